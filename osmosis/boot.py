@@ -1,33 +1,40 @@
 """
 
-Utilities for sub-sampling b vectors from dwi experiments 
+Utilities for sub-sampling b vectors from dwi experiments and for bootstrap
+resampling of the signal
 
 """ 
 
 import numpy as np
-import scipy.linalg as la
 
 import osmosis as oz
 import osmosis.utils as ozu
 
-def subsample(bvecs, n_dirs, elec_points=None):
+def subsample(bvecs, n_dirs, elec_points=None, n_samples=None, prng=None):
     """
 
     Generate a sub-sample of size n of directions from the provided bvecs
 
     Parameters
     ----------
-    bvecs: int array (n by 3), a set of cartesian coordinates for a set of
+    bvecs: int array (3 by n), a set of cartesian coordinates for a set of
     bvecs 
     n_dirs: int, how many bvecs to sub-sample from this set. 
     elec_points: optional, a set of points read from the camino points, using
     Jones (2003) algorithm for electro-static repulsion
+    n_samples: int, optional. If provided, this many sub-samples are drawn
+    together, each relative to a different random seed bvec.
+    prng: RandomState, optional. The source of randomness. Defaults to the
+    numpy global one.
     
     Returns 
     -------
     [x,y,z]: The coordinates of the sub-sample
     bvec_idx: The indices into the original bvecs that would give this
         sub-sample 
+
+    If n_samples is provided, these have an additional first dimension, with
+    one sub-sample in each row.
  
     Notes
     -----
@@ -35,43 +42,51 @@ def subsample(bvecs, n_dirs, elec_points=None):
     points in the directory camino_pts.
 
     """
-    
+    if prng is None:
+        prng = np.random
+    bvecs = np.asarray(bvecs, dtype=float)
+    if n_dirs > bvecs.shape[-1]:
+        e_s = "Can't sub-sample %s directions out of %s" % (n_dirs,
+                                                            bvecs.shape[-1])
+        raise ValueError(e_s)
+
     if elec_points is None:
         # We need a n by 3 here:
         xyz = ozu.get_camino_pts(n_dirs).T
     else:
-        xyz = elec_points.copy()
-            
-    # Rotate all the points to align with the seed, the bvec relative to which
-    # all the rest are chosen (lots going on in this one line):
-    rot_to_first = ozu.calculate_rotation(
-                              bvecs[:, np.ceil(np.random.randint(xyz.shape[0]))],
-                              xyz[0])
+        xyz = np.asarray(elec_points, dtype=float)
+    xyz = xyz[:n_dirs] / np.sqrt(np.sum(xyz[:n_dirs] ** 2, -1))[:, None]
 
-    new_points = np.dot(rot_to_first, bvecs).T
+    # Rotate all the points to align with the seed, the bvec relative to which
+    # all the rest are chosen (one seed for each sample):
+    unit_bvecs = bvecs / np.maximum(np.sqrt(np.sum(bvecs ** 2, 0)),
+                                    np.finfo(float).tiny)
+    seed = unit_bvecs[:, prng.randint(bvecs.shape[-1], size=n_samples or 1)].T
+    # The bvecs are antipodally symmetric, so we can take the seed on the
+    # same hemi-sphere as the first point, and rotate with Rodrigues' formula:
+    seed = seed * np.where(np.dot(seed, xyz[0]) < 0, -1, 1)[:, None]
+    axis = np.cross(xyz[0], seed)
+    cross = np.zeros((seed.shape[0], 3, 3))
+    cross[:, [2, 0, 1], [1, 2, 0]] = axis
+    cross[:, [1, 2, 0], [2, 0, 1]] = -axis
+    rot = (np.eye(3) + cross + np.matmul(cross, cross) /
+           (1 + np.dot(seed, xyz[0]))[:, None, None])
+    points = np.matmul(xyz, np.swapaxes(rot, -1, -2))
 
-    sample_bvecs = np.zeros((3, n_dirs))
-    bvec_idx = []
+    # The antipodally symmetric angle between every point and every bvec:
+    angles = np.arccos(np.minimum(np.abs(np.matmul(points, unit_bvecs)), 1))
 
-    potential_indices = np.arange(bvecs.shape[-1])
+    # Each point, in order, takes the closest bvec that wasn't taken yet:
+    samples = np.arange(angles.shape[0])
+    bvec_idx = np.empty((angles.shape[0], n_dirs), dtype=int)
     for vec in xrange(n_dirs):
-        this = new_points[vec]
-        delta = np.zeros(potential_indices.shape)
-        for j in range(delta.shape[0]):
-            delta[j] = ozu.vector_angle(this, bvecs[:, j])
+        bvec_idx[:, vec] = np.argmin(angles[:, vec], -1)
+        angles[samples[:, None], :, bvec_idx[:, vec:vec + 1]] = np.inf
 
-        this_idx = np.where(delta==np.min(delta))
-        
-        bvec_idx.append(potential_indices[this_idx])    
-        sample_bvecs[:, vec] = np.squeeze(bvecs[:, this_idx])
-
-        # Remove bvecs that you've used, so that you don't have them more than
-        # once: 
-        bvecs = np.hstack([bvecs[:, :this_idx[0]],bvecs[:, this_idx[0]+1:]])
-        potential_indices = np.hstack([potential_indices[:this_idx[0]],
-                                            potential_indices[this_idx[0]+1:]])
-        
-    return sample_bvecs, np.array(bvec_idx).squeeze()
+    sample_bvecs = bvecs[:, bvec_idx].transpose(1, 0, 2)
+    if n_samples is None:
+        return sample_bvecs[0], bvec_idx[0]
+    return sample_bvecs, bvec_idx
         
 def dyadic_tensor(eigs,average=True):
     """
@@ -80,8 +95,13 @@ def dyadic_tensor(eigs,average=True):
 
     Parameters
     ----------
-    eigs: (n,3,3) array
-        Sets of eigenvectors that correspond to the same voxel
+    eigs: (..., n, 3, 3) array
+        Sets of eigenvectors that correspond to the same voxel. Leading
+        dimensions (for example, voxels) are computed over together.
+
+    average: bool
+        Whether to return the average dyadic tensor (with shape (..., 3, 3)),
+        or the dyadic tensors of all n sets (with shape (..., n, 3, 3)).
 
     Notes
     -----
@@ -100,15 +120,13 @@ def dyadic_tensor(eigs,average=True):
     orientation from diffusion tensor MRI MRM, 49: 7-12
     """
 
-    eigs = np.asarray(eigs)
-    dyad = np.empty(eigs.shape)
-    
-    for idx in xrange(eigs.shape[0]):
-        # We only look at the first eigen-vector:
-        dyad[idx] = np.matrix(eigs[idx][0]).T * np.matrix(eigs[idx][0])
+    eigs = np.asarray(eigs, dtype=float)
+    # We only look at the first eigen-vector:
+    first = eigs[..., 0, :]
+    dyad = first[..., :, np.newaxis] * first[..., np.newaxis, :]
 
     if average:
-        return np.mean(dyad, 0)
+        return np.mean(dyad, -3)
     else:
         return dyad
 
@@ -120,37 +138,132 @@ def dyad_coherence(dyad):
 
     Jones (2003). Determining and visualizing uncertainty in estimates of fiber
     orientation from diffusion tensor MRI MRM, 49: 7-12
+
+    Parameters
+    ----------
+    dyad: (..., 3, 3) array
+        Average dyadic tensors (for example, one for each voxel)
     """
-    vals, vecs = la.eigh(dyad)
+    # Round-off can make the (non-negative) small eigenvalues negative:
+    vals = np.maximum(np.linalg.eigvalsh(dyad), 0)
 
     # The eigenvalues are returned in *ascending* order:
-    return (1 - np.sqrt((vals[0] + vals[1])/(2*vals[2])))
+    return (1 - np.sqrt((vals[..., 0] + vals[..., 1])/(2*vals[..., 2])))
 
 def dyad_dispersion(dyad):
     """
     A measure of dispersion of the dyadic tensors of several tensors. Requires
     the full distribution of dyadic tensors (dyadic_tensor calculated with
-    average=False) 
+    average=False)
+
+    Parameters
+    ----------
+    dyad: (..., n, 3, 3) array
+        The n dyadic tensors (for example, of n bootstrap samples in each
+        voxel)
     """
-    mean_principal_eigvec = np.mean(dyad,0)[0]
-
-    theta = []
-    for this_d in dyad:
-        # Using a variation on equation 3 in Jones(2003), taking the arccos of
-        # the correlation between the two vectors (this should yield 90 degrees
-        # for orthogonal vectors and 0 degrees for identical vectors): 
-        corr = (np.dot(this_d[0],mean_principal_eigvec)/
-                        (np.sqrt(np.dot(this_d[0],this_d[0]) *
-                               np.dot(mean_principal_eigvec,
-                                      mean_principal_eigvec))))
-
-        # We sometimes get floating point error leading to larger-than-1
-        # correlation, we treat that as though it were equal to 1:
-        if corr>1.0:
-            corr=1.0
-        angle = np.arccos(corr)
-
-        theta.append(angle)
+    dyad = np.asarray(dyad, dtype=float)
+    principal = dyad[..., 0, :]
+    mean_principal_eigvec = np.mean(dyad, -3)[..., np.newaxis, 0, :]
+
+    # Using a variation on equation 3 in Jones(2003), taking the arccos of
+    # the correlation between the two vectors (this should yield 90 degrees
+    # for orthogonal vectors and 0 degrees for identical vectors):
+    corr = (np.sum(principal * mean_principal_eigvec, -1) /
+            np.sqrt(np.sum(principal ** 2, -1) *
+                    np.sum(mean_principal_eigvec ** 2, -1)))
+
+    # We sometimes get floating point error leading to larger-than-1
+    # correlation, we treat that as though it were equal to 1:
+    theta = np.arccos(np.minimum(corr, 1.0))
 
     # Average over all the tensors:
-    return np.mean(theta)
+    return np.mean(theta, -1)
+
+
+def resample_residuals(residuals, n_samples, method='residual',
+                       leverage=None, prng=None):
+    """
+    Bootstrap samples of the residuals of a linear model fit
+
+    Parameters
+    ----------
+    residuals: (..., n) array
+        The residuals of the fit in each of n measurements (for example, in
+        each direction of each voxel).
+
+    n_samples: int
+        How many samples to draw
+
+    method: str
+        'residual' to draw the residuals of each voxel with replacement from
+        its own n residuals, or 'wild' to flip the sign of each of the
+        residuals at random (a Rademacher wild bootstrap).
+
+    leverage: (n,) array, optional
+        The leverage (diagonal of the hat matrix) of each measurement. If
+        provided, the residuals are scaled by 1/sqrt(1 - leverage) before
+        resampling.
+
+    prng: RandomState, optional
+        The source of randomness. Defaults to the numpy global one.
+
+    Returns
+    -------
+    (n_samples, ..., n) array of resampled residuals
+
+    Notes
+    -----
+    Chung, SW., Lu, Y., Henry, R.G., 2006. Comparison of bootstrap
+    approaches for estimation of uncertainties of DTI parameters.
+    NeuroImage 33, 531-541.
+    """
+    if prng is None:
+        prng = np.random
+    residuals = np.asarray(residuals, dtype=float)
+    if leverage is not None:
+        residuals = residuals / np.sqrt(1 - np.asarray(leverage))
+    shape = (n_samples, ) + residuals.shape
+    if method == 'residual':
+        # Each row of the flattened residuals is drawn from itself:
+        flat = residuals.reshape(-1, residuals.shape[-1])
+        rows = np.arange(flat.shape[0])[:, np.newaxis]
+        choice = prng.randint(flat.shape[-1], size=(n_samples,) + flat.shape)
+        return flat[rows, choice].reshape(shape)
+    elif method == 'wild':
+        return residuals * (2 * prng.randint(2, size=shape) - 1)
+    else:
+        e_s = "method must be one of 'residual' or 'wild', "
+        e_s += "not '%s'" % method
+        raise ValueError(e_s)
+
+
+def resample_repetitions(repetitions, n_samples, prng=None):
+    """
+    Bootstrap samples of repeated measurements, choosing each measurement
+    from one of the repetitions at random
+
+    Parameters
+    ----------
+    repetitions: (n_reps, ..., n) array
+        n_reps repetitions of the same n measurements (for example, of the
+        signal in each direction of each voxel).
+
+    n_samples: int
+        How many samples to draw
+
+    prng: RandomState, optional
+        The source of randomness. Defaults to the numpy global one.
+
+    Returns
+    -------
+    (n_samples, ..., n) array of resampled measurements
+    """
+    if prng is None:
+        prng = np.random
+    repetitions = np.asarray(repetitions)
+    choice = prng.randint(repetitions.shape[0],
+                          size=(n_samples,) + repetitions.shape[1:])
+    # All the other dimensions index themselves:
+    others = np.ix_(*[np.arange(n) for n in repetitions.shape[1:]])
+    return repetitions[(choice, ) + others]
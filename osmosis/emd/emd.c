@@ -51,30 +51,37 @@ typedef struct node2_t {
 
 
 
+/* THE STATE OF ONE COMPUTATION. EACH THREAD NEEDS ITS OWN (SEE emd_r) */
+struct emd_state_t {
+  int n1, n2;                          /* SIGNATURES SIZES */
+  float C[MAX_SIG_SIZE1][MAX_SIG_SIZE1];/* THE COST MATRIX */
+  node2_t X[MAX_SIG_SIZE1*2];          /* THE BASIC VARIABLES VECTOR */
+  /* VARIABLES TO HANDLE X EFFICIENTLY */
+  node2_t *EndX, *EnterX;
+  char IsX[MAX_SIG_SIZE1][MAX_SIG_SIZE1];
+  node2_t *RowsX[MAX_SIG_SIZE1], *ColsX[MAX_SIG_SIZE1];
+  double maxW;
+  float maxC;
+  /* WORKSPACE FOR russel (TOO LARGE FOR THE STACK OF A THREAD) */
+  double Delta[MAX_SIG_SIZE1][MAX_SIG_SIZE1];
+};
+
 /* GLOBAL VARIABLE DECLARATION */
-static int _n1, _n2;                          /* SIGNATURES SIZES */
-static float _C[MAX_SIG_SIZE1][MAX_SIG_SIZE1];/* THE COST MATRIX */
-static node2_t _X[MAX_SIG_SIZE1*2];            /* THE BASIC VARIABLES VECTOR */
-/* VARIABLES TO HANDLE _X EFFICIENTLY */
-static node2_t *_EndX, *_EnterX;
-static char _IsX[MAX_SIG_SIZE1][MAX_SIG_SIZE1];
-static node2_t *_RowsX[MAX_SIG_SIZE1], *_ColsX[MAX_SIG_SIZE1];
-static double _maxW;
-static float _maxC;
+static emd_state_t _state;             /* USED BY emd() */
 
 /* DECLARATION OF FUNCTIONS */
-static float init(signature_t *Signature1, signature_t *Signature2,
+static float init(emd_state_t *s, signature_t *Signature1, signature_t *Signature2,
 		  float *cost);
-static void findBasicVariables(node1_t *U, node1_t *V);
-static int isOptimal(node1_t *U, node1_t *V);
-static int findLoop(node2_t **Loop);
-static void newSol(void);
-static void russel(double *S, double *D);
-static void addBasicVariable(int minI, int minJ, double *S, double *D, 
+static void findBasicVariables(emd_state_t *s, node1_t *U, node1_t *V);
+static int isOptimal(emd_state_t *s, node1_t *U, node1_t *V);
+static int findLoop(emd_state_t *s, node2_t **Loop);
+static void newSol(emd_state_t *s);
+static void russel(emd_state_t *s, double *S, double *D);
+static void addBasicVariable(emd_state_t *s, int minI, int minJ, double *S, double *D, 
 			     node1_t *PrevUMinI, node1_t *PrevVMinJ,
 			     node1_t *UHead);
 #if DEBUG_LEVEL > 0
-static void printSolution(void);
+static void printSolution(emd_state_t *s);
 #endif
 
 
@@ -101,6 +108,32 @@ where
 float emd(signature_t *Signature1, signature_t *Signature2,
 	  float *cost,
 	  flow_t *Flow, int *FlowSize)
+{
+  return emd_r(&_state, Signature1, Signature2, cost, Flow, FlowSize);
+}
+
+
+/******************************************************************************
+float emd_r(emd_state_t *s, signature_t *Signature1, signature_t *Signature2,
+	    float *cost, flow_t *Flow, int *FlowSize)
+
+Same as emd, with the work space of the computation in s (allocated with
+emd_state_new). emd_r can run in several threads at once, as long as each
+of them has its own state.
+******************************************************************************/
+
+emd_state_t *emd_state_new(void)
+{
+  return (emd_state_t *)malloc(sizeof(emd_state_t));
+}
+
+void emd_state_free(emd_state_t *s)
+{
+  free(s);
+}
+
+float emd_r(emd_state_t *s, signature_t *Signature1, signature_t *Signature2,
+	    float *cost, flow_t *Flow, int *FlowSize)
 {
   int itr;
   double totalCost;
@@ -109,30 +142,30 @@ float emd(signature_t *Signature1, signature_t *Signature2,
   flow_t *FlowP;
   node1_t U[MAX_SIG_SIZE1], V[MAX_SIG_SIZE1];
 
-  w = init(Signature1, Signature2, cost);
+  w = init(s, Signature1, Signature2, cost);
 
 #if DEBUG_LEVEL > 1
   printf("\nINITIAL SOLUTION:\n");
-  printSolution();
+  printSolution(s);
 #endif
  
-  if (_n1 > 1 && _n2 > 1)  /* IF _n1 = 1 OR _n2 = 1 THEN WE ARE DONE */
+  if (s->n1 > 1 && s->n2 > 1)  /* IF n1 = 1 OR n2 = 1 THEN WE ARE DONE */
     {
       for (itr = 1; itr < MAX_ITERATIONS; itr++)
 	{
 	  /* FIND BASIC VARIABLES */
-	  findBasicVariables(U, V);
+	  findBasicVariables(s, U, V);
 	  
 	  /* CHECK FOR OPTIMALITY */
-	  if (isOptimal(U, V))
+	  if (isOptimal(s, U, V))
 	    break;
 	  
 	  /* IMPROVE SOLUTION */
-	  newSol();
+	  newSol(s);
 	  
 #if DEBUG_LEVEL > 1
 	  printf("\nITERATION # %d \n", itr);
-	  printSolution();
+	  printSolution(s);
 #endif
 	}
 
@@ -145,9 +178,9 @@ float emd(signature_t *Signature1, signature_t *Signature2,
   totalCost = 0;
   if (Flow != NULL)
     FlowP = Flow;
-  for(XP=_X; XP < _EndX; XP++)
+  for(XP=s->X; XP < s->EndX; XP++)
     {
-      if (XP == _EnterX)  /* _EnterX IS THE EMPTY SLOT */
+      if (XP == s->EnterX)  /* EnterX IS THE EMPTY SLOT */
 	continue;
       if (XP->i == Signature1->n || XP->j == Signature2->n)  /* DUMMY FEATURE */
 	continue;
@@ -155,7 +188,7 @@ float emd(signature_t *Signature1, signature_t *Signature2,
       if (XP->val == 0)  /* ZERO FLOW */
 	continue;
 
-      totalCost += (double)XP->val * _C[XP->i][XP->j];
+      totalCost += (double)XP->val * s->C[XP->i][XP->j];
       if (Flow != NULL)
 	{
 	  FlowP->from = XP->i;
@@ -182,7 +215,7 @@ float emd(signature_t *Signature1, signature_t *Signature2,
 /**********************
    init
 **********************/
-static float init(signature_t *Signature1, signature_t *Signature2, 
+static float init(emd_state_t *s, signature_t *Signature1, signature_t *Signature2, 
 		  float *cost)
 {
   int i, j;
@@ -190,39 +223,39 @@ static float init(signature_t *Signature1, signature_t *Signature2,
   //feature_t *P1, *P2;
   double S[MAX_SIG_SIZE1], D[MAX_SIG_SIZE1];
  
-  _n1 = Signature1->n;
-  _n2 = Signature2->n;
+  s->n1 = Signature1->n;
+  s->n2 = Signature2->n;
 
-  if (_n1 > MAX_SIG_SIZE || _n2 > MAX_SIG_SIZE)
+  if (s->n1 > MAX_SIG_SIZE || s->n2 > MAX_SIG_SIZE)
     {
       fprintf(stderr, "emd: Signature size is limited to %d\n", MAX_SIG_SIZE);
       exit(1);
     }
   
   /* COMPUTE THE DISTANCE MATRIX */
-  _maxC = 0;
-  for(i=0; i < _n1; i++)
-    for(j=0; j < _n2; j++) 
+  s->maxC = 0;
+  for(i=0; i < s->n1; i++)
+    for(j=0; j < s->n2; j++) 
       {
-	_C[i][j] = cost[i * _n2 + j]; 
-	if (_C[i][j] > _maxC)
-	  _maxC = _C[i][j];
+	s->C[i][j] = cost[i * s->n2 + j]; 
+	if (s->C[i][j] > s->maxC)
+	  s->maxC = s->C[i][j];
       }
 	
   /* SUM UP THE SUPPLY AND DEMAND */
   sSum = 0.0;
-  for(i=0; i < _n1; i++)
+  for(i=0; i < s->n1; i++)
     {
       S[i] = Signature1->Weights[i];
       sSum += Signature1->Weights[i];
-      _RowsX[i] = NULL;
+      s->RowsX[i] = NULL;
     }
   dSum = 0.0;
-  for(j=0; j < _n2; j++)
+  for(j=0; j < s->n2; j++)
     {
       D[j] = Signature2->Weights[j];
       dSum += Signature2->Weights[j];
-      _ColsX[j] = NULL;
+      s->ColsX[j] = NULL;
     }
 
   /* IF SUPPLY DIFFERENT THAN THE DEMAND, ADD A ZERO-COST DUMMY CLUSTER */
@@ -231,34 +264,34 @@ static float init(signature_t *Signature1, signature_t *Signature2,
     {
       if (diff < 0.0)
 	{
-	  for (j=0; j < _n2; j++)
-	    _C[_n1][j] = 0;
-	  S[_n1] = -diff;
-	  _RowsX[_n1] = NULL;
-	  _n1++;
+	  for (j=0; j < s->n2; j++)
+	    s->C[s->n1][j] = 0;
+	  S[s->n1] = -diff;
+	  s->RowsX[s->n1] = NULL;
+	  s->n1++;
 	}
       else
 	{
-	  for (i=0; i < _n1; i++)
-	    _C[i][_n2] = 0;
-	  D[_n2] = diff;
-	  _ColsX[_n2] = NULL;
-	  _n2++;
+	  for (i=0; i < s->n1; i++)
+	    s->C[i][s->n2] = 0;
+	  D[s->n2] = diff;
+	  s->ColsX[s->n2] = NULL;
+	  s->n2++;
 	}
     }
 
   /* INITIALIZE THE BASIC VARIABLE STRUCTURES */
-  for (i=0; i < _n1; i++)
-    for (j=0; j < _n2; j++)
-	_IsX[i][j] = 0;
-  _EndX = _X;
+  for (i=0; i < s->n1; i++)
+    for (j=0; j < s->n2; j++)
+	s->IsX[i][j] = 0;
+  s->EndX = s->X;
    
-  _maxW = sSum > dSum ? sSum : dSum;
+  s->maxW = sSum > dSum ? sSum : dSum;
 
   /* FIND INITIAL SOLUTION */
-  russel(S, D);
+  russel(s, S, D);
 
-  _EnterX = _EndX++;  /* AN EMPTY SLOT (ONLY _n1+_n2-1 BASIC VARIABLES) */
+  s->EnterX = s->EndX++;  /* AN EMPTY SLOT (ONLY n1+n2-1 BASIC VARIABLES) */
 
   return sSum > dSum ? dSum : sSum;
 }
@@ -267,7 +300,7 @@ static float init(signature_t *Signature1, signature_t *Signature2,
 /**********************
     findBasicVariables
  **********************/
-static void findBasicVariables(node1_t *U, node1_t *V)
+static void findBasicVariables(emd_state_t *s, node1_t *U, node1_t *V)
 {
   int i, j, found;
   int UfoundNum, VfoundNum;
@@ -276,7 +309,7 @@ static void findBasicVariables(node1_t *U, node1_t *V)
 
   /* INITIALIZE THE ROWS LIST (U) AND THE COLUMNS LIST (V) */
   u0Head.Next = CurU = U;
-  for (i=0; i < _n1; i++)
+  for (i=0; i < s->n1; i++)
     {
       CurU->i = i;
       CurU->Next = CurU+1;
@@ -286,8 +319,8 @@ static void findBasicVariables(node1_t *U, node1_t *V)
   u1Head.Next = NULL;
 
   CurV = V+1;
-  v0Head.Next = _n2 > 1 ? V+1 : NULL;
-  for (j=1; j < _n2; j++)
+  v0Head.Next = s->n2 > 1 ? V+1 : NULL;
+  for (j=1; j < s->n2; j++)
     {
       CurV->i = j;
       CurV->Next = CurV+1;
@@ -296,7 +329,7 @@ static void findBasicVariables(node1_t *U, node1_t *V)
   (--CurV)->Next = NULL;
   v1Head.Next = NULL;
 
-  /* THERE ARE _n1+_n2 VARIABLES BUT ONLY _n1+_n2-1 INDEPENDENT EQUATIONS,
+  /* THERE ARE n1+n2 VARIABLES BUT ONLY n1+n2-1 INDEPENDENT EQUATIONS,
      SO SET V[0]=0 */
   V[0].i = 0;
   V[0].val = 0;
@@ -305,11 +338,11 @@ static void findBasicVariables(node1_t *U, node1_t *V)
 
   /* LOOP UNTIL ALL VARIABLES ARE FOUND */
   UfoundNum=VfoundNum=0;
-  while (UfoundNum < _n1 || VfoundNum < _n2)
+  while (UfoundNum < s->n1 || VfoundNum < s->n2)
     {
 
 #if DEBUG_LEVEL > 3
-      printf("UfoundNum=%d/%d,VfoundNum=%d/%d\n",UfoundNum,_n1,VfoundNum,_n2);
+      printf("UfoundNum=%d/%d,VfoundNum=%d/%d\n",UfoundNum,s->n1,VfoundNum,s->n2);
       printf("U0=");
       for(CurU = u0Head.Next; CurU != NULL; CurU = CurU->Next)
 	printf("[%ld]",CurU-U);
@@ -329,7 +362,7 @@ static void findBasicVariables(node1_t *U, node1_t *V)
 #endif
       
       found = 0;
-      if (VfoundNum < _n2)
+      if (VfoundNum < s->n2)
 	{
 	  /* LOOP OVER ALL MARKED COLUMNS */
 	  PrevV = &v1Head;
@@ -341,10 +374,10 @@ static void findBasicVariables(node1_t *U, node1_t *V)
 	      for (CurU=u0Head.Next; CurU != NULL; CurU=CurU->Next)
 		{
 		  i = CurU->i;
-		  if (_IsX[i][j])
+		  if (s->IsX[i][j])
 		    {
 		      /* COMPUTE U[i] */
-		      CurU->val = _C[i][j] - CurV->val;
+		      CurU->val = s->C[i][j] - CurV->val;
 		      /* ...AND ADD IT TO THE MARKED LIST */
 		      PrevU->Next = CurU->Next;
 		      CurU->Next = u1Head.Next != NULL ? u1Head.Next : NULL;
@@ -359,7 +392,7 @@ static void findBasicVariables(node1_t *U, node1_t *V)
 	      found = 1;
 	    }
 	}
-     if (UfoundNum < _n1)
+     if (UfoundNum < s->n1)
 	{
 	  /* LOOP OVER ALL MARKED ROWS */
 	  PrevU = &u1Head;
@@ -371,10 +404,10 @@ static void findBasicVariables(node1_t *U, node1_t *V)
 	      for (CurV=v0Head.Next; CurV != NULL; CurV=CurV->Next)
 		{
 		  j = CurV->i;
-		  if (_IsX[i][j])
+		  if (s->IsX[i][j])
 		    {
 		      /* COMPUTE V[j] */
-		      CurV->val = _C[i][j] - CurU->val;
+		      CurV->val = s->C[i][j] - CurU->val;
 		      /* ...AND ADD IT TO THE MARKED LIST */
 		      PrevV->Next = CurV->Next;
 		      CurV->Next = v1Head.Next != NULL ? v1Head.Next: NULL;
@@ -405,18 +438,18 @@ static void findBasicVariables(node1_t *U, node1_t *V)
 /**********************
     isOptimal
  **********************/
-static int isOptimal(node1_t *U, node1_t *V)
+static int isOptimal(emd_state_t *s, node1_t *U, node1_t *V)
 {    
   double delta, deltaMin;
   int i, j, minI, minJ;
 
   /* FIND THE MINIMAL Cij-Ui-Vj OVER ALL i,j */
   deltaMin = INFINITY;
-  for(i=0; i < _n1; i++)
-    for(j=0; j < _n2; j++)
-      if (! _IsX[i][j])
+  for(i=0; i < s->n1; i++)
+    for(j=0; j < s->n2; j++)
+      if (! s->IsX[i][j])
 	{
-	  delta = _C[i][j] - U[i].val - V[j].val;
+	  delta = s->C[i][j] - U[i].val - V[j].val;
 	  if (deltaMin > delta)
 	    {
               deltaMin = delta;
@@ -435,11 +468,11 @@ static int isOptimal(node1_t *U, node1_t *V)
        exit(0);
      }
    
-   _EnterX->i = minI;
-   _EnterX->j = minJ;
+   s->EnterX->i = minI;
+   s->EnterX->j = minJ;
    
    /* IF NO NEGATIVE deltaMin, WE FOUND THE OPTIMAL SOLUTION */
-   return deltaMin >= -EPSILON * _maxC;
+   return deltaMin >= -EPSILON * s->maxC;
 
 /*
    return deltaMin >= -EPSILON;
@@ -450,7 +483,7 @@ static int isOptimal(node1_t *U, node1_t *V)
 /**********************
     newSol
 **********************/
-static void newSol(void)
+static void newSol(emd_state_t *s)
 {
     int i, j, k;
     double xMin;
@@ -458,21 +491,21 @@ static void newSol(void)
     node2_t *Loop[2*MAX_SIG_SIZE1], *CurX, *LeaveX;
  
 #if DEBUG_LEVEL > 3
-    printf("EnterX = (%d,%d)\n", _EnterX->i, _EnterX->j);
+    printf("EnterX = (%d,%d)\n", s->EnterX->i, s->EnterX->j);
 #endif
 
     /* ENTER THE NEW BASIC VARIABLE */
-    i = _EnterX->i;
-    j = _EnterX->j;
-    _IsX[i][j] = 1;
-    _EnterX->NextC = _RowsX[i];
-    _EnterX->NextR = _ColsX[j];
-    _EnterX->val = 0;
-    _RowsX[i] = _EnterX;
-    _ColsX[j] = _EnterX;
+    i = s->EnterX->i;
+    j = s->EnterX->j;
+    s->IsX[i][j] = 1;
+    s->EnterX->NextC = s->RowsX[i];
+    s->EnterX->NextR = s->ColsX[j];
+    s->EnterX->val = 0;
+    s->RowsX[i] = s->EnterX;
+    s->ColsX[j] = s->EnterX;
 
     /* FIND A CHAIN REACTION */
-    steps = findLoop(Loop);
+    steps = findLoop(s, Loop);
 
     /* FIND THE LARGEST VALUE IN THE LOOP */
     xMin = INFINITY;
@@ -499,28 +532,28 @@ static void newSol(void)
     /* REMOVE THE LEAVING BASIC VARIABLE */
     i = LeaveX->i;
     j = LeaveX->j;
-    _IsX[i][j] = 0;
-    if (_RowsX[i] == LeaveX)
-      _RowsX[i] = LeaveX->NextC;
+    s->IsX[i][j] = 0;
+    if (s->RowsX[i] == LeaveX)
+      s->RowsX[i] = LeaveX->NextC;
     else
-      for (CurX=_RowsX[i]; CurX != NULL; CurX = CurX->NextC)
+      for (CurX=s->RowsX[i]; CurX != NULL; CurX = CurX->NextC)
 	if (CurX->NextC == LeaveX)
 	  {
 	    CurX->NextC = CurX->NextC->NextC;
 	    break;
 	  }
-    if (_ColsX[j] == LeaveX)
-      _ColsX[j] = LeaveX->NextR;
+    if (s->ColsX[j] == LeaveX)
+      s->ColsX[j] = LeaveX->NextR;
     else
-      for (CurX=_ColsX[j]; CurX != NULL; CurX = CurX->NextR)
+      for (CurX=s->ColsX[j]; CurX != NULL; CurX = CurX->NextR)
 	if (CurX->NextR == LeaveX)
 	  {
 	    CurX->NextR = CurX->NextR->NextR;
 	    break;
 	  }
 
-    /* SET _EnterX TO BE THE NEW EMPTY SLOT */
-    _EnterX = LeaveX;
+    /* SET EnterX TO BE THE NEW EMPTY SLOT */
+    s->EnterX = LeaveX;
 }
 
 
@@ -528,18 +561,18 @@ static void newSol(void)
 /**********************
     findLoop
 **********************/
-static int findLoop(node2_t **Loop)
+static int findLoop(emd_state_t *s, node2_t **Loop)
 {
   int i, steps;
   node2_t **CurX, *NewX;
   char IsUsed[2*MAX_SIG_SIZE1]; 
  
-  for (i=0; i < _n1+_n2; i++)
+  for (i=0; i < s->n1+s->n2; i++)
     IsUsed[i] = 0;
 
   CurX = Loop;
-  NewX = *CurX = _EnterX;
-  IsUsed[_EnterX-_X] = 1;
+  NewX = *CurX = s->EnterX;
+  IsUsed[s->EnterX-s->X] = 1;
   steps = 1;
 
   do
@@ -547,17 +580,17 @@ static int findLoop(node2_t **Loop)
       if (steps%2 == 1)
 	{
 	  /* FIND AN UNUSED X IN THE ROW */
-	  NewX = _RowsX[NewX->i];
-	  while (NewX != NULL && IsUsed[NewX-_X])
+	  NewX = s->RowsX[NewX->i];
+	  while (NewX != NULL && IsUsed[NewX-s->X])
 	    NewX = NewX->NextC;
 	}
       else
 	{
 	  /* FIND AN UNUSED X IN THE COLUMN, OR THE ENTERING X */
-	  NewX = _ColsX[NewX->j];
-	  while (NewX != NULL && IsUsed[NewX-_X] && NewX != _EnterX)
+	  NewX = s->ColsX[NewX->j];
+	  while (NewX != NULL && IsUsed[NewX-s->X] && NewX != s->EnterX)
 	    NewX = NewX->NextR;
-	  if (NewX == _EnterX)
+	  if (NewX == s->EnterX)
 	    break;
  	}
 
@@ -565,7 +598,7 @@ static int findLoop(node2_t **Loop)
        {
 	 /* ADD X TO THE LOOP */
 	 *++CurX = NewX;
-	 IsUsed[NewX-_X] = 1;
+	 IsUsed[NewX-s->X] = 1;
 	 steps++;
 #if DEBUG_LEVEL > 3
 	 printf("steps=%d, NewX=(%d,%d)\n", steps, NewX->i, NewX->j);    
@@ -583,11 +616,11 @@ static int findLoop(node2_t **Loop)
 		   NewX = NewX->NextR;
 		 else
 		   NewX = NewX->NextC;
-	       } while (NewX != NULL && IsUsed[NewX-_X]);
+	       } while (NewX != NULL && IsUsed[NewX-s->X]);
 	     
 	     if (NewX == NULL)
 	       {
-		 IsUsed[*CurX-_X] = 0;
+		 IsUsed[*CurX-s->X] = 0;
 		 CurX--;
 		 steps--;
 	       }
@@ -597,9 +630,9 @@ static int findLoop(node2_t **Loop)
 	 printf("BACKTRACKING TO: steps=%d, NewX=(%d,%d)\n",
 		steps, NewX->i, NewX->j);    
 #endif
-           IsUsed[*CurX-_X] = 0;
+           IsUsed[*CurX-s->X] = 0;
 	   *CurX = NewX;
-	   IsUsed[NewX-_X] = 1;
+	   IsUsed[NewX-s->X] = 1;
        }     
     } while(CurX >= Loop);
   
@@ -622,11 +655,10 @@ static int findLoop(node2_t **Loop)
 /**********************
     russel
 **********************/
-static void russel(double *S, double *D)
+static void russel(emd_state_t *s, double *S, double *D)
 {
   int i, j, found, minI, minJ;
   double deltaMin, oldVal, diff;
-  double Delta[MAX_SIG_SIZE1][MAX_SIG_SIZE1];
   node1_t Ur[MAX_SIG_SIZE1], Vr[MAX_SIG_SIZE1];
   node1_t uHead, *CurU, *PrevU;
   node1_t vHead, *CurV, *PrevV;
@@ -634,7 +666,7 @@ static void russel(double *S, double *D)
 
   /* INITIALIZE THE ROWS LIST (Ur), AND THE COLUMNS LIST (Vr) */
   uHead.Next = CurU = Ur;
-  for (i=0; i < _n1; i++)
+  for (i=0; i < s->n1; i++)
     {
       CurU->i = i;
       CurU->val = -INFINITY;
@@ -644,7 +676,7 @@ static void russel(double *S, double *D)
   (--CurU)->Next = NULL;
   
   vHead.Next = CurV = Vr;
-  for (j=0; j < _n2; j++)
+  for (j=0; j < s->n2; j++)
     {
       CurV->i = j;
       CurV->val = -INFINITY;
@@ -654,11 +686,11 @@ static void russel(double *S, double *D)
   (--CurV)->Next = NULL;
   
   /* FIND THE MAXIMUM ROW AND COLUMN VALUES (Ur[i] AND Vr[j]) */
-  for(i=0; i < _n1 ; i++)
-    for(j=0; j < _n2 ; j++)
+  for(i=0; i < s->n1 ; i++)
+    for(j=0; j < s->n2 ; j++)
       {
 	float v;
-	v = _C[i][j];
+	v = s->C[i][j];
 	if (Ur[i].val <= v)
 	  Ur[i].val = v;
 	if (Vr[j].val <= v)
@@ -666,9 +698,9 @@ static void russel(double *S, double *D)
       }
   
   /* COMPUTE THE Delta MATRIX */
-  for(i=0; i < _n1 ; i++)
-    for(j=0; j < _n2 ; j++)
-      Delta[i][j] = _C[i][j] - Ur[i].val - Vr[j].val;
+  for(i=0; i < s->n1 ; i++)
+    for(j=0; j < s->n2 ; j++)
+      s->Delta[i][j] = s->C[i][j] - Ur[i].val - Vr[j].val;
 
   /* FIND THE BASIC VARIABLES */
   do
@@ -698,9 +730,9 @@ static void russel(double *S, double *D)
 	    {
 	      int j;
 	      j = CurV->i;
-	      if (deltaMin > Delta[i][j])
+	      if (deltaMin > s->Delta[i][j])
 		{
-		  deltaMin = Delta[i][j];
+		  deltaMin = s->Delta[i][j];
 		  minI = i;
 		  minJ = j;
 		  PrevUMinI = PrevU;
@@ -717,7 +749,7 @@ static void russel(double *S, double *D)
 
       /* ADD X[minI][minJ] TO THE BASIS, AND ADJUST SUPPLIES AND COST */
       Remember = PrevUMinI->Next;
-      addBasicVariable(minI, minJ, S, D, PrevUMinI, PrevVMinJ, &uHead);
+      addBasicVariable(s, minI, minJ, S, D, PrevUMinI, PrevVMinJ, &uHead);
 
       /* UPDATE THE NECESSARY Delta[][] */
       if (Remember == PrevUMinI->Next)  /* LINE minI WAS DELETED */
@@ -726,7 +758,7 @@ static void russel(double *S, double *D)
 	    {
 	      int j;
 	      j = CurV->i;
-	      if (CurV->val == _C[minI][j])  /* COLUMN j NEEDS UPDATING */
+	      if (CurV->val == s->C[minI][j])  /* COLUMN j NEEDS UPDATING */
 		{
 		  /* FIND THE NEW MAXIMUM VALUE IN THE COLUMN */
 		  oldVal = CurV->val;
@@ -735,15 +767,15 @@ static void russel(double *S, double *D)
 		    {
 		      int i;
 		      i = CurU->i;
-		      if (CurV->val <= _C[i][j])
-			CurV->val = _C[i][j];
+		      if (CurV->val <= s->C[i][j])
+			CurV->val = s->C[i][j];
 		    }
 		  
 		  /* IF NEEDED, ADJUST THE RELEVANT Delta[*][j] */
 		  diff = oldVal - CurV->val;
-		  if (fabs(diff) < EPSILON * _maxC)
+		  if (fabs(diff) < EPSILON * s->maxC)
 		    for (CurU=uHead.Next; CurU != NULL; CurU=CurU->Next)
-		      Delta[CurU->i][j] += diff;
+		      s->Delta[CurU->i][j] += diff;
 		}
 	    }
 	}
@@ -753,7 +785,7 @@ static void russel(double *S, double *D)
 	    {
 	      int i;
 	      i = CurU->i;
-	      if (CurU->val == _C[i][minJ])  /* ROW i NEEDS UPDATING */
+	      if (CurU->val == s->C[i][minJ])  /* ROW i NEEDS UPDATING */
 		{
 		  /* FIND THE NEW MAXIMUM VALUE IN THE ROW */
 		  oldVal = CurU->val;
@@ -762,15 +794,15 @@ static void russel(double *S, double *D)
 		    {
 		      int j;
 		      j = CurV->i;
-		      if(CurU->val <= _C[i][j])
-			CurU->val = _C[i][j];
+		      if(CurU->val <= s->C[i][j])
+			CurU->val = s->C[i][j];
 		    }
 		  
 		  /* If NEEDED, ADJUST THE RELEVANT Delta[i][*] */
 		  diff = oldVal - CurU->val;
-		  if (fabs(diff) < EPSILON * _maxC)
+		  if (fabs(diff) < EPSILON * s->maxC)
 		    for (CurV=vHead.Next; CurV != NULL; CurV=CurV->Next)
-		      Delta[i][CurV->i] += diff;
+		      s->Delta[i][CurV->i] += diff;
 		}
 	    }
 	}
@@ -783,13 +815,13 @@ static void russel(double *S, double *D)
 /**********************
     addBasicVariable
 **********************/
-static void addBasicVariable(int minI, int minJ, double *S, double *D, 
+static void addBasicVariable(emd_state_t *s, int minI, int minJ, double *S, double *D, 
 			     node1_t *PrevUMinI, node1_t *PrevVMinJ,
 			     node1_t *UHead)
 {
   double T;
   
-  if (fabs(S[minI]-D[minJ]) <= EPSILON * _maxW)  /* DEGENERATE CASE */
+  if (fabs(S[minI]-D[minJ]) <= EPSILON * s->maxW)  /* DEGENERATE CASE */
     {
       T = S[minI];
       S[minI] = 0;
@@ -809,16 +841,16 @@ static void addBasicVariable(int minI, int minJ, double *S, double *D,
     }
 
   /* X(minI,minJ) IS A BASIC VARIABLE */
-  _IsX[minI][minJ] = 1; 
+  s->IsX[minI][minJ] = 1; 
 
-  _EndX->val = T;
-  _EndX->i = minI;
-  _EndX->j = minJ;
-  _EndX->NextC = _RowsX[minI];
-  _EndX->NextR = _ColsX[minJ];
-  _RowsX[minI] = _EndX;
-  _ColsX[minJ] = _EndX;
-  _EndX++;
+  s->EndX->val = T;
+  s->EndX->i = minI;
+  s->EndX->j = minJ;
+  s->EndX->NextC = s->RowsX[minI];
+  s->EndX->NextR = s->ColsX[minJ];
+  s->RowsX[minI] = s->EndX;
+  s->ColsX[minJ] = s->EndX;
+  s->EndX++;
 
   /* DELETE SUPPLY ROW ONLY IF THE EMPTY, AND IF NOT LAST ROW */
   if (S[minI] == 0 && UHead->Next->Next != NULL)
@@ -834,7 +866,7 @@ static void addBasicVariable(int minI, int minJ, double *S, double *D,
 /**********************
     printSolution
 **********************/
-static void printSolution(void)
+static void printSolution(emd_state_t *s)
 {
   node2_t *P;
   double totalCost;
@@ -844,13 +876,13 @@ static void printSolution(void)
 #if DEBUG_LEVEL > 2
   printf("SIG1\tSIG2\tFLOW\tCOST\n");
 #endif
-  for(P=_X; P < _EndX; P++)
-    if (P != _EnterX && _IsX[P->i][P->j])
+  for(P=s->X; P < s->EndX; P++)
+    if (P != s->EnterX && s->IsX[P->i][P->j])
       {
 #if DEBUG_LEVEL > 2
-	printf("%d\t%d\t%f\t%f\n", P->i, P->j, P->val, _C[P->i][P->j]);
+	printf("%d\t%d\t%f\t%f\n", P->i, P->j, P->val, s->C[P->i][P->j]);
 #endif
-	totalCost += (double)P->val * _C[P->i][P->j];
+	totalCost += (double)P->val * s->C[P->i][P->j];
       }
 
   printf("COST = %f\n", totalCost);
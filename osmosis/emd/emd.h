@@ -48,4 +48,12 @@ float emd(signature_t *Signature1, signature_t *Signature2,
 	  float *cost,
 	  flow_t *Flow, int *FlowSize);
 
+/* Re-entrant version of emd. Each thread needs its own state: */
+typedef struct emd_state_t emd_state_t;
+
+emd_state_t *emd_state_new(void);
+void emd_state_free(emd_state_t *s);
+float emd_r(emd_state_t *s, signature_t *Signature1, signature_t *Signature2,
+	    float *cost, flow_t *Flow, int *FlowSize);
+
 #endif
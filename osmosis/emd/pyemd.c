@@ -1,4 +1,7 @@
 #include <Python.h>
+#include <math.h>
+#include <string.h>
+#include <pthread.h>
 #include "emd.h"
 
 // define PyInt_* macros for Python 3.x
@@ -99,9 +102,227 @@ static PyObject *compute_emd(PyObject *self, PyObject *args, PyObject *keywds)
   return Py_BuildValue("d", distance);
 }
 
+/* Batched EMD: many pairs of signatures with the same ground distances */
+
+typedef struct {
+  const double *w1, *w2, *cost;
+  int n_pairs, n1, n2, normalize;
+  int thread, n_threads;
+  double *out;
+  int failed, started;
+} batch_t;
+
+/* Keep only the features with positive weight, and the corresponding block
+   of the cost matrix. Returns the total weight kept. */
+static double compact_weights(const double *w, int n, float *w_out, int *idx)
+{
+  int i, k = 0;
+  double total = 0;
+  for(i = 0; i < n; i ++) {
+    if(w[i] > 0) {
+      w_out[k] = w[i];
+      idx[k] = i;
+      total += w[i];
+      k ++;
+    }
+  }
+  idx[n] = k;
+  return total;
+}
+
+static void *emd_batch_worker(void *arg)
+{
+  batch_t *b = (batch_t *)arg;
+  emd_state_t *state;
+  float *w1, *w2, *c;
+  int *idx1, *idx2;
+  int p, i, j, k1, k2;
+  double total1, total2;
+  signature_t signature1, signature2;
+
+  state = emd_state_new();
+  w1 = malloc(b->n1 * sizeof(float));
+  w2 = malloc(b->n2 * sizeof(float));
+  c = malloc(b->n1 * b->n2 * sizeof(float));
+  idx1 = malloc((b->n1 + 1) * sizeof(int));
+  idx2 = malloc((b->n2 + 1) * sizeof(int));
+  if(state == NULL || w1 == NULL || w2 == NULL || c == NULL ||
+     idx1 == NULL || idx2 == NULL) {
+    b->failed = 1;
+    goto cleanup;
+  }
+
+  for(p = b->thread; p < b->n_pairs; p += b->n_threads) {
+    total1 = compact_weights(b->w1 + (size_t)p * b->n1, b->n1, w1, idx1);
+    total2 = compact_weights(b->w2 + (size_t)p * b->n2, b->n2, w2, idx2);
+    k1 = idx1[b->n1];
+    k2 = idx2[b->n2];
+    if(k1 == 0 || k2 == 0) {
+      b->out[p] = NAN;
+      continue;
+    }
+    if(b->normalize) {
+      for(i = 0; i < k1; i ++)
+	w1[i] /= total1;
+      for(j = 0; j < k2; j ++)
+	w2[j] /= total2;
+    }
+    for(i = 0; i < k1; i ++)
+      for(j = 0; j < k2; j ++)
+	c[i * k2 + j] = b->cost[(size_t)idx1[i] * b->n2 + idx2[j]];
+
+    signature1.n = k1;
+    signature1.Weights = w1;
+    signature2.n = k2;
+    signature2.Weights = w2;
+    b->out[p] = emd_r(state, &signature1, &signature2, c, 0, 0);
+  }
+
+ cleanup:
+  emd_state_free(state);
+  free(w1);
+  free(w2);
+  free(c);
+  free(idx1);
+  free(idx2);
+  return NULL;
+}
+
+static int get_double_buffer(PyObject *obj, Py_buffer *view, const char *name)
+{
+  if(PyObject_GetBuffer(obj, view, PyBUF_C_CONTIGUOUS | PyBUF_FORMAT) < 0)
+    return -1;
+  if(view->itemsize != sizeof(double) || view->format == NULL ||
+     view->format[strlen(view->format) - 1] != 'd') {
+    PyErr_Format(PyExc_TypeError, "%s must be a contiguous float64 array",
+		 name);
+    PyBuffer_Release(view);
+    return -1;
+  }
+  return 0;
+}
+
+static PyObject *compute_emd_batch(PyObject *self, PyObject *args,
+				   PyObject *keywds)
+{
+  static char *kwlist[] = {"weights1", "weights2", "cost", "n_threads",
+			   "normalize", NULL};
+
+  PyObject *weights1, *weights2, *cost, *result = NULL;
+  Py_buffer v1, v2, vc;
+  int n_threads = 1, normalize = 1;
+  int n_pairs, n1, n2, t, failed = 0;
+  double *out = NULL;
+  batch_t *batches = NULL;
+  pthread_t *threads = NULL;
+
+  if(!PyArg_ParseTupleAndKeywords(args, keywds, "OOO|ii", kwlist,
+				  &weights1, &weights2, &cost, &n_threads,
+				  &normalize))
+    return NULL;
+
+  if(get_double_buffer(weights1, &v1, "weights1") < 0)
+    return NULL;
+  if(get_double_buffer(weights2, &v2, "weights2") < 0) {
+    PyBuffer_Release(&v1);
+    return NULL;
+  }
+  if(get_double_buffer(cost, &vc, "cost") < 0) {
+    PyBuffer_Release(&v1);
+    PyBuffer_Release(&v2);
+    return NULL;
+  }
+
+  if(v1.ndim != 2 || v2.ndim != 2 || v1.shape[0] != v2.shape[0]) {
+    PyErr_SetString(PyExc_ValueError, "weights1 and weights2 must be 2D, "
+		    "with one row for each pair of signatures");
+    goto done;
+  }
+  n_pairs = v1.shape[0];
+  n1 = v1.shape[1];
+  n2 = v2.shape[1];
+  if(vc.len != (Py_ssize_t)n1 * n2 * sizeof(double)) {
+    PyErr_SetString(PyExc_ValueError, "cost must have n1 times n2 elements");
+    goto done;
+  }
+  if(n1 > MAX_SIG_SIZE || n2 > MAX_SIG_SIZE) {
+    PyErr_Format(PyExc_ValueError, "Signature size is limited to %d",
+		 MAX_SIG_SIZE);
+    goto done;
+  }
+  if(n_threads < 1)
+    n_threads = 1;
+  if(n_threads > n_pairs)
+    n_threads = n_pairs > 0 ? n_pairs : 1;
+
+  out = malloc((n_pairs + 1) * sizeof(double));
+  batches = malloc(n_threads * sizeof(batch_t));
+  threads = malloc(n_threads * sizeof(pthread_t));
+  if(out == NULL || batches == NULL || threads == NULL) {
+    PyErr_NoMemory();
+    goto done;
+  }
+
+  for(t = 0; t < n_threads; t ++) {
+    batches[t].w1 = v1.buf;
+    batches[t].w2 = v2.buf;
+    batches[t].cost = vc.buf;
+    batches[t].n_pairs = n_pairs;
+    batches[t].n1 = n1;
+    batches[t].n2 = n2;
+    batches[t].normalize = normalize;
+    batches[t].thread = t;
+    batches[t].n_threads = n_threads;
+    batches[t].out = out;
+    batches[t].failed = 0;
+    batches[t].started = 0;
+  }
+
+  Py_BEGIN_ALLOW_THREADS
+  if(n_threads == 1)
+    emd_batch_worker(&batches[0]);
+  else {
+    for(t = 0; t < n_threads; t ++)
+      if(pthread_create(&threads[t], NULL, emd_batch_worker, &batches[t]))
+	/* Could not start a thread, do its share here: */
+	emd_batch_worker(&batches[t]);
+      else
+	batches[t].started = 1;
+    for(t = 0; t < n_threads; t ++)
+      if(batches[t].started)
+	pthread_join(threads[t], NULL);
+  }
+  Py_END_ALLOW_THREADS
+
+  for(t = 0; t < n_threads; t ++)
+    failed |= batches[t].failed;
+  if(failed) {
+    PyErr_NoMemory();
+    goto done;
+  }
+
+  result = PyList_New(n_pairs);
+  if(result == NULL)
+    goto done;
+  for(t = 0; t < n_pairs; t ++)
+    PyList_SET_ITEM(result, t, PyFloat_FromDouble(out[t]));
+
+ done:
+  free(out);
+  free(batches);
+  free(threads);
+  PyBuffer_Release(&v1);
+  PyBuffer_Release(&v2);
+  PyBuffer_Release(&vc);
+  return result;
+}
+
 static PyMethodDef functions[] = {
     {"emd", (PyCFunction)compute_emd, METH_VARARGS | METH_KEYWORDS,
      "Compute the Earth Mover's Distance.\n\nParameters\n----------\nw1 : list (length n) \n\t The first set of weights \nw2 : list (length m)\n\tSecond set of weights\ndist : list (length n times m)\n\tAny distance metric between item i in w1 and item j in w2.\n"},
+    {"emd_batch", (PyCFunction)compute_emd_batch,
+     METH_VARARGS | METH_KEYWORDS,
+     "Compute the Earth Mover's Distance between many pairs of signatures\nwith the same ground distances.\n\nParameters\n----------\nweights1 : float64 array (n_pairs, n)\n\tThe first set of weights in each pair\nweights2 : float64 array (n_pairs, m)\n\tThe second set of weights in each pair\ncost : float64 array (n, m)\n\tThe distance between item i in weights1 and item j in weights2.\nn_threads : int\n\tNumber of threads to use (default: 1). The GIL is released\n\twhile computing.\nnormalize : bool\n\tWhether to normalize the weights in each signature to sum to 1\n\t(default: True).\n\nReturns\n-------\nA list with the EMD of each pair. Only positive weights are used, and\nthe EMD is nan for pairs in which one of the signatures has none.\n"},
     {NULL, NULL, 0, NULL}
 };
 
@@ -4,13 +4,57 @@ This module implements representations of DWI-derived fibers and fiber groups.
 # Import from 3rd party: 
 import numpy as np
 import scipy.stats as stats
-import scipy.linalg as la
+import scipy.spatial as spatial
 
 # Import locally: 
 import osmosis.descriptors as desc
-import osmosis.tensor as ozt
 import osmosis.utils as ozu
 
+
+def _node_directions(grad):
+    """
+    Helper function to get the unit direction of the gradient at each node,
+    as an (n_nodes, 3) array. Where the gradient is 0, the direction is taken
+    to be the x axis.
+    """
+    grad = np.reshape(np.asarray(grad, dtype=float), (3, -1)).T
+    norm = np.sqrt(np.sum(grad ** 2, -1))
+    directions = np.zeros(grad.shape)
+    directions[:, 0] = 1
+    nz = norm > 0
+    directions[nz] = grad[nz] / norm[nz][:, np.newaxis]
+    return directions
+
+
+def _node_tensors(directions, axial_diffusivity, radial_diffusivity):
+    """
+    Helper function to get the (n_nodes, 9) Q forms of the tensors with the
+    given principal directions: Q = RD * I + (AD - RD) * g g^T
+    """
+    outer = np.einsum('ni,nj->nij', directions, directions)
+    return (radial_diffusivity * np.eye(3).ravel() +
+            (axial_diffusivity - radial_diffusivity) *
+            outer.reshape(-1, 9))
+
+
+def _node_signal(directions, bvecs, bvals, axial_diffusivity,
+                 radial_diffusivity):
+    """
+    Helper function to get the (n_nodes, n_bvecs) relative signal predicted
+    by the tensors with the given principal directions.
+
+    The ADC of each tensor is $\vec{b} Q \vec{b}^T$, which in closed form
+    is $RD |\vec{b}|^2 + (AD - RD) (\vec{g} \cdot \vec{b})^2$
+    """
+    bvecs = np.reshape(np.asarray(bvecs, dtype=float), (3, -1))
+    bvals = np.asarray(bvals, dtype=float)
+    ADC = (radial_diffusivity * np.sum(bvecs ** 2, 0) +
+           (axial_diffusivity - radial_diffusivity) *
+           np.dot(directions, bvecs) ** 2)
+    # Stejskal/Tanner with S0 = 1:
+    return np.exp(-bvals * ADC)
+
+
 class Fiber(desc.ResetMixin):
     """
     This represents a single fiber, its node coordinates and statistics
@@ -126,7 +170,7 @@ class Fiber(desc.ResetMixin):
             self.affine = affine.getI()
         # Generate a new fiber and return it:
         else: 
-            return Fiber(self.coords,
+            return Fiber(xyz_new,
                          affine.getI(),
                          self.fiber_stats,
                          self.node_stats)
@@ -178,21 +222,11 @@ class Fiber(desc.ResetMixin):
         may be based on a biophysical model of some kind.
         """
         
-        d_matrix = np.matrix(np.diag([axial_diffusivity,
-                                      radial_diffusivity,
-                                      radial_diffusivity]))
-
-        grad = self.gradients
-        
-        # Preallocate:
-        tensors = np.empty((grad.shape[-1], 9)) #dtype='object')
-
-        for grad_idx, this_grad in enumerate(grad.T):
-            usv = la.svd(np.matrix(this_grad), overwrite_a=True)
-            this_Q = (np.matrix(usv[2]) * d_matrix * np.matrix(usv[2]))
-            tensors[grad_idx]= this_Q.ravel()#ozt.Tensor(this_Q, bvecs, bvals)
-
-        return tensors
+        # The tensor at each node has its principal diffusion direction along
+        # the gradient of the fiber at that node:
+        return _node_tensors(_node_directions(self.gradients),
+                             axial_diffusivity,
+                             radial_diffusivity)
 
     def predicted_signal(self,
                          bvecs,
@@ -221,19 +255,14 @@ class Fiber(desc.ResetMixin):
         Parameters
         ----------
         """
-        # Gotta have those tensors: 
-        tens = self.tensors(axial_diffusivity,
+        # The ADC is calculated from the direction of each node's tensor,
+        # instead of from the full Q form:
+        return _node_signal(_node_directions(self.gradients),
+                            bvecs,
+                            bvals,
+                            axial_diffusivity,
                             radial_diffusivity)
 
-        # Preallocate: 
-        sig = np.empty((tens.shape[0], len(bvals)))
-        for t_idx, ten in enumerate(tens): 
-            ADC = ozt.apparent_diffusion_coef(bvecs, ten.reshape((3,3)))
-            # Call S/T with the ADC as input:
-            sig[t_idx] = ozt.stejskal_tanner(1, bvals, ADC) 
-
-        return sig 
-
 class FiberGroup(desc.ResetMixin):
     """
     This represents a group of fibers.
@@ -339,29 +368,29 @@ class FiberGroup(desc.ResetMixin):
         else:
             in_affine = True
             
-        if not inplace:
-            fibs = np.copy(self.fibers) # Make a copy, to be able to do this not
-                                        # inplace
-        else:
-            fibs = self.fibers # Otherwise, save memory by pointing to the same
-                               # objects in memory
-            
-        for this_f in fibs:
+        # When not inplace, each fiber is transformed into a new Fiber, so
+        # that the original fibers are not mutated:
+        fibs = []
+        for this_f in self.fibers:
             # This one takes the highest precedence: 
             if in_affine:
-                this_f.xform(np.matrix(affine))
+                new_f = this_f.xform(np.matrix(affine), inplace=inplace)
 
             # Otherwise, the fiber affines take precedence: 
             elif this_f.affine is not None:
-                this_f.xform()
+                new_f = this_f.xform(inplace=inplace)
                 affine = None # The resulting object should not have an
                               # affine.
                 
             # And finally resort to the FG's affine:
             else:
-                this_f.xform(self.affine)
+                new_f = this_f.xform(self.affine, inplace=inplace)
                 affine = self.affine # Invert the objects affine,
                                         # before assigning to the output
+            if inplace:
+                fibs.append(this_f)
+            else:
+                fibs.append(new_f)
 
         if affine is not None:
             affine = np.matrix(affine).getI()
@@ -369,6 +398,8 @@ class FiberGroup(desc.ResetMixin):
         if inplace:
             self.fibers = fibs
             self.affine = affine
+            # Forget about anything that was computed from the old coords:
+            self.reset()
             self.coords = self._get_coords()
             
         # If we asked to do things inplace, we are done. Otherwise, we return a
@@ -414,6 +445,676 @@ class FiberGroup(desc.ResetMixin):
         The unique spatial coordinates of all the fibers in the FiberGroup.
 
         """
-        return ozu.unique_rows(self.coords.T).T 
+        return ozu.unique_rows(self.coords.T).T
+
+    @desc.auto_attr
+    def node_index(self):
+        """
+        A spatial index of the nodes of all the fibers (see NodeIndex)
+        """
+        lengths = [f.n_nodes for f in self.fibers]
+        return NodeIndex(self.coords,
+                         np.concatenate([[0], np.cumsum(lengths)]))
+
+
+class CompactFiberGroup(desc.ResetMixin):
+    """
+    A group of fibers, with the coordinates of all the nodes in one array and
+    the stats in one array per stat.
+
+    This holds the same information as a FiberGroup, with much less memory
+    and time spent on each fiber, so that large tractograms can be handled as
+    a whole. The fibers have no affines of their own, only the group has one.
+    """
+    def __init__(self,
+                 coords,
+                 offsets,
+                 fiber_stats=None,
+                 node_stats=None,
+                 name=None,
+                 color=None,
+                 thickness=None,
+                 affine=None
+                 ):
+        """
+        Initialize a compact group of fibers
+
+        Parameters
+        ----------
+        coords: np.array of shape 3 x n_nodes
+            The x,y,z coordinates of the nodes of all the fibers, one fiber
+            after the other.
+
+        offsets: np.array of n_fibers + 1 ints
+            The nodes of fiber k are coords[:, offsets[k]:offsets[k+1]]
+
+        fiber_stats: dict
+            Each per-fiber statistic, as an array with one value per fiber
+
+        node_stats: dict
+            Each per-node statistic, as an array with one value per node
+
+        name, color, thickness, affine: see FiberGroup
+        """
+        coords = np.asarray(coords)
+        if len(coords.shape) != 2 or coords.shape[0] != 3:
+            e_s = "coords input has shape ("
+            e_s += ''.join(["%s, "%n for n in coords.shape])
+            e_s += "); please reshape to be 3 by n"
+            raise ValueError(e_s)
+        offsets = np.asarray(offsets, dtype=int)
+        if offsets[0] != 0 or offsets[-1] != coords.shape[-1]:
+            e_s = "offsets should go from 0 to the number of nodes (%s)"%(
+                coords.shape[-1])
+            raise ValueError(e_s)
+
+        self.coords = coords
+        self.offsets = offsets
+        self.n_fibers = len(offsets) - 1
+        self.n_nodes = coords.shape[-1]
+
+        if fiber_stats is None:
+            fiber_stats = {}
+        self.fiber_stats = dict([(k, np.asarray(v)) for k, v in
+                                 fiber_stats.items()])
+        if node_stats is None:
+            node_stats = {}
+        self.node_stats = dict([(k, np.asarray(v)) for k, v in
+                                node_stats.items()])
+
+        if name is None:
+            name = "FG-1"
+        self.name = name
+
+        if color is None:
+            color = [200, 200, 100] # RGB
+        self.color = np.asarray(color)
+
+        if thickness is None:
+            thickness = -0.5
+        self.thickness = thickness
+
+        if affine is not None:
+            self.affine = np.matrix(affine)
+        else:
+            self.affine = None
+
+    def __len__(self):
+        return self.n_fibers
+
+    def __getitem__(self, i):
+        """
+        The i'th fiber, as a Fiber with views into the arrays of the group.
+        """
+        if i < 0:
+            i = i + self.n_fibers
+        if i < 0 or i >= self.n_fibers:
+            raise IndexError("Fiber index out of range")
+        low, high = self.offsets[i], self.offsets[i + 1]
+        return Fiber(self.coords[:, low:high],
+                     fiber_stats=dict([(k, v[i]) for k, v in
+                                       self.fiber_stats.items()]),
+                     node_stats=dict([(k, v[low:high]) for k, v in
+                                      self.node_stats.items()]))
+
+    def __iter__(self):
+        for i in xrange(self.n_fibers):
+            yield self[i]
+
+    @property
+    def fibers(self):
+        """
+        All the fibers, as Fiber objects with views into the arrays of the
+        group. These are made every time they are asked for, so iterating over
+        the group is cheaper, when all of them are not needed at once.
+        """
+        return list(self)
+
+    @property
+    def fiber_lengths(self):
+        """
+        The number of nodes in each fiber
+        """
+        return np.diff(self.offsets)
+
+    @property
+    def fiber_index(self):
+        """
+        The fiber that each node belongs to
+        """
+        return np.repeat(np.arange(self.n_fibers), self.fiber_lengths)
+
+    def xform(self, affine=None, inplace=True):
+        """
+        Transform the coordinates of all the fibers according to an affine
+
+        Precedence order : input > FiberGroup.affine
+
+        Parameters
+        ----------
+        affine: 4 by 4 array/matrix
+            An affine to apply instead of the affine of the group.
+
+        inplace: Whether to change the group inplace. Otherwise, a new group
+            is returned (sharing the stats with this one).
+
+        Note
+        ----
+        As with FiberGroup, the group gets the inverse of the affine that was
+        applied, so that calling xform() twice gives you back what you had in
+        the first place.
+        """
+        if affine is None:
+            affine = self.affine
+
+        if affine is None:
+            coords = self.coords
+        else:
+            affine = np.matrix(affine)
+            # Keep the shape, also for a single node:
+            coords = np.reshape(ozu.xform(self.coords, affine), (3, -1))
+            affine = affine.getI()
+
+        if inplace:
+            self.coords = coords
+            self.affine = affine
+            # Forget about anything that was computed from the old coords:
+            self.reset()
+        else:
+            return CompactFiberGroup(coords,
+                                     self.offsets,
+                                     fiber_stats=self.fiber_stats,
+                                     node_stats=self.node_stats,
+                                     name=self.name,
+                                     color=self.color,
+                                     thickness=self.thickness,
+                                     affine=affine)
+
+    @desc.auto_attr
+    def unique_coords(self):
+        """
+        The unique spatial coordinates of all the fibers in the group.
+        """
+        return ozu.unique_rows(self.coords.T).T
+
+    @desc.auto_attr
+    def node_index(self):
+        """
+        A spatial index of the nodes of all the fibers (see NodeIndex)
+        """
+        return NodeIndex(self.coords, self.offsets)
+
+    @desc.auto_attr
+    def gradients(self):
+        """
+        The gradients along the fibers, at all the nodes of all the fibers.
+
+        As in Fiber.gradients, these are central differences in the inner
+        nodes of each fiber and one-sided differences at its ends (fibers
+        with only one node have a gradient of 0).
+        """
+        grad = np.zeros(self.coords.shape)
+        if self.n_nodes < 2:
+            return grad
+        diff = np.diff(self.coords, axis=-1)
+        # The differences to the next and to the previous node:
+        fwd = np.zeros(grad.shape)
+        fwd[:, :-1] = diff
+        bwd = np.zeros(grad.shape)
+        bwd[:, 1:] = diff
+        grad = (fwd + bwd) / 2.0
+        first = self.offsets[:-1]
+        last = self.offsets[1:] - 1
+        grad[:, first] = fwd[:, first]
+        grad[:, last] = bwd[:, last]
+        grad[:, first[first == last]] = 0
+        return grad
+
+    def tensors(self, axial_diffusivity, radial_diffusivity):
+        """
+        The tensors at all the nodes of all the fibers, as an (n_nodes, 9)
+        array of Q forms (see Fiber.tensors)
+        """
+        return _node_tensors(_node_directions(self.gradients),
+                             axial_diffusivity,
+                             radial_diffusivity)
+
+    def predicted_signal(self,
+                         bvecs,
+                         bvals,
+                         axial_diffusivity,
+                         radial_diffusivity):
+        """
+        The relative signal predicted at all the nodes of all the fibers, as
+        an (n_nodes, n_bvecs) array (see Fiber.predicted_signal)
+        """
+        return _node_signal(_node_directions(self.gradients),
+                            bvecs,
+                            bvals,
+                            axial_diffusivity,
+                            radial_diffusivity)
+
+    def to_fiber_group(self):
+        """
+        A FiberGroup with one Fiber object for each fiber in this group
+        """
+        return FiberGroup(self.fibers,
+                          name=self.name,
+                          color=self.color,
+                          thickness=self.thickness,
+                          affine=self.affine)
+
+
+def compact_fiber_group(fg):
+    """
+    Make a CompactFiberGroup with the fibers of a FiberGroup
+
+    Parameters
+    ----------
+    fg: FiberGroup class instance
+
+    Returns
+    -------
+    CompactFiberGroup class instance
+
+    Note
+    ----
+    The fibers' own affines are not kept, only the affine of the group. Stats
+    that are missing in some of the fibers are nan in those fibers.
+    """
+    lengths = [f.n_nodes for f in fg.fibers]
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(int)
+    coords = np.hstack([np.reshape(f.coords, (3, -1)) for f in fg.fibers])
+    fiber_stats = dict([(k, np.array(v, dtype=float).ravel()) for k, v in
+                        fg.fiber_stats.items()])
+
+    node_stats = {}
+    node_keys = set()
+    for f in fg.fibers:
+        node_keys.update(f.node_stats.keys())
+    for k in node_keys:
+        node_stats[k] = np.hstack([np.ravel(f.node_stats[k])
+                                   if k in f.node_stats else
+                                   ozu.nans(f.n_nodes) for f in fg.fibers])
+
+    return CompactFiberGroup(coords, offsets, fiber_stats=fiber_stats,
+                             node_stats=node_stats, name=fg.name,
+                             color=fg.color, thickness=fg.thickness,
+                             affine=fg.affine)
+
+
+def fiber_batches(fg, batch_size=None):
+    """
+    Iterate over the fibers of a group, a batch of fibers at a time
+
+    Parameters
+    ----------
+    fg: FiberGroup or CompactFiberGroup class instance
+
+    batch_size: int, optional
+        The number of fibers in each batch. Defaults to all the fibers in one
+        batch.
+
+    Returns
+    -------
+    A generator of CompactFiberGroup class instances. For a
+    CompactFiberGroup, the batches hold views into the arrays of the group,
+    so that only the fibers of one batch are read at a time (e.g. from a
+    memory-mapped file). For a FiberGroup, each batch is compacted on its own.
+    """
+    n_fibers = len(fg.fibers) if isinstance(fg, FiberGroup) else len(fg)
+    if batch_size is None:
+        batch_size = max(n_fibers, 1)
+
+    for start in xrange(0, n_fibers, batch_size):
+        stop = min(start + batch_size, n_fibers)
+        if isinstance(fg, FiberGroup):
+            yield compact_fiber_group(FiberGroup(fg.fibers[start:stop],
+                                                 name=fg.name,
+                                                 color=fg.color,
+                                                 thickness=fg.thickness,
+                                                 affine=fg.affine))
+        else:
+            low, high = fg.offsets[start], fg.offsets[stop]
+            yield CompactFiberGroup(fg.coords[:, low:high],
+                                    fg.offsets[start:stop + 1] - low,
+                                    fiber_stats=dict([(k, v[start:stop]) for
+                                              k, v in fg.fiber_stats.items()]),
+                                    node_stats=dict([(k, v[low:high]) for
+                                              k, v in fg.node_stats.items()]),
+                                    name=fg.name,
+                                    color=fg.color,
+                                    thickness=fg.thickness,
+                                    affine=fg.affine)
+
+
+class NodeIndex(desc.ResetMixin):
+    """
+    A spatial index of the nodes of a group of fibers.
+
+    The nodes are hashed by the voxel they are in (the integer part of their
+    coordinates, as in BaseFiber.fg_idx), so that the nodes and fibers in a
+    set of voxels are found with a binary search over the voxels, instead of
+    a scan over all the nodes. Queries for the nearest nodes use a KD-tree
+    over the node coordinates, which is built the first time it is needed.
+    """
+    def __init__(self, coords, offsets):
+        """
+        Parameters
+        ----------
+        coords: array of shape (3, n_nodes)
+            The coordinates of the nodes of all the fibers, one fiber after
+            the other (as in FiberGroup.coords)
+
+        offsets: array of n_fibers + 1 ints
+            The nodes of fiber k are coords[:, offsets[k]:offsets[k+1]]
+        """
+        self.coords = np.reshape(np.asarray(coords, dtype=float), (3, -1))
+        self.offsets = np.asarray(offsets, dtype=int)
+        self.n_fibers = len(self.offsets) - 1
+        self.n_nodes = self.coords.shape[-1]
+        self.fiber_index = np.repeat(np.arange(self.n_fibers),
+                                     np.diff(self.offsets))
+
+        vox = self.coords.astype(int)
+        if self.n_nodes:
+            self._vox_min = np.min(vox, -1)
+            self._vox_shape = np.max(vox, -1) - self._vox_min + 1
+        else:
+            self._vox_min = np.zeros(3, dtype=int)
+            self._vox_shape = np.zeros(3, dtype=int)
+
+        keys, first, inverse = np.unique(self._keys(vox), return_index=True,
+                                         return_inverse=True)
+        # The voxels are numbered in the order in which they first appear in
+        # the nodes (as in ozu.unique_rows):
+        order = np.argsort(first, kind='mergesort')
+        rank = np.empty(len(order), dtype=int)
+        rank[order] = np.arange(len(order))
+
+        # The unique voxels, with shape (3, n_voxels):
+        self.voxels = vox[:, first[order]]
+        # The serial number of the voxel of each node:
+        self.node_voxel = rank[inverse]
+        self.n_voxels = self.voxels.shape[-1]
+
+        # For the look-ups, the sorted keys and their voxel numbers:
+        self._sorted_keys = keys
+        self._key_voxel = rank
+        # And the nodes in each voxel:
+        self._voxel_nodes = np.argsort(self.node_voxel, kind='mergesort')
+        self._voxel_ptr = np.concatenate([[0],
+                        np.cumsum(np.bincount(self.node_voxel,
+                                              minlength=self.n_voxels))])
+
+    def _keys(self, vox):
+        """
+        A single int64 key for each voxel in (3, n) vox (-1 for voxels
+        outside of the bounding box of the nodes)
+        """
+        vox = np.reshape(np.asarray(vox, dtype=np.int64), (3, -1))
+        rel = vox - self._vox_min[:, np.newaxis]
+        inside = np.all((rel >= 0) &
+                        (rel < self._vox_shape[:, np.newaxis]), 0)
+        keys = ((rel[0] * self._vox_shape[1] + rel[1]) * self._vox_shape[2] +
+                rel[2])
+        keys[~inside] = -1
+        return keys
+
+    def voxel_ids(self, vox):
+        """
+        The serial number (in self.voxels) of each voxel in (3, n) vox, or -1
+        for voxels with no nodes in them
+        """
+        keys = self._keys(vox)
+        if not self.n_voxels:
+            return -np.ones(len(keys), dtype=int)
+        pos = np.clip(np.searchsorted(self._sorted_keys, keys), 0,
+                      self.n_voxels - 1)
+        found = (self._sorted_keys[pos] == keys) & (keys >= 0)
+        return np.where(found, self._key_voxel[pos], -1)
+
+    def nodes_in_voxels(self, vox):
+        """
+        The indices of all the nodes in any of the voxels in (3, n) vox
+        """
+        ids = self.voxel_ids(vox)
+        ids = np.unique(ids[ids >= 0])
+        if not len(ids):
+            return np.zeros(0, dtype=int)
+        return np.sort(np.concatenate([
+            self._voxel_nodes[self._voxel_ptr[i]:self._voxel_ptr[i + 1]]
+            for i in ids]))
+
+    def fibers_in_voxels(self, vox):
+        """
+        The indices of the fibers that pass through any of the voxels in
+        (3, n) vox
+        """
+        return np.unique(self.fiber_index[self.nodes_in_voxels(vox)])
+
+    def fibers_in_roi(self, roi):
+        """
+        The indices of the fibers that pass through an ROI
+
+        Parameters
+        ----------
+        roi: 3-d boolean array
+            A mask in the same (voxel) coordinates as the fibers
+        """
+        return self.fibers_in_voxels(np.array(np.where(roi)))
+
+    @desc.auto_attr
+    def kdtree(self):
+        """
+        A KD-tree over the coordinates of the nodes
+        """
+        return spatial.cKDTree(self.coords.T)
+
+    def nearest_node(self, points, tol=np.inf):
+        """
+        The node nearest to each of a set of points
+
+        Parameters
+        ----------
+        points: array of shape (3, n) or (3,)
+
+        tol: float
+            Only nodes closer than this are considered
+
+        Returns
+        -------
+        dist: the distance to the nearest node (inf if there is none)
+        node: the index of the nearest node (-1 if there is none)
+        fiber: the fiber of the nearest node (-1 if there is none)
+        """
+        points = np.asarray(points, dtype=float)
+        dist, node = self.kdtree.query(np.reshape(points, (3, -1)).T,
+                                       distance_upper_bound=tol)
+        found = np.isfinite(dist)
+        node = np.where(found, node, -1)
+        fiber = np.where(found, self.fiber_index[np.minimum(node,
+                                                    self.n_nodes - 1)], -1)
+        if len(points.shape) == 1:
+            return dist[0], node[0], fiber[0]
+        return dist, node, fiber
+
+    def fibers_near(self, point, radius):
+        """
+        The indices of the fibers with a node within radius of a point
+        """
+        nodes = self.kdtree.query_ball_point(np.ravel(point), radius)
+        return np.unique(self.fiber_index[np.asarray(nodes, dtype=int)])
+
+
+# The node stat with the number of original nodes each node stands for, after
+# compress_fibers:
+NODE_WEIGHT = 'node_weight'
+
+
+def _as_compact(fg):
+    """
+    Helper function to get a CompactFiberGroup, whatever the input
+    """
+    if isinstance(fg, CompactFiberGroup):
+        return fg
+    return compact_fiber_group(fg)
+
+
+def _like(cfg, fg):
+    """
+    Helper function to return the result in the same kind of group as the
+    input
+    """
+    if isinstance(fg, CompactFiberGroup):
+        return cfg
+    return cfg.to_fiber_group()
+
+
+def compress_fibers(fg):
+    """
+    Compress the fibers, keeping one node for every stretch of consecutive
+    nodes of a fiber in the same voxel
+
+    Parameters
+    ----------
+    fg: FiberGroup or CompactFiberGroup class instance
+
+    Returns
+    -------
+    A group of the same kind, with fewer nodes. Each new node is at the mean
+    position of the nodes it replaces (which is in the same voxel), so the
+    fibers pass through exactly the same voxels, in the same order. Node stats
+    are averaged over the nodes that are replaced, and the node stat
+    NODE_WEIGHT holds the number of original nodes each node stands for
+    (FiberModel uses it to weight the signal of each node).
+
+    Note
+    ----
+    This is done for all the nodes of the group at once.
+
+    The direction of a fiber at each new node is the direction between its
+    neighbors, a voxel or so away, rather than the directions at the nodes
+    it replaces. For straight fibers these are the same, and FiberModel
+    gives the same matrix for the compressed fibers. Where fibers curve
+    inside a voxel, the predicted signal is only an approximation, which
+    gets worse as the radius of curvature gets smaller (a few percent of
+    the matrix for a radius of 4 voxels).
+    """
+    cfg = _as_compact(fg)
+    n_nodes = cfg.n_nodes
+    if not n_nodes:
+        return fg
+    vox = cfg.coords.astype(int)
+    fiber_index = cfg.fiber_index
+
+    # A new stretch starts at the beginning of each fiber and wherever the
+    # voxel changes:
+    start = np.ones(n_nodes, dtype=bool)
+    start[1:] = (np.any(vox[:, 1:] != vox[:, :-1], 0) |
+                 (fiber_index[1:] != fiber_index[:-1]))
+    stretch = np.cumsum(start) - 1
+    n_new = stretch[-1] + 1
+
+    weight = np.asarray(cfg.node_stats.get(NODE_WEIGHT, np.ones(n_nodes)),
+                        dtype=float)
+    new_weight = np.bincount(stretch, weights=weight, minlength=n_new)
+
+    def mean_over_stretch(x):
+        return np.bincount(stretch, weights=x * weight,
+                           minlength=n_new) / new_weight
+
+    coords = np.array([mean_over_stretch(c) for c in cfg.coords])
+    node_stats = dict([(k, mean_over_stretch(np.asarray(v, dtype=float)))
+                       for k, v in cfg.node_stats.items()])
+    node_stats[NODE_WEIGHT] = new_weight
+    lengths = np.bincount(fiber_index[start], minlength=cfg.n_fibers)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+
+    return _like(CompactFiberGroup(coords, offsets,
+                                   fiber_stats=cfg.fiber_stats,
+                                   node_stats=node_stats,
+                                   name=cfg.name,
+                                   color=cfg.color,
+                                   thickness=cfg.thickness,
+                                   affine=cfg.affine), fg)
+
+
+def resample_fibers(fg, step_size):
+    """
+    Resample the fibers at (nearly) equal steps along their length
+
+    Parameters
+    ----------
+    fg: FiberGroup or CompactFiberGroup class instance
+
+    step_size: float
+        The largest distance between consecutive nodes. Each fiber is
+        resampled at the smallest number of equally spaced points (including
+        its two ends) that are no further apart than this.
+
+    Returns
+    -------
+    A group of the same kind. Node stats are linearly interpolated between
+    the original nodes. Fibers with only one node are left as they are.
+
+    Note
+    ----
+    This is done for all the nodes of the group at once.
+    """
+    cfg = _as_compact(fg)
+    if not cfg.n_nodes:
+        return fg
+    offsets = cfg.offsets
+    lengths = np.diff(offsets)
+    first = offsets[:-1]
+
+    # The distance along each fiber of each node:
+    seg = np.zeros(cfg.n_nodes)
+    seg[1:] = np.sqrt(np.sum(np.diff(cfg.coords, axis=-1) ** 2, 0))
+    seg[first] = 0
+    dist = np.cumsum(seg)
+    dist -= np.repeat(dist[first], lengths)
+    fiber_len = np.zeros(cfg.n_fibers)
+    fiber_len[lengths > 0] = dist[offsets[1:][lengths > 0] - 1]
+
+    # How many new nodes in each fiber:
+    new_lengths = np.where(lengths > 1,
+                           np.ceil(fiber_len / float(step_size)).astype(int)
+                           + 1, lengths)
+    new_lengths = np.where((lengths > 1) & (fiber_len == 0), 1, new_lengths)
+    new_fiber = np.repeat(np.arange(cfg.n_fibers), new_lengths)
+    new_offsets = np.concatenate([[0], np.cumsum(new_lengths)])
+    # The position of each new node along its fiber:
+    rank = np.arange(new_offsets[-1]) - np.repeat(new_offsets[:-1],
+                                                  new_lengths)
+    n_steps = np.maximum(new_lengths - 1, 1)[new_fiber]
+    new_dist = fiber_len[new_fiber] * rank / n_steps.astype(float)
+
+    # Find the segment each new node falls in, searching in the distance
+    # along all the fibers, one after the other:
+    start_dist = np.concatenate([[0], np.cumsum(fiber_len[:-1] + 1)])
+    all_dist = dist + np.repeat(start_dist, lengths)
+    idx = np.searchsorted(all_dist, new_dist + start_dist[new_fiber],
+                          side='right') - 1
+    low = first[new_fiber]
+    high = np.maximum(offsets[1:][new_fiber] - 2, low)
+    idx = np.clip(idx, low, high)
+    nxt = np.minimum(idx + 1, offsets[1:][new_fiber] - 1)
+    span = dist[nxt] - dist[idx]
+    frac = np.where(span > 0, (new_dist - dist[idx]) /
+                    np.where(span > 0, span, 1), 0)
 
+    def interp(x):
+        x = np.asarray(x, dtype=float)
+        return x[..., idx] * (1 - frac) + x[..., nxt] * frac
 
+    return _like(CompactFiberGroup(interp(cfg.coords), new_offsets,
+                                   fiber_stats=cfg.fiber_stats,
+                                   node_stats=dict([(k, interp(v)) for k, v
+                                                in cfg.node_stats.items()
+                                                if k != NODE_WEIGHT]),
+                                   name=cfg.name,
+                                   color=cfg.color,
+                                   thickness=cfg.thickness,
+                                   affine=cfg.affine), fg)
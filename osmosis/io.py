@@ -63,8 +63,10 @@ completely ignored.
 """
 
 # Import from standard lib:
-import struct
 import os
+import json
+import shutil
+import tempfile
 import inspect
 import warnings
 import urllib
@@ -92,391 +94,512 @@ osmosis_path =  os.path.split(oz.__file__)[0]
 
 data_path = osmosis_path + '/data/'
 
-# XXX The following functions are way too long. Break 'em up!
-def fg_from_pdb(file_name, verbose=True):
+# The stats header of a pdb file, for each stat:
+_stat_hdr_dtype = np.dtype([('luminance_encoding', '=i4'),
+                            ('computed_per_point', '=i4'),
+                            ('viewable', '=i4'),
+                            ('agg_name', 'S255'),
+                            ('local_name', 'S255'),
+                            # Integer reads are word aligned:
+                            ('pad', 'V2'),
+                            ('uid', '=i4')])
+
+def _read_array(buf, idx, count, dtype='=i4'):
     """
-    Read the definition of a fiber-group from a .pdb file
+    Helper function to read an array of count items from a buffer, starting
+    at byte idx, without copying it.
+
+    Returns
+    -------
+    out: array
+        The items
+    idx: int
+        The byte after the last item
+    """
+    dtype = np.dtype(dtype)
+    count = int(count)
+    out = np.frombuffer(buf, dtype=dtype, count=count, offset=int(idx))
+    return out, int(idx) + count * dtype.itemsize
+
+def read_pdb(file_name):
+    """
+    Read the contents of a .pdb file into flat arrays
+
+    The file is memory-mapped (copy-on-write) and all the arrays are read
+    straight out of it, using the offsets in the header, so that the nodes of
+    all the fibers are read at once.
+
     Parameters
     ----------
     file_name: str
        Full path to the .pdb file
+
     Returns
     -------
-    A FiberGroup object
+    pdb: dict with the following items:
+        xform: 4 by 4 array
+            The affine of the fibers
+        version: int
+            PDB version of the file (2 or 3)
+        stats_header: dict
+            The stats header, with a list of each of the fields of the header
+            (see the osmosis.io module top-level docstring)
+        coords: 2 dimensional array
+            The (3 by n_nodes) coordinates of the nodes of all the fibers
+        offsets: 1 dimensional array
+            The nodes of fiber k are coords[:, offsets[k]:offsets[k+1]]
+        fiber_stats: dict
+            Each per-fiber stat, as an array with one value for each fiber
+        node_stats: dict
+            Each per-point stat, as an array with one value for each node (in
+            the same order as coords)
 
     Note
     ----
-    This only reads Version 3 PDB. For the full file-format spec, see the
-    osmosis.io module top-level docstring
-
+    For the full file-format spec, see the osmosis.io module top-level
+    docstring
     """
-    # Read the file as binary info:
-    f_obj = file(file_name, 'r')
-    f_read = f_obj.read()
-    f_obj.close()
-    # This is an updatable index into this read:
+    buf = np.memmap(file_name, dtype=np.uint8, mode='c')
     idx = 0
 
     # First part is an int encoding the offset to the fiber part:
-    offset, idx = _unpacker(f_read, idx, 1)
+    offset, idx = _read_array(buf, idx, 1)
+    offset = int(offset[0])
 
     # Next bit are doubles, encoding the xform (4 by 4 = 16 of them):
-    xform, idx  = _unpacker(f_read, idx, 16, 'double')
+    xform, idx = _read_array(buf, idx, 16, '=f8')
     xform = np.reshape(xform, (4, 4))
 
     # Next is an int encoding the number of stats:
-    numstats, idx = _unpacker(f_read, idx, 1)
-
-    # The stats header is a dict with lists holding the stat per
-    stats_header = dict(luminance_encoding=[],  # int => bool
-                        computed_per_point=[],  # int => bool
-                        viewable=[],  # int => bool
-                        agg_name=[],  # char array => string
-                        local_name=[],  # char array => string
-                        uid=[]  # int
-        )
-
-    # Read the stats header:
-    counter = 0
-    while counter < numstats:
-        counter += 1
-        for k in ["luminance_encoding",
-                  "computed_per_point",
-                  "viewable"]:
-            this, idx = _unpacker(f_read, idx, 1)
-            stats_header[k].append(np.bool(this))
-
-        for k in ["agg_name", "local_name"]:
-            this, idx = _unpacker(f_read, idx, 255, 'char')
-            stats_header[k].append(_word_maker(this))
-        # Must have integer reads be word aligned (?):
-        idx += 2
-        this, idx = _unpacker(f_read, idx, 1)
-        stats_header["uid"].append(this)
+    numstats, idx = _read_array(buf, idx, 1)
+    numstats = int(numstats[0])
+
+    # The stats header holds a list of each field, with one item per stat:
+    hdr, idx = _read_array(buf, idx, numstats, _stat_hdr_dtype)
+    stats_header = dict(uid=[int(u) for u in hdr['uid']])
+    for k in ["luminance_encoding", "computed_per_point", "viewable"]:
+        stats_header[k] = [bool(this) for this in hdr[k]]
+    for k in ["agg_name", "local_name"]:
+        # The name ends with the first null character:
+        stats_header[k] = [this.split('\x00')[0] for this in hdr[k]]
+    per_point = stats_header["computed_per_point"]
+    names = stats_header["local_name"]
 
     # We skip the whole bit with the algorithms and go straight to the version
     # number, which is one int length before the fibers:
-    idx = offset - 4
-    version, idx = _unpacker(f_read, idx, 1)
-    if int(version) < 2:
+    version, idx = _read_array(buf, offset - 4, 1)
+    version = int(version[0])
+    if version < 2:
         raise ValueError("Can only read PDB version 2 or version 3 files")
-    elif verbose:
-        print("Loading a PDB version %s file from: %s"%(int(version), file_name))
-
-    if int(version) == 2:
+    if version == 2:
         idx = offset
 
     # How many fibers?
-    numpaths, idx = _unpacker(f_read, idx, 1)
+    numpaths, idx = _read_array(buf, idx, 1)
+    numpaths = int(numpaths[0])
 
-    if int(version) == 2:
+    if version == 2:
+        # Each fiber has a header of its own, so they are read one by one, but
+        # each one with only a few reads:
         pts = []
-        if verbose:
-                prog_bar = ProgressBar(numpaths[0])
-                f_name = inspect.stack()[0][3]
-
         f_stats = []
-        n_stats = []
+        n_stats = dict([(names[s], []) for s in range(numstats)
+                        if per_point[s]])
+        pts_per_fiber = np.zeros(numpaths, dtype=int)
         for p_idx in range(numpaths):
-            f_stats_dict = {}
-            n_stats_dict = {}
-
             # Keep track of where you are right now
             ppos = idx
-            path_offset, idx = _unpacker(f_read, idx, 1)
-            n_nodes, idx = _unpacker(f_read, idx, 1)
-            # As far as I can tell the following two don't matter much:
-            algo_type, idx = _unpacker(f_read, idx, 1)
-            seed_pt_idx, idx = _unpacker(f_read, idx, 1)
+            # The header size, the number of nodes and the two ints after
+            # them (algorithm type and seed point) don't matter much:
+            path_hdr, idx = _read_array(buf, idx, 4)
+            n_nodes = int(path_hdr[1])
+            pts_per_fiber[p_idx] = n_nodes
             # Read out the per-path stats:
-            for stat_idx in range(numstats):
-                per_fiber_stat, idx = _unpacker(f_read, idx, 1, 'double')
-                f_stats_dict[stats_header["local_name"][stat_idx]] = \
-                    per_fiber_stat
-            f_stats.append(f_stats_dict)
+            this_stats, idx = _read_array(buf, idx, numstats, '=f8')
+            f_stats.append(this_stats)
             # Skip forward to where the paths themselves are:
-            idx = ppos
+            idx = ppos + int(path_hdr[0])
             # Read the nodes:
-            pathways, idx = _unpacker(f_read, idx, n_nodes*3, 'double')
-
-            pts.append(np.reshape(pathways, (n_nodes, 3)).T)
+            pathways, idx = _read_array(buf, idx, n_nodes * 3, '=f8')
+            pts.append(np.reshape(pathways, (n_nodes, 3)))
             for stat_idx in range(numstats):
-                if stats_header["computed_per_point"][stat_idx]:
-                    name = stats_header["local_name"][stat_idx]
-                    n_stats_dict[name], idx = _unpacker(f_read, idx, n_nodes,
-                                                    'double')
-
-            n_stats.append(n_stats_dict)
+                if per_point[stat_idx]:
+                    this_stat, idx = _read_array(buf, idx, n_nodes, '=f8')
+                    n_stats[names[stat_idx]].append(this_stat)
 
-        fibers = []
-
-        # Initialize all the fibers:
-        for p_idx in range(numpaths):
-            this_fstats_dict = f_stats[p_idx]
-            f_stat_k = this_fstats_dict.keys()
-            f_stat_v = [this_fstats_dict[k] for k in f_stat_k]
-            this_nstats_dict = n_stats[p_idx]
-            n_stats_k = this_nstats_dict.keys()
-            n_stats_v = [this_nstats_dict[k] for k in n_stats_k]
-            fibers.append(ozf.Fiber(pts[p_idx],
-                                xform,
-                                fiber_stats=dict(zip(f_stat_k, f_stat_v)),
-                                node_stats=dict(zip(n_stats_k, n_stats_v))))
-
-
-    elif int(version) == 3:
+        if numpaths:
+            coords = np.concatenate(pts).T
+            f_stats = np.array(f_stats)
+        else:
+            coords = np.zeros((3, 0))
+            f_stats = np.zeros((0, numstats))
+        fiber_stats = dict([(names[s], f_stats[:, s]) for s in
+                            range(numstats)])
+        node_stats = dict([(k, np.concatenate(v) if len(v) else np.zeros(0))
+                           for k, v in n_stats.items()])
+
+    elif version == 3:
         # The next few bytes encode the number of points in each fiber:
-        pts_per_fiber, idx = _unpacker(f_read, idx, numpaths)
-        total_pts = np.sum(pts_per_fiber)
+        pts_per_fiber, idx = _read_array(buf, idx, numpaths)
+        total_pts = int(np.sum(pts_per_fiber))
         # Next we have the xyz coords of the nodes in all fibers:
-        fiber_pts, idx = _unpacker(f_read, idx, total_pts * 3, 'double')
+        fiber_pts, idx = _read_array(buf, idx, total_pts * 3, '=f8')
+        coords = np.reshape(fiber_pts, (total_pts, 3)).T
+
+        # Then, one value per fiber for each stat (the per-point stats also
+        # have their mean here):
+        all_f_stats, idx = _read_array(buf, idx, numstats * numpaths, '=f8')
+        all_f_stats = np.reshape(all_f_stats, (numstats, numpaths))
+        # This is a fiber-stat only if it's not computed per point:
+        fiber_stats = dict([(names[s], all_f_stats[s])
+                            for s in range(numstats) if not per_point[s]])
+
+        # And the per-point stats, one value for each node:
+        node_stats = {}
+        for stat_idx in range(numstats):
+            if per_point[stat_idx]:
+                node_stats[names[stat_idx]], idx = _read_array(buf, idx,
+                                                               total_pts,
+                                                               '=f8')
 
-        # We extract the information on a fiber-by-fiber basis
-        pts_read = 0
-        pts = []
+    offsets = np.concatenate([[0], np.cumsum(pts_per_fiber)]).astype(int)
+
+    return dict(xform=xform, version=version, stats_header=stats_header,
+                coords=coords, offsets=offsets, fiber_stats=fiber_stats,
+                node_stats=node_stats)
 
+def fg_from_pdb(file_name, verbose=True, compact=False):
+    """
+    Read the definition of a fiber-group from a .pdb file
+    Parameters
+    ----------
+    file_name: str
+       Full path to the .pdb file
+    compact: bool
+       Whether to return a CompactFiberGroup, which holds the arrays read from
+       the file as they are, instead of making a Fiber object for each fiber.
+    Returns
+    -------
+    A FiberGroup object (or a CompactFiberGroup object)
+
+    Note
+    ----
+    This reads PDB version 2 and version 3 files (see `read_pdb`). For the
+    full file-format spec, see the osmosis.io module top-level docstring.
+    The coordinates and stats of each fiber are views into the arrays read
+    from the file.
+
+    """
+    pdb = read_pdb(file_name)
+    if verbose:
+        print("Loading a PDB version %s file from: %s"%(pdb["version"],
+                                                       file_name))
+    xform = pdb["xform"]
+    coords = pdb["coords"]
+    offsets = pdb["offsets"]
+    fiber_stats = pdb["fiber_stats"]
+    node_stats = pdb["node_stats"]
+    name = os.path.split(file_name)[-1].split('.')[0]
+
+    if compact:
         if verbose:
-            prog_bar = ProgressBar(numpaths[0])
-            f_name = inspect.stack()[0][3]
-        for p_idx in range(numpaths):
-            n_nodes = pts_per_fiber[p_idx]
-            pts.append(np.reshape(
-                       fiber_pts[pts_read * 3:(pts_read + n_nodes) * 3],
-                       (n_nodes, 3)).T)
-            pts_read += n_nodes
-            if verbose:
-                prog_bar.animate(p_idx, f_name=f_name)
-
-        f_stats_dict = {}
-        for stat_idx in range(numstats):
-            per_fiber_stat, idx = _unpacker(f_read, idx, numpaths, 'double')
-            # This is a fiber-stat only if it's not computed per point:
-            if not stats_header["computed_per_point"][stat_idx]:
-                f_stats_dict[stats_header["local_name"][stat_idx]] =\
-                    per_fiber_stat
-
-        per_point_stat = []
-        n_stats_dict = {}
-        for stat_idx in range(numstats):
-            pts_read = 0
-            # If it is computer per point, it's a node-stat:
-            if stats_header["computed_per_point"][stat_idx]:
-                name = stats_header["local_name"][stat_idx]
-                n_stats_dict[name] = []
-                per_point_stat, idx = _unpacker(f_read, idx, total_pts, 'double')
-                for p_idx in range(numpaths):
-                    n_stats_dict[name].append(
-                        per_point_stat[pts_read:pts_read + pts_per_fiber[p_idx]])
-
-                    pts_read += pts_per_fiber[p_idx]
-            else:
-                per_point_stat.append([])
+            print("Done reading from file")
+        return ozf.CompactFiberGroup(coords, offsets, fiber_stats=fiber_stats,
+                                     node_stats=node_stats, name=name,
+                                     affine=xform)
 
-        fibers = []
-        # Initialize all the fibers:
-        for p_idx in range(numpaths):
-            f_stat_k = f_stats_dict.keys()
-            f_stat_v = [f_stats_dict[k][p_idx] for k in f_stat_k]
-            n_stats_k = n_stats_dict.keys()
-            n_stats_v = [n_stats_dict[k][p_idx] for k in n_stats_k]
-            fibers.append(ozf.Fiber(pts[p_idx],
-                                xform,
-                                fiber_stats=dict(zip(f_stat_k, f_stat_v)),
-                                node_stats=dict(zip(n_stats_k, n_stats_v))))
+    fibers = []
+    # Initialize all the fibers:
+    for p_idx in range(len(offsets) - 1):
+        low, high = offsets[p_idx], offsets[p_idx + 1]
+        fibers.append(ozf.Fiber(coords[:, low:high],
+                        xform,
+                        fiber_stats=dict([(k, v[p_idx]) for k, v in
+                                          fiber_stats.items()]),
+                        node_stats=dict([(k, v[low:high]) for k, v in
+                                         node_stats.items()])))
     if verbose:
         print("Done reading from file")
 
-    name = os.path.split(file_name)[-1].split('.')[0]
     return ozf.FiberGroup(fibers, name=name, affine=xform)
 
-# This one's a global used in both packing and unpacking the data
-
-_fmt_dict = {'int':['=i', 4],
-             'double':['=d', 8],
-             'char':['=c', 1],
-             'bool':['=?', 1],
-             #'uint':['=I', 4],
-                }
+def _char_list_maker(name):
+    """
+    Helper function that makes the name of a stat into the 255 characters of
+    the stats header: the name, followed by a null character and then 'g' for
+    the rest of the 255
+    """
+    return (name + '\x00').ljust(255, 'g')
 
-def pdb_from_fg(fg, file_name='fibers.pdb', verbose=True, affine=None):
+def _pdb_header(affine, fiber_stat_names, node_stat_names):
     """
-    Create a pdb file from a osmosis.fibers.FiberGroup class instance.
+    Helper function that makes the header of a (version 3) pdb file, up to
+    and including the version number.
 
     Parameters
     ----------
-    fg: a FiberGroup object
-
-    file_name: str
-       Full path to the pdb file to be saved.
+    affine: 4 by 4 array
+    fiber_stat_names, node_stat_names: lists
+        The names of the per-fiber and the per-point stats
 
+    Returns
+    -------
+    The header, as a string
     """
-
-    fwrite = file(file_name, 'w')
-
-    # The total number of stats are both node-stats and fiber-stats:
-    n_stats = len(fg[0].fiber_stats.keys()) + len(fg[0].node_stats.keys())
-    stats_hdr_sz = (4 * _fmt_dict['int'][1] + 2 * _fmt_dict['char'][1] * 255 + 2)
-
-
+    n_stats = len(fiber_stat_names) + len(node_stat_names)
     # This is the 'offset' to the beginning of the fiber-data. Note that we are
     # just skipping the whole algorithms thing, since that seems to be unused
     # in mrDiffusion anyway.
-    hdr_sz = (4 * _fmt_dict['int'][1] + # ints: hdr_sz itself, n_stats, n_algs
-                                        # (always 0), version
-             16 *_fmt_dict['double'][1] +      # doubles: the 4 by 4 affine
-             n_stats * stats_hdr_sz) # The stats part of the header, add
-                                        # one for good measure(?).
+    hdr_sz = (4 * 4 + # ints: hdr_sz itself, n_stats, n_algs (always 0),
+                      # version
+              16 * 8 + # doubles: the 4 by 4 affine
+              n_stats * _stat_hdr_dtype.itemsize) # The stats part
+
+    stats_hdr = np.zeros(n_stats, dtype=_stat_hdr_dtype)
+    stats_hdr['luminance_encoding'] = True  # currently unused
+    # Fiber stats come first, and then the per-point (node) stats:
+    stats_hdr['computed_per_point'][len(fiber_stat_names):] = True
+    stats_hdr['viewable'] = True  # currently unused
+    names = [_char_list_maker(n) for n in
+             list(fiber_stat_names) + list(node_stat_names)]
+    # The name goes in twice for some reason:
+    stats_hdr['agg_name'] = names
+    stats_hdr['local_name'] = names
+    stats_hdr['pad'] = np.void('gg')
+    # These might get reordered upon resaving on different platforms, because
+    # dict keys come in no particular order...
+    stats_hdr['uid'] = np.arange(n_stats)
+
+    return ''.join([np.array([hdr_sz, ], dtype='=i4').tostring(),
+                    np.asarray(affine, dtype='=f8').ravel().tostring(),
+                    np.array([n_stats], dtype='=i4').tostring(),
+                    stats_hdr.tostring(),
+                    # Number of algorithms - set to 0 always - and the PDB
+                    # file version:
+                    np.array([0, 3], dtype='=i4').tostring()])
+
+def _fiber_arrays(fibers, fiber_stat_names=None, node_stat_names=None):
+    """
+    Helper function that puts the data of a batch of fibers into flat arrays,
+    in the order in which they go into a pdb file.
 
+    Parameters
+    ----------
+    fibers: FiberGroup, CompactFiberGroup, list of Fiber objects, or dict
+        The dict has the coords, offsets, fiber_stats and node_stats items,
+        as in the output of `read_pdb`.
+    fiber_stat_names, node_stat_names: lists, optional
+        The stats to take from the fibers. Default: all the stats of the
+        first fiber.
 
-    _packer(fwrite, hdr_sz)
-    if affine is None:
-        if fg.affine is None:
-            affine = tuple(np.eye(4).ravel().squeeze())
-        else:
-            affine = tuple(np.array(fg.affine).ravel().squeeze())
+    Returns
+    -------
+    fiber_stat_names, node_stat_names: lists
+    pts_per_fiber: 1 dimensional array
+        Number of nodes in each fiber
+    coords: 2 dimensional array
+        The (n_nodes by 3) coordinates of all the nodes
+    fiber_stats: 2 dimensional array
+        The value of each per-fiber stat (rows) for each fiber (columns)
+    node_means: 2 dimensional array
+        The mean of each per-point stat (rows) in each fiber (columns)
+    node_stats: 2 dimensional array
+        The value of each per-point stat (rows) in each node (columns)
+    """
+    if isinstance(fibers, ozf.CompactFiberGroup):
+        fibers = dict(coords=fibers.coords, offsets=fibers.offsets,
+                      fiber_stats=fibers.fiber_stats,
+                      node_stats=fibers.node_stats)
+    if isinstance(fibers, dict):
+        if fiber_stat_names is None:
+            fiber_stat_names = fibers["fiber_stats"].keys()
+        if node_stat_names is None:
+            node_stat_names = fibers["node_stats"].keys()
+        pts_per_fiber = np.diff(fibers["offsets"])
+        coords = np.asarray(fibers["coords"]).T
+        fiber_stats = [fibers["fiber_stats"][k] for k in fiber_stat_names]
+        node_stats = [fibers["node_stats"][k] for k in node_stat_names]
+    else:
+        if isinstance(fibers, ozf.FiberGroup):
+            fibers = fibers.fibers
+        if fiber_stat_names is None:
+            fiber_stat_names = fibers[0].fiber_stats.keys()
+        if node_stat_names is None:
+            node_stat_names = fibers[0].node_stats.keys()
+        pts_per_fiber = np.array([f.n_nodes for f in fibers])
+        coords = np.hstack([np.reshape(f.coords, (3, -1)) for f in fibers]).T
+        fiber_stats = [[f.fiber_stats[k] for f in fibers]
+                       for k in fiber_stat_names]
+        node_stats = [np.hstack([np.ravel(f.node_stats[k]) for f in fibers])
+                      for k in node_stat_names]
+
+    n_fibers = len(pts_per_fiber)
+    fiber_stats = np.reshape(np.asarray(fiber_stats, dtype=float),
+                             (len(fiber_stat_names), n_fibers))
+    node_stats = np.reshape(np.asarray(node_stats, dtype=float),
+                            (len(node_stat_names), coords.shape[0]))
+    # The per-point stats also have their mean value in the per-fiber part:
+    starts = np.concatenate([[0], np.cumsum(pts_per_fiber)[:-1]])
+    if node_stats.shape[-1]:
+        node_means = np.add.reduceat(node_stats, starts, -1) / pts_per_fiber
     else:
-        affine = tuple(np.array(affine).ravel().squeeze())
+        node_means = np.zeros((len(node_stat_names), n_fibers))
 
-    _packer(fwrite, affine, 'double')
-    _packer(fwrite, n_stats)
+    return (list(fiber_stat_names), list(node_stat_names), pts_per_fiber,
+            coords, fiber_stats, node_means, node_stats)
 
+def _write_array(fwrite, arr, dtype='=f8'):
+    """
+    Helper function that writes an array to a file in one go
+    """
+    np.ascontiguousarray(arr, dtype=dtype).tofile(fwrite)
 
-    # We are going to assume that fibers are homogenous on the following
-    # properties. XXX Should we check that when making FiberGroup instances?
-    uid = 0
-    for f_stat in fg[0].fiber_stats:
-        _packer(fwrite, True)   # currently unused
-        _packer(fwrite, False)  # Is this per-point?
-        _packer(fwrite, True)   # currently unused
-        _stat_hdr_set(fwrite, f_stat, uid)
-        uid += 1  # We keep tracking that across fiber and node stats
+def _replace_file(tmp_name, file_name):
+    """
+    Helper function that moves a newly written file into place. Fibers read
+    from the old file (see `read_pdb`) are memory-mapped, so the old file is
+    replaced, rather than overwritten, to keep them intact.
+    """
+    if os.name == 'nt' and os.path.exists(file_name):
+        os.remove(file_name)
+    os.rename(tmp_name, file_name)
 
-    for n_stat in fg[0].node_stats:
-        # Three True bools for this one:
-        for x in range(3):
-            _packer(fwrite, True)
-        _stat_hdr_set(fwrite, n_stat, uid)
-        uid += 1
+def _get_affine(fg, affine):
+    if affine is None:
+        if getattr(fg, 'affine', None) is None:
+            return np.eye(4)
+        return np.array(fg.affine)
+    return np.array(affine)
 
-    _packer(fwrite, 0) # Number of algorithms - set to 0 always
+def pdb_from_fg(fg, file_name='fibers.pdb', verbose=True, affine=None):
+    """
+    Create a pdb file from a osmosis.fibers.FiberGroup class instance.
 
-    fwrite.seek(hdr_sz - _fmt_dict['int'][1])
+    Parameters
+    ----------
+    fg: a FiberGroup (or CompactFiberGroup) object
 
-    # This is the PDB file version:
-    _packer(fwrite, 3)
-    _packer(fwrite, fg.n_fibers)
+    file_name: str
+       Full path to the pdb file to be saved.
 
-    for fib in fg.fibers:
-        # How many coords in each fiber:
-        _packer(fwrite, fib.coords.shape[-1])
+    affine: 4 by 4 array, optional
+       The affine saved in the file. Default: the affine of the FiberGroup,
+       or np.eye(4) if it has none.
 
+    Note
+    ----
+    The header is built once, and each part of the fiber data is written to
+    file as one array (see also `pdb_from_batches`).
+    """
+    (f_names, n_names, pts_per_fiber, coords, fiber_stats, node_means,
+     node_stats) = _fiber_arrays(fg)
+
+    fwrite = open(file_name + '.tmp', 'wb')
+    fwrite.write(_pdb_header(_get_affine(fg, affine), f_names, n_names))
+    _write_array(fwrite, [len(pts_per_fiber)], '=i4')
+    # How many coords in each fiber:
+    _write_array(fwrite, pts_per_fiber, '=i4')
     # x,y,z coords in each fiber:
-    for fib in fg.fibers:
-        _packer(fwrite, fib.coords.T.ravel(), 'double')
-
-    for stat in fg[0].fiber_stats:
-        for fib in fg.fibers:
-            _packer(fwrite, fib.fiber_stats[stat],'double')
-
-    # The per-node stats have to be inserted in here as well, with their mean
-    # value:
-    for stat in fg[1].node_stats:
-        for fib in fg.fibers:
-            _packer(fwrite, np.mean(fib.node_stats[stat]), 'double')
-
-    for stat in fg[1].node_stats:
-        for fib in fg.fibers:
-            _packer(fwrite, fib.node_stats[stat], 'double')
-
-    if verbose:
-        "Done saving data in file%s"%file_name
-
+    _write_array(fwrite, coords)
+    # The per-fiber stats, followed by the per-node stats, with their mean
+    # value, and then the per-node stats themselves:
+    _write_array(fwrite, fiber_stats)
+    _write_array(fwrite, node_means)
+    _write_array(fwrite, node_stats)
     fwrite.close()
+    _replace_file(file_name + '.tmp', file_name)
 
-def _unpacker(file_read, idx, obj_to_read, fmt='int'):
+    if verbose:
+        print("Done saving data in file %s"%file_name)
 
+def pdb_from_batches(batches, file_name='fibers.pdb', affine=None,
+                     verbose=True):
     """
-    Helper function to unpack binary data from files with the struct library.
+    Create a pdb file from batches of fibers, without holding all of them in
+    memory.
 
-    Relies on http://docs.python.org/library/struct.html
+    The parts of each batch are appended to temporary files, one for each part
+    of the pdb file, as the batches come in. When all the batches are in, the
+    header is written and the temporary files are copied into the pdb file
+    after it.
 
     Parameters
     ----------
-    file_read: The output of file.read() from a file object
-    idx: An index into x
-    obj_to_read: How many objects to read
-    fmt: A format string, telling us what to read from there
-    """
-    # For each one, this is [fmt_string, size]
-
-    fmt_str = _fmt_dict[fmt][0]
-    fmt_sz = _fmt_dict[fmt][1]
-
-    out = np.array([struct.unpack(fmt_str,
-                    file_read[idx + fmt_sz * j:idx + fmt_sz + fmt_sz * j])[0]
-        for j in range(obj_to_read)])
-
-    idx += obj_to_read * fmt_sz
-    return out, idx
-
-def _packer(file_write, vals, fmt='int'):
-    """
-    Helper function to pack binary data to files, using the struct library:
-
-    Relies on http://docs.python.org/library/struct.html
-
-    """
-    fmt_str = _fmt_dict[fmt][0]
-    if np.iterable(vals):
-        for pack_this in vals:
-            s = struct.pack(fmt_str, pack_this)
-            file_write.write(s)
-
-    else:
-        s = struct.pack(fmt_str, vals)
-        file_write.write(s)
+    batches: iterable
+        Each batch is a FiberGroup, a CompactFiberGroup, a list of Fiber
+        objects, or a dict as in the output of `read_pdb`. All the batches
+        should have the stats of the first batch.
+    file_name: str
+       Full path to the pdb file to be saved.
+    affine: 4 by 4 array, optional
+       The affine saved in the file. Default: the affine of the first batch,
+       if it has one, and np.eye(4) otherwise.
 
-def _word_maker(arr):
-    """
-    Helper function Make a string out of pdb stats header "name" variables
+    Returns
+    -------
+    n_fibers: int
+        The number of fibers saved
     """
-    make_a_word = []
-    for this in arr:
-        if this: # The sign that you reached the end of the word is an empty
-                 # char
-            make_a_word.append(this)
-        else:
-            break
-    return ''.join(make_a_word)
+    f_names = None
+    n_names = None
+    n_fibers = 0
+    parts = None
+    for batch in batches:
+        (f_names, n_names, pts_per_fiber, coords, fiber_stats, node_means,
+         node_stats) = _fiber_arrays(batch, f_names, n_names)
+        if parts is None:
+            if affine is None:
+                affine = _get_affine(batch, None)
+                if isinstance(batch, dict) and 'xform' in batch:
+                    affine = batch['xform']
+            # counts, coords, each fiber stat, each node stat mean and each
+            # node stat:
+            parts = [tempfile.TemporaryFile() for ii in
+                     range(2 + len(f_names) + 2 * len(n_names))]
+        n_fibers += len(pts_per_fiber)
+        _write_array(parts[0], pts_per_fiber, '=i4')
+        _write_array(parts[1], coords)
+        for ii, stat in enumerate(np.concatenate([fiber_stats, node_means])):
+            _write_array(parts[2 + ii], stat)
+        for ii, stat in enumerate(node_stats):
+            _write_array(parts[2 + len(f_names) + len(n_names) + ii], stat)
+
+    if parts is None:
+        raise ValueError("No fibers to save in %s"%file_name)
+
+    fwrite = open(file_name + '.tmp', 'wb')
+    fwrite.write(_pdb_header(affine, f_names, n_names))
+    _write_array(fwrite, [n_fibers], '=i4')
+    for part in parts:
+        part.seek(0)
+        shutil.copyfileobj(part, fwrite, 16 * 1024 * 1024)
+        part.close()
+    fwrite.close()
+    _replace_file(file_name + '.tmp', file_name)
 
-def _char_list_maker(name):
-    """
-    Helper function that does essentially the opposite of _word_maker. Takes a
-    string and makes it into a 255 long list of characters with the name of a
-    stat, followed by a single white-space and then 'g' for the rest of the 255
-    """
+    if verbose:
+        print("Done saving %s fibers in file %s"%(n_fibers, file_name))
 
-    l = list(name)
-    l.append('\x00')  # The null character
-    while len(l)<255:
-        l.append('g')
-    return l
+    return n_fibers
 
-def _stat_hdr_set(fwrite, stat, uid):
+def _trk_affine(hdr, affine=None):
     """
-    Helper function for writing stuff into stats header portion of pdb files
+    Helper function to get the affine of the fibers in a trk file: the
+    affine provided as input, or otherwise the one in the header of the file.
     """
-    # Name of the stat:
-    char_list = _char_list_maker(stat)
-    _packer(fwrite, char_list, 'char')
-    _packer(fwrite, char_list, 'char')  # Twice for some reason
-    _packer(fwrite, ['g','g'], 'char')  # Add this, so that that the uid ends
-                                        # up "word-aligned".
-
-    _packer(fwrite, uid) # These might get reordered upon
-                         # resaving on different platforms, because
-                         # dict keys come in no particular order...
-
+    if affine is not None:
+        return affine
+
+    aff = tv.aff_from_hdr(hdr)
+    # If the header contains a bogus affine, we revert to np.eye(4), so we
+    # don't get into trouble later:
+    try:
+        np.matrix(aff).getI()
+    except np.linalg.LinAlgError:
+        e_s = "trk file contains bogus header, reverting to np.eye(4)"
+        warnings.warn(e_s)
+        aff = np.eye(4)
+    return aff
 
 def fg_from_trk(trk_file, affine=None):
     """
@@ -489,19 +612,7 @@ def fg_from_trk(trk_file, affine=None):
     fibers_trk = read_trk[0]
 
     # Per default read from the affine from the file header:
-    if affine is not None:
-        aff = affine
-    else:
-        hdr = read_trk[1]
-        aff= tv.aff_from_hdr(hdr)
-        # If the header contains a bogus affine, we revert to np.eye(4), so we
-        # don't get into trouble later:
-        try:
-            np.matrix(aff).getI()
-        except np.linalg.LinAlgError:
-            e_s = "trk file contains bogus header, reverting to np.eye(4)"
-            warnings.warn(e_s)
-            aff = np.eye(4)
+    aff = _trk_affine(read_trk[1], affine)
 
     fibers = []
     for f in fibers_trk:
@@ -509,6 +620,99 @@ def fg_from_trk(trk_file, affine=None):
 
     return ozf.FiberGroup(fibers, affine=aff)
 
+def iter_pdb(file_name, batch_size=1000):
+    """
+    Read the fibers in a .pdb file, a batch of fibers at a time
+
+    Parameters
+    ----------
+    file_name: str
+       Full path to the .pdb file
+
+    batch_size: int
+       The number of fibers in each batch
+
+    Returns
+    -------
+    A generator of CompactFiberGroup class instances
+
+    Note
+    ----
+    The file is memory-mapped (see `read_pdb`), and each batch holds views
+    into it, so only the nodes of the fibers in the current batch need to be
+    in memory at any one time (for PDB version 3 files; version 2 files are
+    read as a whole).
+    """
+    pdb = read_pdb(file_name)
+    fg = ozf.CompactFiberGroup(pdb["coords"], pdb["offsets"],
+                               fiber_stats=pdb["fiber_stats"],
+                               node_stats=pdb["node_stats"],
+                               name=os.path.split(file_name)[-1].split('.')[0],
+                               affine=pdb["xform"])
+    for batch in ozf.fiber_batches(fg, batch_size):
+        yield batch
+
+def iter_trk(trk_file, batch_size=1000, affine=None):
+    """
+    Read the fibers in a trackvis .trk file, a batch of fibers at a time
+
+    Parameters
+    ----------
+    trk_file: str
+       Full path to the .trk file
+
+    batch_size: int
+       The number of fibers in each batch
+
+    affine: 4 by 4 array, optional
+       Defaults to the affine in the header of the file (see `fg_from_trk`)
+
+    Returns
+    -------
+    A generator of CompactFiberGroup class instances
+    """
+    streamlines, hdr = tv.read(trk_file, as_generator=True)
+    aff = _trk_affine(hdr, affine)
+
+    def make_batch(pts):
+        lengths = [p.shape[0] for p in pts]
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(int)
+        return ozf.CompactFiberGroup(np.vstack(pts).T, offsets, affine=aff)
+
+    pts = []
+    for f in streamlines:
+        pts.append(np.reshape(np.asarray(f[0], dtype=float), (-1, 3)))
+        if len(pts) == batch_size:
+            yield make_batch(pts)
+            pts = []
+    if len(pts):
+        yield make_batch(pts)
+
+def iter_fibers(fibers, batch_size=1000, affine=None):
+    """
+    Iterate over the fibers of a tractogram, a batch of fibers at a time
+
+    Parameters
+    ----------
+    fibers: str, FiberGroup or CompactFiberGroup
+       The fibers, or the full path to a .pdb or .trk file holding them
+
+    batch_size: int
+       The number of fibers in each batch
+
+    affine: 4 by 4 array, optional
+       For .trk files, see `iter_trk`
+
+    Returns
+    -------
+    A generator of CompactFiberGroup class instances
+    """
+    if isinstance(fibers, str):
+        if fibers.endswith('.trk'):
+            return iter_trk(fibers, batch_size, affine=affine)
+        return iter_pdb(fibers, batch_size)
+    return ozf.fiber_batches(fibers, batch_size)
+
 def trk_from_fg(fg, trk_file, affine=None):
     """
     Save a trk file from a FiberGroup class instance
@@ -742,13 +946,337 @@ def make_wm_mask(seg_path, dwi_path, out_path=data_path + 'wm_mask.nii.gz',
     # Now, let's save some output:
     ni.Nifti1Image(vol, dwi_ni.get_affine()).to_filename(out_path)
 
+def shard_file_name(fn, i, f_type="npy"):
+    """
+    The name of the file with the output of shard i:
+    (file name)(number of shard).(file type)
+    """
+    return "%s%d.%s"%(fn, i, f_type)
+
+def save_shard(sub_data, fn, i, low, high, file_path=os.getcwd()):
+    """
+    Save the output of one shard of a parallelized computation, together with
+    a manifest, so that the shards can be put together without looking at
+    any of the other files (see `place_shards`).
+
+    Parameters
+    ----------
+    sub_data: array
+        The output, with one row for each voxel in the shard
+    fn: str
+        Base file name of the output
+    i: int
+        Number of the shard
+    low, high: int
+        The shard holds the voxels low:high of the mask (in the order of
+        np.where)
+    file_path: str
+        Where to save the output
+
+    Returns
+    -------
+    manifest: dict
+        The shard index, voxel range, file name, dtype and shape of the output
+    """
+    sub_data = np.asarray(sub_data)
+    manifest = dict(i=int(i), low=int(low), high=int(high),
+                    file=shard_file_name(fn, i),
+                    dtype=sub_data.dtype.str,
+                    shape=[int(d) for d in sub_data.shape])
+    np.save(os.path.join(file_path, manifest["file"]), sub_data)
+    # The manifest is written last, so that a manifest always points to a
+    # complete file:
+    f = open(os.path.join(file_path, shard_file_name(fn, i, "json")), 'w')
+    json.dump(manifest, f)
+    f.close()
+    return manifest
+
+def shard_manifest(fn, expected_file_num, file_path=os.getcwd()):
+    """
+    Read the manifests of the shards of one output, without loading any data.
+
+    Parameters
+    ----------
+    fn: str
+        Base file name of the output
+    expected_file_num: int
+        Expected number of shards
+    file_path: str
+        Path to the directory with the shards
+
+    Returns
+    -------
+    manifests: list
+        The manifest of each shard (see `save_shard`), or None for the shards
+        that are missing
+    """
+    manifests = []
+    for i in range(expected_file_num):
+        manifest_file = os.path.join(file_path, shard_file_name(fn, i, "json"))
+        if os.path.exists(manifest_file):
+            f = open(manifest_file)
+            manifests.append(json.load(f))
+            f.close()
+        else:
+            manifests.append(None)
+    return manifests
+
+def place_shards(fn, expected_file_num, n_vox, file_path=os.getcwd(),
+                 out_file=None, vox_mask=None):
+    """
+    Put the outputs of all the shards of a parallelized computation together,
+    using their manifests (see `save_shard`). Each shard is read once, straight
+    into its place in the output.
+
+    Parameters
+    ----------
+    fn: str
+        Base file name of the output
+    expected_file_num: int
+        Expected number of shards
+    n_vox: int
+        Number of voxels in the mask
+    file_path: str
+        Path to the directory with the shards
+    out_file: str, optional
+        If provided, the output is a memory-mapped .npy file with this name,
+        instead of an array in memory
+    vox_mask: 1 dimensional array, optional
+        Boolean array with one entry for each voxel in the mask. Shards that
+        have fewer rows than voxels in their range (e.g. because voxels with
+        no signal were left out by the model) are placed in the voxels that
+        are True here.
+
+    Returns
+    -------
+    missing_files: 1 dimensional array
+        The shards that are missing
+    aggre: array
+        The outputs of the shards, with one row for each voxel in the mask
+        (nan where shards are missing)
+    """
+    manifests = shard_manifest(fn, expected_file_num, file_path=file_path)
+    missing_files = np.array([i for i, m in enumerate(manifests) if m is None])
+    present = [m for m in manifests if m is not None]
+
+    if len(present) == 0:
+        return missing_files, ozu.nans(n_vox)
+
+    # The manifests tell us the type and shape of the output:
+    out_shape = (n_vox,) + tuple(present[0]["shape"][1:])
+    out_dtype = np.result_type(np.dtype(present[0]["dtype"]), np.float32)
+    if out_file is None:
+        aggre = np.empty(out_shape, dtype=out_dtype)
+    else:
+        aggre = np.lib.format.open_memmap(out_file, mode='w+',
+                                          dtype=out_dtype, shape=out_shape)
+    aggre[:] = np.nan
+
+    for m in present:
+        sub_data = np.load(os.path.join(file_path, m["file"]), mmap_mode='r')
+        if sub_data.shape[0] == m["high"] - m["low"] or vox_mask is None:
+            aggre[m["low"]:m["high"]] = sub_data
+        else:
+            aggre[m["low"]:m["high"]][vox_mask[m["low"]:m["high"]]] = sub_data
+
+    if out_file is not None:
+        aggre.flush()
+
+    return missing_files, aggre
+
+def write_data_shards(data, bvals, bvecs, mask, shard_size, shard_path,
+                      fn="data_"):
+    """
+    Split the diffusion data in a mask into compact files for parallel jobs,
+    so that each job reads only its own voxels (see `load_data_shard`),
+    instead of the whole data set.
+
+    Each shard is saved with `save_shard` as a (voxels by volumes) .npy
+    file, together with the indices of its voxels in the volume
+    ((fn)idx(number of shard).npy). The b-values and b-vectors are saved
+    once, for all the shards.
+
+    Parameters
+    ----------
+    data: 4 dimensional array or str
+        The diffusion data, or the name of a nifti file with the data
+    bvals: 1 dimensional array
+        The b-values
+    bvecs: 2 dimensional array
+        The b-vectors
+    mask: 3 dimensional array
+        The voxels to split into shards
+    shard_size: int
+        Number of voxels in each shard
+    shard_path: str
+        Where to save the shards
+    fn: str
+        Base file name of the shards
+
+    Returns
+    -------
+    n_shards: int
+        The number of shards
+    """
+    if isinstance(data, str):
+        data = ni.load(data).get_data()
+
+    if not os.path.exists(shard_path):
+        os.makedirs(shard_path)
+
+    mask_idx = np.where(mask)
+    n_vox = len(mask_idx[0])
+    n_shards = int(np.ceil(n_vox / float(shard_size)))
+
+    np.save(os.path.join(shard_path, "%sbvals.npy"%fn), np.asarray(bvals))
+    np.save(os.path.join(shard_path, "%sbvecs.npy"%fn), np.asarray(bvecs))
+
+    for i in range(n_shards):
+        low = i * shard_size
+        # Make sure not to go over the edge of the mask:
+        high = np.min([(i + 1) * shard_size, n_vox])
+        this_idx = tuple([idx[low:high] for idx in mask_idx])
+        np.save(os.path.join(shard_path, shard_file_name(fn + "idx", i)),
+                np.array(this_idx).T)
+        # The signal keeps the data type of the data, to keep it compact:
+        save_shard(data[this_idx], fn, i, low, high, file_path=shard_path)
+
+    return n_shards
+
+def load_data_shard(i, shard_path, fn="data_", mmap_mode='r'):
+    """
+    Load the data of one shard written by `write_data_shards`.
+
+    The voxels of the shard are arranged as a (voxels, 1, 1) volume, so that
+    the data can be used with the models as is. Outputs indexed with the mask
+    (e.g. `model.model_params[model.mask]`) come out in the order of the
+    voxels in the shard.
+
+    Parameters
+    ----------
+    i: int
+        Number of the shard
+    shard_path: str
+        Where the shards were saved
+    fn: str
+        Base file name of the shards
+    mmap_mode: str or None
+        Memory-mapping mode of the signal (see `np.load`). The default only
+        reads from disk the parts of the signal that are used.
+
+    Returns
+    -------
+    data: 4 dimensional array
+        The signal in the voxels of the shard, with shape
+        (voxels, 1, 1, volumes)
+    bvals, bvecs: arrays
+        The b-values and b-vectors
+    mask: 3 dimensional array
+        All the (voxels, 1, 1) voxels
+    manifest: dict
+        The manifest of the shard (see `save_shard`), with the indices of
+        the voxels in the full volume in 'vox_idx'
+    """
+    manifest = shard_manifest(fn, i + 1, file_path=shard_path)[i]
+    if manifest is None:
+        raise IOError("No manifest for shard %s of %s in %s"%(i, fn,
+                                                               shard_path))
+    sig = np.load(os.path.join(shard_path, manifest["file"]),
+                  mmap_mode=mmap_mode)
+    data = sig.reshape((sig.shape[0], 1, 1, sig.shape[-1]))
+    mask = np.ones(data.shape[:3], dtype=bool)
+    bvals = np.load(os.path.join(shard_path, "%sbvals.npy"%fn))
+    bvecs = np.load(os.path.join(shard_path, "%sbvecs.npy"%fn))
+    manifest["vox_idx"] = np.load(os.path.join(shard_path,
+                                               shard_file_name(fn + "idx", i)))
+    return data, bvals, bvecs, mask, manifest
+
+def job_data(data_path, i, shard_size=2000,
+             mask_file="wm_mask_no_vent.nii.gz", shard_dir="shards"):
+    """
+    The data of one parallel job (one shard of a mask) for the templates in
+    `osmosis.parallel`. The data are read from the shards written by
+    `write_data_shards` in data_path/shard_dir, if there are any there, and
+    from the full data.nii.gz, bvals, bvecs and mask files in data_path
+    otherwise.
+
+    Parameters
+    ----------
+    data_path: str
+        The directory of the subject data
+    i: int
+        Number of the shard
+    shard_size: int
+        Number of voxels in each shard
+    mask_file: str
+        The mask (in data_path) that was split into shards
+    shard_dir: str
+        The directory of the shards, relative to data_path
+
+    Returns
+    -------
+    data, bvals, bvecs, mask: the data of the job (see `load_data_shard`)
+    low, high: int
+        The job has the voxels low:high of the mask
+
+    Notes
+    -----
+    If there are shards, they must have been written with the same
+    shard_size (otherwise, the jobs would skip some voxels and overlap in
+    others), and a ValueError is raised if they were not.
+    """
+    shard_path = os.path.join(data_path, shard_dir)
+    if os.path.exists(os.path.join(shard_path,
+                                   shard_file_name("data_", 0, "json"))):
+        manifests = shard_manifest("data_", i + 2, file_path=shard_path)
+        manifest = manifests[i]
+        if manifest is None:
+            e_s = "There is no shard %s in %s. "%(i, shard_path)
+            e_s += "Were the shards written with shard_size=%s?"%shard_size
+            raise ValueError(e_s)
+        this_size = manifest["high"] - manifest["low"]
+        # Only the last shard can be smaller:
+        last = manifests[i + 1] is None
+        if (manifest["low"] != i * shard_size or this_size > shard_size or
+            (this_size < shard_size and not last)):
+            e_s = "Shard %s in %s has the voxels %s:%s, "%(i, shard_path,
+                                                         manifest["low"],
+                                                         manifest["high"])
+            e_s += "which don't match shard_size=%s"%shard_size
+            raise ValueError(e_s)
+        data, bvals, bvecs, mask, manifest = load_data_shard(i, shard_path)
+        return data, bvals, bvecs, mask, manifest["low"], manifest["high"]
+
+    data_file = ni.load(os.path.join(data_path, "data.nii.gz"))
+    wm_data_file = ni.load(os.path.join(data_path, mask_file))
+
+    data = data_file.get_data()
+    wm_data = np.round(wm_data_file.get_data()).astype(int)
+    wm_idx = np.where(wm_data==1)
+
+    bvals = np.loadtxt(os.path.join(data_path, "bvals"))
+    bvecs = np.loadtxt(os.path.join(data_path, "bvecs"))
+
+    low = i*shard_size
+    # Make sure not to go over the edge of the mask:
+    high = np.min([(i+1) * shard_size, len(wm_idx[0])])
+
+    # Now set the mask:
+    mask = np.zeros(wm_data_file.shape)
+    mask[wm_idx[0][low:high], wm_idx[1][low:high], wm_idx[2][low:high]] = 1
+
+    return data, bvals, bvecs, mask, low, high
+
 def place_files(file_names, mask_vox_num, expected_file_num, mask_data,
                 data, bvals, file_path=os.getcwd(), vol=False,
-                f_type="npy", save=False):
+                f_type="npy", save=False, affine=None):
     """
     Function to aggregate sub data files from parallelizing.  Assumes that
     the sub_files are in the format:
-    (file name)_(number of sub_file).(file_type)
+    (file name)(number of sub_file).(file_type)
+
+    Only the expected sub files are read, each of them once. If a sub file
+    has a manifest (see `save_shard`), the voxel range is taken from it.
 
     Parameters
     ----------
@@ -775,8 +1303,8 @@ def place_files(file_names, mask_vox_num, expected_file_num, mask_data,
         String indicating the type of file the sub files are saved as
     save: str
         String indicating whether or not to save the output aggregation/volumes
-    num_dirs: int
-        Number of directions in each output aggregation/volume
+    affine: 4 by 4 array
+        The affine of saved volumes. Default: identity
 
     Returns
     -------
@@ -785,89 +1313,73 @@ def place_files(file_names, mask_vox_num, expected_file_num, mask_data,
     aggre_list: list
         List with all the aggregations/volumes
     """
-    files = os.listdir(file_path)
-
     # Get data and indices
     mask_idx = np.where(mask_data)
+    n_vox = int(np.sum(mask_data))
 
     bval_list, b_inds, unique_b, bvals_scaled = ozu.separate_bvals(bvals)
-    all_b_idx = np.where(bvals_scaled != 0)
 
     # Remove voxels from the mask that contain zero signal values and turn the
     # mask into linear form.
     S0 = np.mean(data[..., b_inds[0]],-1)
-    pre_mask = np.array(mask_data, dtype=bool)
-    ravel_mask = np.ravel(pre_mask).astype(int)
-    ravel_mask[np.where(ravel_mask)[0][np.where(S0[pre_mask] == 0)]] = 2
-    ravel_mask = ravel_mask[np.where(ravel_mask != 0)]
-    ravel_mask[np.where(ravel_mask == 2)] = 0
-    ravel_mask = ravel_mask.astype(bool)
+    ravel_mask = S0[mask_idx] != 0
 
     aggre_list = []
     missing_files_list = []
     for fn in file_names:
-        count = 0
+        aggre = None
         # Keep track of files in case there are any missing ones
         i_track = np.ones(expected_file_num)
+        manifests = shard_manifest(fn, expected_file_num, file_path=file_path)
+
+        for i in range(expected_file_num):
+            this_file = os.path.join(file_path, shard_file_name(fn, i, f_type))
+            if not os.path.exists(this_file):
+                continue
+
+            if manifests[i] is not None:
+                low, high = manifests[i]["low"], manifests[i]["high"]
+            else:
+                low = i*mask_vox_num
+                high = np.min([(i+1) * mask_vox_num, n_vox])
+            this_mask = ravel_mask[low:high]
+
+            if f_type == "npy":
+                sub_data = np.load(this_file, mmap_mode='r')
+            elif f_type == "nii.gz":
+                sub_data = ni.load(this_file).get_data()
+                if sub_data.shape[:3] == mask_data.shape:
+                    # Sub volumes hold their voxels in place:
+                    sub_data = sub_data[tuple([idx[low:high] for idx
+                                               in mask_idx])]
+
+            if aggre is None:
+                if len(sub_data.shape) == 1:
+                    num_dirs = 1
+                else:
+                    num_dirs = sub_data.shape[-1]
+
+                if vol is False:
+                    aggre = np.squeeze(ozu.nans((n_vox,) + (num_dirs,)))
+                else:
+                    aggre = np.squeeze(ozu.nans((mask_data.shape +
+                                                 (num_dirs,))))
+
+            # Sub files either have all the voxels in their range, or only
+            # the ones with signal:
+            sub_data = np.squeeze(sub_data)
+            if sub_data.shape[0] > np.sum(this_mask):
+                sub_data = sub_data[this_mask]
+
+            if vol is False:
+                aggre[low:high][this_mask] = sub_data
+            else:
+                aggre[tuple([idx[low:high][this_mask] for idx
+                             in mask_idx])] = sub_data
 
-        # If you don't want to put the voxels back into a volume, just
-        # preallocate enough for each voxel included in the mask.
-
-        for f_idx in np.arange(len(files)):
-            this_file = files[f_idx]
-            if this_file[(len(this_file)-len(f_type)):len(this_file)] == f_type:
-
-                if f_type == "npy":
-                    sub_data = np.load(os.path.join(file_path, this_file))
-
-                elif f_type == "nii.gz":
-                    sub_data = ni.load(os.path.join(file_path,
-                                        this_file)).get_data()
-
-                # If the name of this file is equal to file name that you want
-                # to aggregate, load it and find the voxels corresponding to its
-                # location in the given mask.
-                if this_file[0:len(fn)] == fn:
-                    if count == 0:
-                        if len(sub_data.shape) == 1:
-                            num_dirs = 1
-
-                        else:
-                            num_dirs = sub_data.shape[-1]
-
-                        if vol is False:
-                            aggre = np.squeeze(ozu.nans((int(np.sum(mask_data)),
-                                                               ) + (num_dirs,)))
-                        else:
-                            aggre = np.squeeze(ozu.nans((mask_data_file.shape
-                                                             + (num_dirs,))))
-
-                    count = count + 1
-                    # Find the location in this aggregate for this file piece.
-                    i = int(this_file.split(".")[0][len(fn):])
-                    low = i*mask_vox_num
-                    high = np.min([(i+1) * mask_vox_num,
-                                int(np.sum(mask_data))])
-
-                    # If you don't have a volume input and don't want a volume
-                    # output, output just an aggregate the output files.
-                    if vol is False:
-                        if sub_data.shape[0] > aggre[low:high][ravel_mask[
-                                                      low:high]].shape[0]:
-                            aggre[low:high][ravel_mask[low:high]] = np.squeeze(
-                                                sub_data)[ravel_mask[low:high]]
-                        else:
-                            aggre[low:high][ravel_mask[low:high]] = np.squeeze(
-                                                                      sub_data)
-                    else:
-                        mask = np.zeros(mask_data_file.shape)
-                        mask[mask_idx[0][low:high][ravel_mask[low:high]],
-                             mask_idx[1][low:high][ravel_mask[low:high]],
-                             mask_idx[2][low:high]][ravel_mask[low:high]] = 1
-                        aggre[np.where(mask)] = sub_data
-                    # If the file is present, change its index within the
-                    # tracking array to 0.
-                    i_track[i] = 0
+            # If the file is present, change its index within the
+            # tracking array to 0.
+            i_track[i] = 0
 
         missing_files_list.append(np.squeeze(np.where(i_track)))
         aggre_list.append(aggre)
@@ -876,8 +1388,9 @@ def place_files(file_names, mask_vox_num, expected_file_num, mask_data,
             if vol is False:
                 np.save("aggre_%s.npy"%fn, aggre)
             else:
-                aff = mask_data_file.get_affine()
-                ni.Nifti1Image(aggre, aff).to_filename("vol_%s.nii.gz"%fn)
+                if affine is None:
+                    affine = np.eye(4)
+                ni.Nifti1Image(aggre, affine).to_filename("vol_%s.nii.gz"%fn)
 
     return missing_files_list, aggre_list
 
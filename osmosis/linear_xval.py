@@ -0,0 +1,310 @@
+"""
+
+K-fold cross-validation of linear models by downdating the Gram matrix
+
+In leave-n-out cross-validation, the design matrix of each fold is the full
+design matrix with a few of its rows removed. Instead of refitting every fold
+from scratch, we compute $X^T X$ and $X^T Y$ for all the data once, and derive
+each fold's system by subtracting the contribution of the held-out rows:
+
+.. math::
+
+    X_f^T X_f = X^T X - X_h^T X_h
+
+    X_f^T Y_f = X^T Y - X_h^T Y_h
+
+Each fold is then solved in this (n_regressors by n_regressors) form, starting
+from the solution for all the data, which is usually very close to the
+solution for the fold.
+
+Solvers are named as in `osmosis.model.sparse_deconvolution`: 'LR' (or 'OLS'),
+'nnls' and 'ElasticNet'. The ElasticNet objective is the one used by sklearn:
+
+.. math::
+
+    \frac{1}{2 n} ||y - X \beta||^2_2 + \alpha \rho ||\beta||_1 +
+    \frac{\alpha (1 - \rho)}{2} ||\beta||^2_2
+
+"""
+
+import numpy as np
+
+# The default solver parameters, as in SparseDeconvolutionModel:
+ALPHA = 0.0005
+L1_RATIO = 0.6
+
+
+class GramSystem(object):
+    """
+    The sufficient statistics for least-squares fitting of Y = X beta for
+    many targets (columns of Y) with one design matrix X.
+    """
+    def __init__(self, gram, XtY, x_sum, y_sum, n_obs):
+        """
+        Parameters
+        ----------
+        gram: 2 dimensional array
+            X^T X, with shape (n_regressors, n_regressors)
+        XtY: 2 dimensional array
+            X^T Y, with shape (n_regressors, n_targets)
+        x_sum: 1 dimensional array
+            The sum of the rows of X
+        y_sum: 1 dimensional array
+            The sum of the rows of Y
+        n_obs: int
+            Number of rows in X
+        """
+        self.gram = gram
+        self.XtY = XtY
+        self.x_sum = x_sum
+        self.y_sum = y_sum
+        self.n_obs = n_obs
+
+    def downdate(self, X_out, Y_out):
+        """
+        The system that results from removing some rows from the data
+
+        Parameters
+        ----------
+        X_out: 2 dimensional array
+            The rows of the design matrix to remove
+        Y_out: 2 dimensional array
+            The corresponding rows of Y
+
+        Returns
+        -------
+        GramSystem class instance for the remaining rows.
+        """
+        return GramSystem(self.gram - np.dot(X_out.T, X_out),
+                          self.XtY - np.dot(X_out.T, Y_out),
+                          self.x_sum - np.sum(X_out, 0),
+                          self.y_sum - np.sum(Y_out, 0),
+                          self.n_obs - X_out.shape[0])
+
+    def centered(self):
+        """
+        The Gram matrix and X^T Y of the column-centered X and Y (used when
+        fitting an intercept)
+        """
+        x_mean = self.x_sum / float(self.n_obs)
+        gram = self.gram - self.n_obs * np.outer(x_mean, x_mean)
+        XtY = self.XtY - np.outer(self.x_sum, self.y_sum) / float(self.n_obs)
+        return gram, XtY
+
+    def intercept(self, beta):
+        """
+        The intercept for each target, given parameters fit to centered data
+        """
+        return (self.y_sum - np.dot(self.x_sum, beta)) / float(self.n_obs)
+
+
+def gram_system(X, Y):
+    """
+    Compute the Gram system of a design matrix and a set of targets
+
+    Parameters
+    ----------
+    X: 2 dimensional array
+        Design matrix with shape (n_obs, n_regressors)
+    Y: 1 or 2 dimensional array
+        Targets with shape (n_obs, n_targets)
+
+    Returns
+    -------
+    GramSystem class instance
+    """
+    X = np.asarray(X, dtype=float)
+    Y = np.asarray(Y, dtype=float)
+    if len(Y.shape) == 1:
+        Y = Y[:, None]
+    return GramSystem(np.dot(X.T, X), np.dot(X.T, Y), np.sum(X, 0),
+                      np.sum(Y, 0), X.shape[0])
+
+
+def _ols_gram(gram, XtY):
+    """
+    Least squares solution of the normal equations. The minimum norm solution
+    is used for rank-deficient systems.
+    """
+    return np.linalg.lstsq(gram, XtY, rcond=-1)[0]
+
+
+def _cd_gram(gram, XtY, beta, l1=0.0, l2=0.0, positive=False, tol=1e-6,
+             max_iter=1000):
+    """
+    Coordinate descent on the normal equations, for all targets at once.
+
+    Minimizes 1/2 b^T G b - b^T X^T y + l1 |b|_1 + l2/2 |b|^2 for each
+    column of XtY, optionally with b >= 0.
+
+    Parameters
+    ----------
+    gram: 2 dimensional array
+        X^T X
+    XtY: 2 dimensional array
+        X^T Y
+    beta: 2 dimensional array
+        Initial values of the parameters (updated in place).
+    l1, l2: float
+        The L1 and L2 penalties, in the scale of the normal equations
+    positive: bool
+        Whether to constrain the parameters to be non-negative
+    tol: float
+        Convergence tolerance on the largest update, relative to the largest
+        parameter
+    max_iter: int
+        Maximal number of sweeps over the coordinates
+
+    Returns
+    -------
+    beta: 2 dimensional array
+        The parameters, with shape (n_regressors, n_targets)
+    """
+    diag = np.diag(gram) + l2
+    # Residual gradient: X^T y - G b, kept up to date as we go:
+    rho_all = XtY - np.dot(gram, beta)
+    active = np.where(diag > 0)[0]
+    for iteration in xrange(max_iter):
+        max_update = 0.0
+        for j in active:
+            old = beta[j].copy()
+            rho = rho_all[j] + gram[j, j] * old
+            if l1 > 0:
+                new = np.sign(rho) * np.maximum(np.abs(rho) - l1, 0) / diag[j]
+            else:
+                new = rho / diag[j]
+            if positive:
+                new = np.maximum(new, 0)
+            delta = new - old
+            if np.any(delta):
+                beta[j] = new
+                rho_all -= np.outer(gram[:, j], delta)
+                max_update = max(max_update, np.max(np.abs(delta)))
+        if max_update <= tol * max(np.max(np.abs(beta)), 1e-12):
+            break
+    return beta
+
+
+def solve_gram(system, solver="LR", solver_params=None, beta0=None, tol=1e-6,
+               max_iter=1000):
+    """
+    Fit a linear model from its Gram system
+
+    Parameters
+    ----------
+    system: GramSystem class instance
+
+    solver: str
+        'LR' or 'OLS' for ordinary least squares, 'nnls' for non-negative
+        least squares or 'ElasticNet'.
+    solver_params: dict, optional
+        For 'ElasticNet': alpha, l1_ratio, positive and fit_intercept. For
+        'LR'/'OLS' and 'nnls': fit_intercept. Defaults to the parameters used
+        by SparseDeconvolutionModel for ElasticNet, and no intercept otherwise.
+    beta0: 2 dimensional array, optional
+        Initial parameters (warm start) for the iterative solvers
+    tol, max_iter: see `_cd_gram`
+
+    Returns
+    -------
+    beta: 2 dimensional array
+        Parameters with shape (n_regressors, n_targets)
+    intercept: 1 dimensional array
+        Intercept for each target (zeros, if no intercept is fit)
+    """
+    if solver_params is None:
+        if solver == "ElasticNet":
+            solver_params = dict(alpha=ALPHA, l1_ratio=L1_RATIO,
+                                 fit_intercept=True, positive=True)
+        else:
+            solver_params = {}
+
+    fit_intercept = solver_params.get('fit_intercept', False)
+    if fit_intercept:
+        gram, XtY = system.centered()
+    else:
+        gram, XtY = system.gram, system.XtY
+
+    if beta0 is None:
+        beta = np.zeros(XtY.shape)
+    else:
+        beta = np.array(beta0, dtype=float).reshape(XtY.shape)
+
+    if solver in ["LR", "OLS"]:
+        beta = _ols_gram(gram, XtY)
+    elif solver == "nnls":
+        beta = _cd_gram(gram, XtY, np.maximum(beta, 0), positive=True,
+                        tol=tol, max_iter=max_iter)
+    elif solver == "ElasticNet":
+        alpha = solver_params.get('alpha', ALPHA)
+        l1_ratio = solver_params.get('l1_ratio', L1_RATIO)
+        positive = solver_params.get('positive', False)
+        if positive:
+            beta = np.maximum(beta, 0)
+        # Scale the penalties into the normal equations (sklearn divides the
+        # squared error by 2 * n_obs):
+        beta = _cd_gram(gram, XtY, beta,
+                        l1=system.n_obs * alpha * l1_ratio,
+                        l2=system.n_obs * alpha * (1 - l1_ratio),
+                        positive=positive, tol=tol, max_iter=max_iter)
+    else:
+        e_s = "Solver %s is not supported for Gram matrix fitting"%solver
+        raise ValueError(e_s)
+
+    if fit_intercept:
+        intercept = system.intercept(beta)
+    else:
+        intercept = np.zeros(XtY.shape[-1])
+
+    return beta, intercept
+
+
+def kfold_xval_linear(X, Y, folds, solver="LR", solver_params=None,
+                      tol=1e-6, max_iter=1000):
+    """
+    K-fold cross-validation of a linear model Y = X beta, with one design
+    matrix for many targets (e.g. voxels), by downdating the Gram matrix of
+    all the data in each fold.
+
+    Parameters
+    ----------
+    X: 2 dimensional array
+        Design matrix, with shape (n_obs, n_regressors)
+    Y: 1 or 2 dimensional array
+        Targets, with shape (n_obs, n_targets)
+    folds: list
+        Each item is an array of the row indices held out in that fold
+        (e.g. the vec_combo_rm0 outputs of `osmosis.utils.fold_plan`)
+    solver, solver_params, tol, max_iter: see `solve_gram`
+
+    Returns
+    -------
+    predicted: 2 dimensional array
+        The prediction for each row of Y from the fold in which it was held
+        out (rows that were not held out in any fold are nan)
+    params: list
+        The (beta, intercept) fit in each fold
+    """
+    X = np.asarray(X, dtype=float)
+    Y = np.asarray(Y, dtype=float)
+    if len(Y.shape) == 1:
+        Y = Y[:, None]
+
+    full = gram_system(X, Y)
+    # The solution for all the data is used as a warm start in every fold:
+    beta_full, _ = solve_gram(full, solver=solver, solver_params=solver_params,
+                              tol=tol, max_iter=max_iter)
+
+    predicted = np.ones(Y.shape) * np.nan
+    params = []
+    for held_out in folds:
+        held_out = np.asarray(held_out, dtype=int)
+        fold = full.downdate(X[held_out], Y[held_out])
+        beta, intercept = solve_gram(fold, solver=solver,
+                                     solver_params=solver_params,
+                                     beta0=beta_full, tol=tol,
+                                     max_iter=max_iter)
+        predicted[held_out] = np.dot(X[held_out], beta) + intercept
+        params.append((beta, intercept))
+
+    return predicted, params
@@ -75,6 +75,11 @@ class DWI(desc.ResetMixin):
         mask: optional, 3-d array
             When provided, used as a boolean mask into the data for access. 
 
+            The data can also be provided already masked and flattened, as a
+            voxels by volumes 2-d array. In that case, the mask (if provided)
+            is a 1-d boolean array over the voxels and all the volume outputs
+            of the object are flat as well.
+
         sub_sample: int or array of ints.
            If we want to sub-sample the DWI data on the sphere (in the bvecs),
            we can do one of two things: 
@@ -144,10 +149,11 @@ class DWI(desc.ResetMixin):
             # in the voxel should be taken
             if len(self.shape)==1:
                 self.mask = slice(0,None,None)
-            # Otherwise, we make a 3D mask, with all the voxels in the volume: 
+            # Otherwise, we make a mask, with all the voxels in the volume
+            # (or all the rows, if the data was already flattened): 
             else:
                 # Spatial mask (take only the spatial dimensions):
-                self.mask = np.ones(self.shape[:3], dtype=bool)
+                self.mask = np.ones(self.shape[:-1], dtype=bool)
             
         if sub_sample is not None:
             if np.iterable(sub_sample):
@@ -254,7 +260,12 @@ class DWI(desc.ResetMixin):
     def _flat_data(self):
         """
         Get the flat data only in the mask
-        """        
+        """
+        # If the data is already flat, and all of it is in the mask, there is
+        # no need to copy it:
+        if (len(self.shape) == 2 and isinstance(self.mask, np.ndarray) and
+            np.all(self.mask)):
+            return self.data
         return self.data[self.mask]
                
     @desc.auto_attr
@@ -324,7 +335,7 @@ class DWI(desc.ResetMixin):
             r_squared = val
         
         # Re-package it into a volume:
-        out = ozu.nans(self.shape[:3])
+        out = ozu.nans(self.shape[:-1])
         out[self.mask] = r_squared
 
         out[out<-1]=-1.0
@@ -350,7 +361,7 @@ class DWI(desc.ResetMixin):
             rmse[vox] = ozu.rmse(flat_sig1[vox], flat_sig2[vox])
             
         # Re-package it into a volume:
-        out = ozu.nans(self.shape[:3])
+        out = ozu.nans(self.shape[:-1])
         out[self.mask] = rmse
         return out
 
@@ -544,7 +555,7 @@ class BaseModel(DWI):
             r_squared = val
         
         # Re-package it into a volume:
-        out = ozu.nans(self.shape[:3])
+        out = ozu.nans(self.shape[:-1])
         out[self.mask] = r_squared
 
         out[out<-1]=-1.0
@@ -587,7 +598,7 @@ class BaseModel(DWI):
 
         # Preallocate the output:
 
-        out = ozu.nans(self.data.shape[:3])
+        out = ozu.nans(self.data.shape[:-1])
         res = self.residuals[self.mask]
         
         if has_numexpr:
@@ -14,6 +14,16 @@ import osmosis.tensor as ozt
 import osmosis.boot as boot
 
 
+def _voxel_blocks(n_vox, block_size):
+    """
+    Slices that split n_vox voxels into consecutive blocks of (at most)
+    block_size voxels
+    """
+    block_size = int(max(block_size, 1))
+    for start in xrange(0, n_vox, block_size):
+        yield slice(start, min(start + block_size, n_vox))
+
+
 class TensorModel(BaseModel):
 
     """
@@ -30,7 +40,8 @@ class TensorModel(BaseModel):
                  scaling_factor=SCALE_FACTOR,
                  sub_sample=None,
                  verbose=True,
-                 fit_method='WLS'):
+                 fit_method='WLS',
+                 block_size=10000):
         """
         Parameters
         -----------
@@ -65,6 +76,10 @@ class TensorModel(BaseModel):
         fit_method: str
            'WLS' for weighted least squares fitting (default) or 'LS'/'OLS' for
            ordinary least squares.
+
+        block_size: int
+           The number of voxels fit (and predicted) together. Larger blocks
+           are faster, but take more memory.
         
         """
         # Initialize the super-class:
@@ -85,6 +100,7 @@ class TensorModel(BaseModel):
         
         self.scaling_factor = scaling_factor
         self.fit_method = fit_method
+        self.block_size = block_size
         self.gtab = gradients.gradient_table(self.bvals, self.bvecs)
         
     @desc.auto_attr
@@ -98,7 +114,7 @@ class TensorModel(BaseModel):
         evecs (9) + evals (3)
         
         """
-        out = ozu.nans((self.data.shape[:3] +  (12,)))
+        out = ozu.nans((self.data.shape[:-1] +  (12,)))
         
         flat_params = np.empty((self._flat_S0.shape[0], 12))
         
@@ -112,8 +128,10 @@ class TensorModel(BaseModel):
                 print("Fitting TensorModel params using dipy")
             tensor_model = dti.TensorModel(self.gtab,
                                   fit_method=self.fit_method)
-            for vox, vox_data in enumerate(self.data[self.mask]):
-                flat_params[vox] = tensor_model.fit(vox_data).model_params
+            flat_data = self._flat_data
+            for block in _voxel_blocks(flat_params.shape[0], self.block_size):
+                flat_params[block] = tensor_model.fit(
+                    flat_data[block]).model_params
 
             out[self.mask] = flat_params
             # Save the params for future use: 
@@ -127,7 +145,7 @@ class TensorModel(BaseModel):
     @desc.auto_attr
     def evecs(self):
         return np.reshape(self.model_params[..., 3:], 
-                          self.model_params.shape[:3] + (3,3))
+                          self.model_params.shape[:-1] + (3,3))
 
     @desc.auto_attr
     def evals(self):
@@ -156,7 +174,7 @@ class TensorModel(BaseModel):
                         \lambda_2^2+\lambda_3^2} }
 
         """
-        out = ozu.nans(self.data.shape[:3])
+        out = ozu.nans(self.data.shape[:-1])
         
         lambda_1 = self.evals[..., 0][self.mask]
         lambda_2 = self.evals[..., 1][self.mask]
@@ -177,7 +195,7 @@ class TensorModel(BaseModel):
 
     @desc.auto_attr
     def linearity(self):
-        out = ozu.nans(self.data.shape[:3])
+        out = ozu.nans(self.data.shape[:-1])
         out[self.mask] = ozu.tensor_linearity(self.evals[..., 0][self.mask],
                                               self.evals[..., 1][self.mask],
                                               self.evals[..., 2][self.mask])
@@ -185,7 +203,7 @@ class TensorModel(BaseModel):
 
     @desc.auto_attr
     def planarity(self):
-        out = ozu.nans(self.data.shape[:3])
+        out = ozu.nans(self.data.shape[:-1])
         out[self.mask] = ozu.tensor_planarity(self.evals[..., 0][self.mask],
                                               self.evals[..., 1][self.mask],
                                               self.evals[..., 2][self.mask])
@@ -193,7 +211,7 @@ class TensorModel(BaseModel):
 
     @desc.auto_attr
     def sphericity(self):
-        out = ozu.nans(self.data.shape[:3])
+        out = ozu.nans(self.data.shape[:-1])
         out[self.mask] = ozu.tensor_sphericity(self.evals[..., 0][self.mask],
                                                self.evals[..., 1][self.mask],
                                                self.evals[..., 2][self.mask])
@@ -203,35 +221,35 @@ class TensorModel(BaseModel):
     @desc.auto_attr
     def tensors(self):
         out = ozu.nans(self.evecs.shape)
-        evals = self.evals[self.mask]
-        evecs = self.evecs[self.mask]
-        D_flat = np.empty(evecs.shape)
-        for ii in xrange(len(D_flat)):
-            Q = evecs[ii]
-            L = evals[ii]
-            D_flat[ii] = np.dot(Q*L, Q.T)
-
-        out[self.mask] = D_flat
+        # Q L Q^T in every voxel, where the columns of Q are the evecs:
+        out[self.mask] = np.einsum('vij,vj,vkj->vik', self.evecs[self.mask],
+                                   self.evals[self.mask],
+                                   self.evecs[self.mask])
         return out
 
+    def _flat_adc(self, bvecs):
+        """
+        The ADC predicted by the tensors in the mask in the directions of
+        bvecs (3 by n), computed over blocks of voxels
+        """
+        tensors_flat = self.tensors[self.mask]
+        adc_flat = np.empty((tensors_flat.shape[0], bvecs.shape[-1]))
+        for block in _voxel_blocks(adc_flat.shape[0], self.block_size):
+            # b^T D b for every voxel and direction:
+            adc_flat[block] = np.einsum('in,vij,jn->vn', bvecs,
+                                        tensors_flat[block], bvecs)
+        return adc_flat
+
     @desc.auto_attr
     def mode(self):
-        out = ozu.nans(self.data.shape[:3])
+        out = ozu.nans(self.data.shape[:-1])
         out[self.mask] = dti.tensor_mode(self.tensors)[self.mask]
         return out
 
     @desc.auto_attr
     def model_adc(self):
         out = np.empty(self.signal.shape)
-        tensors_flat = self.tensors[self.mask].reshape((-1,3,3))
-        adc_flat = np.empty(self.signal[self.mask].shape)
-
-        for ii in xrange(len(adc_flat)):
-            adc_flat[ii] = ozt.apparent_diffusion_coef(
-                                        self.bvecs[:,self.b_idx],
-                                        tensors_flat[ii])
-
-        out[self.mask] = adc_flat
+        out[self.mask] = self._flat_adc(self.bvecs[:, self.b_idx])
         return out
 
     def predict_adc(self, sphere):
@@ -240,16 +258,8 @@ class TensorModel(BaseModel):
         The ADC predicted on a sphere (containing points other than the bvecs)
         
         """
-        out = ozu.nans(self.signal.shape[:3] + (sphere.shape[-1],))
-        tensors_flat = self.tensors[self.mask].reshape((-1,3,3))
-        pred_adc_flat = np.empty((np.sum(self.mask), sphere.shape[-1]))
-
-        for ii in xrange(len(pred_adc_flat)):
-            pred_adc_flat[ii] = ozt.apparent_diffusion_coef(sphere,
-                                                       tensors_flat[ii])
-
-        out[self.mask] = pred_adc_flat
-
+        out = ozu.nans(self.signal.shape[:-1] + (sphere.shape[-1],))
+        out[self.mask] = self._flat_adc(sphere)
         return out
         
 
@@ -286,16 +296,11 @@ class TensorModel(BaseModel):
     def fit(self):
         if self.verbose:
             print("Predicting signal from TensorModel")
-        adc_flat = self.model_adc[self.mask]
-        fit_flat = np.empty(adc_flat.shape)
         out = ozu.nans(self.signal.shape)
-
-        for ii in xrange(len(fit_flat)):
-            fit_flat[ii] = ozt.stejskal_tanner(self._flat_S0[ii],
-                                               self.bvals[self.b_idx],
-                                               adc_flat[ii])
-
-        out[self.mask] = fit_flat
+        # S = S0 exp(-b ADC), in every voxel and direction:
+        out[self.mask] = (self._flat_S0[:, None] *
+                          np.exp(-self.bvals[self.b_idx] *
+                                 self.model_adc[self.mask]))
         return out
 
     def predict(self, sphere, bvals=None):
@@ -317,16 +322,9 @@ class TensorModel(BaseModel):
             # If you gave them as input, you need to scale them:
             bvals = bvals/float(self.scaling_factor)
             
-        pred_adc_flat = self.predict_adc(sphere)[self.mask]
-        predict_flat = np.empty(pred_adc_flat.shape)
-
-        out = ozu.nans(self.signal.shape[:3] + (sphere.shape[-1], ))
-        for ii in xrange(len(predict_flat)):
-            predict_flat[ii] = ozt.stejskal_tanner(self._flat_S0[ii],
-                                                   bvals,
-                                                   pred_adc_flat[ii])
-
-        out[self.mask] = predict_flat
+        out = ozu.nans(self.signal.shape[:-1] + (sphere.shape[-1], ))
+        out[self.mask] = (self._flat_S0[:, None] *
+                          np.exp(-bvals * self._flat_adc(sphere)))
         return out
 
     @desc.auto_attr
@@ -335,11 +333,14 @@ class TensorModel(BaseModel):
 
         The diffusion distance implied by the model parameters
         """
+        bvecs = self.bvecs[:, self.b_idx]
         tensors_flat = self.tensors[self.mask]
-        dist_flat = np.empty(self._flat_signal.shape)        
-        for vox in xrange(len(dist_flat)):
-            dist_flat[vox]=ozt.diffusion_distance(self.bvecs[:, self.b_idx],
-                                                  tensors_flat[vox])
+        dist_flat = np.empty(self._flat_signal.shape)
+        for block in _voxel_blocks(dist_flat.shape[0], self.block_size):
+            # 1 / sqrt(b^T D^-1 b) for every voxel and direction:
+            sph_adc = np.einsum('in,vij,jn->vn', bvecs,
+                                np.linalg.inv(tensors_flat[block]), bvecs)
+            dist_flat[block] = 1 / np.sqrt(sph_adc)
         out = ozu.nans(self.signal.shape)
         out[self.mask] = dist_flat
 
@@ -355,19 +356,16 @@ def _dyad_stats(tensor_model_list, mask=None, dyad_stat=boot.dyad_coherence,
     if mask is None:
         mask = np.ones(tensor_model_list[0].shape[:3])
         
-    # flatten the eigenvectors:
-    tensor_model_flat=np.array([this.evecs[np.where(mask)] for this in
-    tensor_model_list])
-    out_flat = np.empty(tensor_model_flat[0].shape[0])
-
-    # Loop over voxels
-    for idx in xrange(tensor_model_flat.shape[1]):
-        dyad = boot.dyadic_tensor(tensor_model_flat[:,idx,:,:],
-                                  average=average)
-        out_flat[idx] = dyad_stat(dyad)
+    # flatten the eigenvectors, into (voxels, models, 3, 3), with the
+    # eigenvectors in the rows, as boot.dyadic_tensor expects:
+    tensor_model_flat = np.array([np.swapaxes(this.evecs[np.where(mask)],
+                                              -1, -2)
+                                  for this in tensor_model_list])
+    dyad = boot.dyadic_tensor(np.swapaxes(tensor_model_flat, 0, 1),
+                              average=average)
 
     out = ozu.nans(tensor_model_list[0].shape[:3])
-    out[np.where(mask)] = out_flat
+    out[np.where(mask)] = dyad_stat(dyad)
     return out        
     
 
@@ -396,3 +394,192 @@ def tensor_dispersion(tensor_model_list, mask=None):
                        dyad_stat=boot.dyad_dispersion,
                        average=False) # This one needs to know the individual
                                       # dyads, in addition to the average one.
+
+
+def _fit_log_tensors(design, log_sig, fit_method='WLS'):
+    """
+    Fit the tensor model to the log of the signal in many voxels (and many
+    samples) at once
+
+    Parameters
+    ----------
+    design: (..., g, 7) array
+        dipy's design matrix for the g measurements. A stack of design
+        matrices (one per sample) has matching leading dimensions in log_sig.
+
+    log_sig: (..., n_vox, g) array
+        The log of the signal
+
+    fit_method: str
+        'WLS' for weighted least squares or 'LS'/'OLS' for ordinary least
+        squares. These follow dipy.reconst.dti.wls_fit_tensor and
+        ols_fit_tensor.
+
+    Returns
+    -------
+    (..., n_vox, 7) array: the six unique elements of the tensor (Dxx, Dxy,
+    Dyy, Dxz, Dyz, Dzz) and the log of S0
+    """
+    params = np.matmul(log_sig, np.swapaxes(np.linalg.pinv(design), -1, -2))
+    if fit_method in ['LS', 'OLS']:
+        return params
+    if fit_method != 'WLS':
+        e_s = "fit_method must be one of 'WLS', 'LS' or 'OLS', "
+        e_s += "not '%s'" % fit_method
+        raise ValueError(e_s)
+    # The weights are the squared signal predicted by the OLS fit:
+    w = np.exp(2 * np.matmul(params, np.swapaxes(design, -1, -2)))
+    # X^T W X, as the weighted sum of the outer products of the rows of X:
+    outer = design[..., :, np.newaxis] * design[..., np.newaxis, :]
+    XtWX = np.matmul(w, outer.reshape(design.shape[:-1] + (-1,)))
+    XtWX = XtWX.reshape(XtWX.shape[:-1] + design.shape[-1:] * 2)
+    XtWy = np.matmul(w * log_sig, design)
+    return np.linalg.solve(XtWX, XtWy[..., np.newaxis])[..., 0]
+
+
+def _decompose_tensors(params, min_diffusivity=0):
+    """
+    The eigen-values (..., 3), in descending order, and eigen-vectors
+    (..., 3, 3), in the columns, of the tensors in params (..., 7)
+    """
+    evals, evecs = np.linalg.eigh(dti.from_lower_triangular(params))
+    evals = np.maximum(evals[..., ::-1], min_diffusivity)
+    return evals, evecs[..., ::-1]
+
+
+def tensor_bootstrap(data, bvecs, bvals, n_samples=100, method='wild',
+                     n_dirs=None, mask=None, scaling_factor=SCALE_FACTOR,
+                     fit_method='WLS', block_size=1000, seed=None,
+                     verbose=True):
+    """
+    The coherence and dispersion of the principal diffusion direction over
+    bootstrap samples of the signal.
+
+    All the samples are fit together over blocks of voxels, instead of
+    creating a TensorModel for each sample.
+
+    Parameters
+    ----------
+    data, bvecs, bvals: see DWI inputs. For method='repetition', data is a
+        sequence of repeated measurements (arrays or file-names), all with the
+        same bvecs and bvals.
+
+    n_samples: int
+        The number of bootstrap samples
+
+    method: str
+        How the samples are generated:
+
+        'wild': the residuals of the fit of the tensor model to the log of the
+        signal are multiplied by random signs in every measurement.
+
+        'residual': the residuals of each voxel are drawn with replacement.
+
+        'repetition': each measurement is drawn from one of the repeated
+        measurements.
+
+        'subsample': the tensor is fit to n_dirs directions, chosen with
+        boot.subsample (together with all the b0 measurements).
+
+    n_dirs: int
+        The number of directions in each sample, for method='subsample'
+
+    mask, scaling_factor: see TensorModel
+
+    fit_method: str
+        'WLS' for weighted least squares fitting (default) or 'LS'/'OLS' for
+        ordinary least squares.
+
+    block_size: int
+        The number of voxels fit together. Memory use grows as block_size *
+        n_samples.
+
+    seed: int, optional
+        Seed for the random number generator
+
+    Returns
+    -------
+    coherence, dispersion: arrays with the shape of the volume. The dyadic
+    coherence (see boot.dyad_coherence) and the dispersion (see
+    boot.dyad_dispersion) of the principal diffusion direction in each
+    voxel. Voxels outside the mask are nan.
+
+    Notes
+    -----
+    Chung, SW., Lu, Y., Henry, R.G., 2006. Comparison of bootstrap
+    approaches for estimation of uncertainties of DTI parameters.
+    NeuroImage 33, 531-541.
+    """
+    if method not in ['wild', 'residual', 'repetition', 'subsample']:
+        e_s = "method must be one of 'wild', 'residual', 'repetition' or "
+        e_s += "'subsample', not '%s'" % method
+        raise ValueError(e_s)
+    if method == 'subsample' and n_dirs is None:
+        raise ValueError("n_dirs is required for method='subsample'")
+    prng = np.random.RandomState(seed)
+
+    if method == 'repetition':
+        models = [TensorModel(this_data, bvecs, bvals, mask=mask,
+                              scaling_factor=scaling_factor,
+                              params_file='temp', verbose=False)
+                  for this_data in data]
+    else:
+        models = [TensorModel(data, bvecs, bvals, mask=mask,
+                              scaling_factor=scaling_factor,
+                              params_file='temp', verbose=False)]
+    TM = models[0]
+    design = dti.design_matrix(TM.gtab)
+    # As in dipy:
+    min_diffusivity = 1e-6 / -design.min()
+
+    if method == 'subsample':
+        if verbose:
+            print("Sub-sampling %s directions %s times" % (n_dirs, n_samples))
+        # The measurements (and design matrix) of each sample:
+        dirs = boot.subsample(TM.bvecs[:, TM.b_idx], n_dirs,
+                              n_samples=n_samples, prng=prng)[1]
+        rows = np.sort(np.hstack([np.tile(TM.b0_idx, (n_samples, 1)),
+                                  TM.b_idx[dirs]]), -1)
+        design = design[rows]
+    elif method in ['wild', 'residual']:
+        # The leverage of each measurement, from the OLS hat matrix:
+        leverage = np.sum(design * np.linalg.pinv(design).T, -1)
+
+    n_vox = np.sum(TM.mask)
+    coherence = np.empty(n_vox)
+    dispersion = np.empty(n_vox)
+    for block in _voxel_blocks(n_vox, block_size):
+        if verbose:
+            print("Bootstrapping voxels %s to %s of %s" % (block.start,
+                                                           block.stop, n_vox))
+        # dipy replaces all signals below 1 with 1:
+        log_sig = np.log(np.maximum(
+            [this._flat_data[block] for this in models], 1))
+        if method == 'subsample':
+            # (samples, voxels, measurements):
+            log_samples = np.swapaxes(log_sig[0][:, rows], 0, 1)
+        elif method == 'repetition':
+            log_samples = boot.resample_repetitions(log_sig, n_samples,
+                                                    prng=prng)
+        else:
+            params = _fit_log_tensors(design, log_sig[0], fit_method)
+            log_fit = np.dot(params, design.T)
+            log_samples = log_fit + boot.resample_residuals(
+                log_sig[0] - log_fit, n_samples, method=method,
+                leverage=leverage, prng=prng)
+
+        evecs = _decompose_tensors(_fit_log_tensors(design, log_samples,
+                                                    fit_method),
+                                   min_diffusivity)[1]
+        # (voxels, samples, 3, 3), with the eigenvectors in the rows:
+        evecs = np.swapaxes(np.swapaxes(evecs, -1, -2), 0, 1)
+        coherence[block] = boot.dyad_coherence(
+            boot.dyadic_tensor(evecs, average=True))
+        dispersion[block] = boot.dyad_dispersion(
+            boot.dyadic_tensor(evecs, average=False))
+
+    out_coherence = ozu.nans(TM.mask.shape)
+    out_coherence[TM.mask] = coherence
+    out_dispersion = ozu.nans(TM.mask.shape)
+    out_dispersion[TM.mask] = dispersion
+    return out_coherence, out_dispersion
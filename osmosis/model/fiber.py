@@ -3,12 +3,14 @@ import inspect
 
 import numpy as np
 import scipy.sparse as sparse
-
-import sklearn.linear_model as lm
+import scipy.sparse.linalg as spla
 
 import osmosis.utils as ozu
+import osmosis.fibers as ozf
+import osmosis.io as oio
 import osmosis.descriptors as desc
 import osmosis.sgd as sgd
+import osmosis.nnls as onn
 from osmosis.model.base import BaseModel, SCALE_FACTOR
 from osmosis.model.canonical_tensor import AD,RD
 
@@ -32,7 +34,8 @@ class BaseFiber(BaseModel):
                  mask=None,
 		 scaling_factor=None,
 		 params_file=None,
-		 sub_sample=None):
+		 sub_sample=None,
+                 batch_size=None):
 	"""
 	Parameters
 	----------
@@ -40,8 +43,14 @@ class BaseFiber(BaseModel):
 	data : a volume with data (can be diffusion data, but doesn't have to
 	be)
 
-	FG : a osmosis.fibers.FiberGroup object, or the name of a pdb file
-        containing the fibers to be read in using ozf.fg_from_pdb
+	FG : a osmosis.fibers.FiberGroup (or CompactFiberGroup) object, or the
+        name of a pdb or trk file containing the fibers. Fibers in a file are
+        read a batch at a time, whenever they are needed (see
+        `osmosis.io.iter_fibers`), instead of being held in memory.
+
+        batch_size : int, optional
+        The number of fibers to process at a time. Defaults to all of the
+        fibers at once.
         """
         # Initialize the super-class:
         BaseModel.__init__(self,
@@ -54,12 +63,42 @@ class BaseFiber(BaseModel):
                             params_file=params_file,
                             sub_sample=sub_sample)
         
-        if affine is not None:
+        self.batch_size = batch_size
+        self._fg_affine = None
+        if isinstance(FG, str):
+            # Fibers in files are transformed one batch at a time:
+            self.FG = FG
+            if affine is not None:
+                self._fg_affine = np.matrix(affine).getI()
+        elif affine is not None:
             # The FG is transformed through the provided affine if need be: 
             self.FG = FG.xform(affine.getI(), inplace=False)
         else:
             self.FG = FG
-	
+
+    def fiber_batches(self):
+        """
+        Iterate over the fibers, batch_size fibers at a time, as
+        CompactFiberGroup objects in the coordinates of the data
+        """
+        if isinstance(self.FG, str):
+            for batch in oio.iter_fibers(self.FG, self.batch_size):
+                if self._fg_affine is not None:
+                    batch.xform(self._fg_affine)
+                yield batch
+        else:
+            for batch in ozf.fiber_batches(self.FG, self.batch_size):
+                yield batch
+
+    @desc.auto_attr
+    def n_fibers(self):
+        """
+        The number of fibers in the model
+        """
+        if isinstance(self.FG, str):
+            return int(np.sum([len(b) for b in self.fiber_batches()]))
+        return len(self.FG.fibers)
+
     @desc.auto_attr
     def fg_idx(self):
         """
@@ -73,6 +112,8 @@ class BaseFiber(BaseModel):
         """
         All the coords of all the fibers  
         """
+        if isinstance(self.FG, str):
+            return np.hstack([b.coords for b in self.fiber_batches()])
         return self.FG.coords
 
 
@@ -81,53 +122,71 @@ class BaseFiber(BaseModel):
         """
         The *unique* voxel indices
         """
-        return ozu.unique_rows(self.fg_idx.T).T
+        if not isinstance(self.FG, str):
+            # The spatial index of the fibers has them (and can be reused):
+            return self.FG.node_index.voxels
+        # The unique voxels of each batch are found first, so that the
+        # coordinates of all the fibers are not needed at once:
+        idx = [ozu.unique_rows(b.coords.astype(int).T)
+               for b in self.fiber_batches()]
+        return ozu.unique_rows(np.vstack(idx)).T
 
 
     @desc.auto_attr
-    def voxel2fiber(self):
+    def _vox_lookup(self):
         """
-        The first list in the tuple answers the question: Given a voxel (from
-        the unique indices in this model), which fibers pass through it?
-
-        The second answers the question: Given a voxel, for each fiber, which
-        nodes are in that voxel? 
+        The linear indices of the unique voxels in the volume, sorted, and
+        the order that sorts them, for finding the voxel of each node
         """
-        # Preallocate for speed:
-        
-        # Make a voxels by fibers grid. If the fiber is in the voxel, the value
-        # there will be 1, otherwise 0:
-        v2f = np.zeros((len(self.fg_idx_unique.T), len(self.FG.fibers)))
-
-        # This is a grid of size (fibers, maximal length of a fiber), so that
-        # we can capture put in the voxel number in each fiber/node combination:
-        v2fn = ozu.nans((len(self.FG.fibers),
-                         np.max([f.coords.shape[-1] for f in self.FG])))
+        vox_lin = np.ravel_multi_index(self.fg_idx_unique,
+                                       self.data.shape[:3])
+        vox_order = np.argsort(vox_lin)
+        return vox_lin[vox_order], vox_order
 
-        if self.verbose:
-            prog_bar = ozu.ProgressBar(self.FG.n_fibers)
-            this_class = str(self.__class__).split("'")[-2].split('.')[-1]
-            f_name = this_class + '.' + inspect.stack()[0][3]
+    def _node_voxels(self, batch):
+        """
+        The serial number of the voxel of each node of a batch of fibers, in
+        the unique voxel indices of this model
+        """
+        vox_lin, vox_order = self._vox_lookup
+        node_lin = np.ravel_multi_index(batch.coords.astype(int),
+                                        self.data.shape[:3])
+        return vox_order[np.searchsorted(vox_lin, node_lin)]
 
-        # In each fiber:
-        for f_idx, f in enumerate(self.FG.fibers):
-            # In each voxel present in there:
-            for vv in f.coords.astype(int).T:
-                # What serial number is this voxel in the unique fiber indices:
-                voxel_id = np.where((vv[0] == self.fg_idx_unique[0]) *
-                                    (vv[1] == self.fg_idx_unique[1]) *
-                                    (vv[2] == self.fg_idx_unique[2]))[0]
-                # Add that combination to the grid:
-                v2f[voxel_id, f_idx] += 1 
-                # All the nodes going through this voxel get its number:
-                v2fn[f_idx][np.where((f.coords.astype(int)[0]==vv[0]) *
-                                     (f.coords.astype(int)[1]==vv[1]) *
-                                     (f.coords.astype(int)[2]==vv[2]))]=voxel_id
-            
-            if self.verbose:
-                prog_bar.animate(f_idx, f_name=f_name)
+    @desc.auto_attr
+    def voxel2fiber(self):
+        """
+        The first item in the tuple answers the question: Given a voxel (from
+        the unique indices in this model), which fibers pass through it? This
+        is a sparse (voxels by fibers) matrix, with the number of nodes of
+        each fiber in each voxel.
 
-        return v2f,v2fn
+        The second answers the question: Given a node, which voxel is it in?
+        This is an array with the serial number of the voxel of each node of
+        each fiber (one fiber after the other, as in FiberGroup.coords).
+        """
+        n_vox = self.fg_idx_unique.shape[-1]
+        if not isinstance(self.FG, str):
+            # The spatial index has the voxel of each node:
+            node_vox = self.FG.node_index.node_voxel
+            node_fiber = self.FG.node_index.fiber_index
+            n_fibers = self.FG.node_index.n_fibers
+        else:
+            node_vox = []
+            node_fiber = []
+            n_fibers = 0
+            for batch in self.fiber_batches():
+                node_vox.append(self._node_voxels(batch))
+                node_fiber.append(batch.fiber_index + n_fibers)
+                n_fibers += len(batch)
+            node_vox = np.concatenate(node_vox)
+            node_fiber = np.concatenate(node_fiber)
+
+        # Duplicate entries are summed, counting the nodes in each voxel:
+        v2f = sparse.coo_matrix((np.ones(len(node_vox)),
+                                 [node_vox, node_fiber]),
+                                shape=(n_vox, n_fibers)).tocsr()
+        return v2f, node_vox
 
 class FiberModel(BaseFiber):
     """
@@ -148,17 +207,37 @@ class FiberModel(BaseFiber):
                  mask=None,
                  mode='relative_signal',
                  scaling_factor=SCALE_FACTOR,
-                 sub_sample=None):
+                 sub_sample=None,
+                 batch_size=None,
+                 solver='sgd',
+                 solver_params=None,
+                 fiber_weights0=None):
         """
         Parameters
         ----------
         
-        FG: a osmosis.fibers.FiberGroup object, or the name of a pdb file
-            containing the fibers to be read in using ozf.fg_from_pdb
+        FG: a osmosis.fibers.FiberGroup object, or the name of a pdb or trk
+            file containing the fibers (see BaseFiber)
 
         axial_diffusivity: The axial diffusivity of a single fiber population.
 
         radial_diffusivity: The radial diffusivity of a single fiber population.
+
+        batch_size: The number of fibers to process at a time. The
+            contributions of each batch to the model matrix are computed
+            together, so the signal predicted at the nodes of only one batch
+            is held in memory at any time. Defaults to all the fibers at once.
+
+        solver: How to fit the weights. Either 'sgd' (see
+            `osmosis.sgd.stochastic_gradient_descent`) or 'nnls', for the
+            deterministic sparse non-negative least squares solver (see
+            `osmosis.nnls.sparse_nnls`).
+
+        solver_params: dict, optional. Additional keyword arguments for the
+            solver (for example tol, max_iter and n_threads for 'nnls').
+
+        fiber_weights0: array, optional. Initial fiber weights for the 'nnls'
+            solver, for example from a fit of this model with fewer fibers.
         
         """
         # Initialize the super-class:
@@ -171,112 +250,116 @@ class FiberModel(BaseFiber):
 			   mask=mask,
 			   scaling_factor=scaling_factor,
 			   params_file=params_file,
-		           sub_sample=sub_sample)
+		           sub_sample=sub_sample,
+                           batch_size=batch_size)
 
         self.axial_diffusivity = axial_diffusivity
         self.radial_diffusivity = radial_diffusivity
         self.mode = mode
+        if solver not in ['sgd', 'nnls']:
+            raise ValueError("Solver %s is not supported"%solver)
+        self.solver = solver
+        if solver_params is None:
+            solver_params = {}
+        self.solver_params = solver_params
+        self.fiber_weights0 = fiber_weights0
+
+    def _batch_signal(self, batch):
+        """
+        The relative signal predicted at each node of a batch of fibers, as
+        an (n_nodes, n_bvecs) array
+        """
+        return batch.predicted_signal(self.bvecs[:, self.b_idx],
+                                      self.bvals[self.b_idx],
+                                      self.axial_diffusivity,
+                                      self.radial_diffusivity)
 
     @desc.auto_attr
     def fiber_signal(self):
         """
         The relative signal predicted along each fiber. 
         """
-
-        if self.verbose:
-            prog_bar = ozu.ProgressBar(self.FG.n_fibers)
-            this_class = str(self.__class__).split("'")[-2].split('.')[-1]
-            f_name = this_class + '.' + inspect.stack()[0][3]
-
         sig = []
-        for f_idx, f in enumerate(self.FG):
-            sig.append(f.predicted_signal(self.bvecs[:, self.b_idx],
-                                          self.bvals[self.b_idx],
-                                          self.axial_diffusivity,
-                                          self.radial_diffusivity))
-
-            if self.verbose:
-                prog_bar.animate(f_idx, f_name=f_name)
-
+        for batch in self.fiber_batches():
+            sig.extend(np.split(self._batch_signal(batch),
+                                batch.offsets[1:-1]))
         return sig
-        
+
     @desc.auto_attr
     def matrix(self):
         """
         The matrix of fiber-contributions to the DWI signal.
+
+        The fibers are processed one batch at a time. The signal predicted at
+        the nodes of each batch is summed over the nodes of each fiber in each
+        voxel (and demeaned by the mean signal in the voxel, so that the
+        isotropic part can carry that) and only these sums are kept for the
+        sparse matrix. Nodes with a osmosis.fibers.NODE_WEIGHT node stat
+        (see osmosis.fibers.compress_fibers) are weighted by it. For fibers
+        that curve inside voxels, the matrix of the compressed fibers is an
+        approximation of the matrix of the original ones.
         """
         # Assign some local variables, for shorthand:
-        vox_coords = self.fg_idx_unique.T
-        n_vox = self.fg_idx_unique.shape[-1]
+        vox_coords = self.fg_idx_unique
+        n_vox = vox_coords.shape[-1]
         n_bvecs = self.b_idx.shape[0]
-        v2f,v2fn = self.voxel2fiber
 
-        # How many fibers in each voxel (this will determine how many
-        # components are in the fiber part of the matrix):
-        n_unique_f = np.sum(v2f)        
-        
-        # Preallocate these, which will be used to generate the two sparse
-        # matrices:
-
-        # This one will hold the fiber-predicted signal
-        f_matrix_sig = np.zeros(n_unique_f * n_bvecs)
-        f_matrix_row = np.zeros(n_unique_f * n_bvecs)
-        f_matrix_col = np.zeros(n_unique_f * n_bvecs)
-
-        # And this will hold weights to soak up the isotropic component in each
-        # voxel: 
-        i_matrix_sig = np.zeros(n_vox * n_bvecs)
-        i_matrix_row = np.zeros(n_vox * n_bvecs)
-        i_matrix_col = np.zeros(n_vox * n_bvecs)
-        
-        keep_ct1 = 0
-        keep_ct2 = 0
+        if self.mode == 'relative_signal':
+            vox_sig = self.relative_signal
+        elif self.mode == 'signal_attenuation':
+            vox_sig = 1 - self.relative_signal
+        vox_mean = np.mean(vox_sig[vox_coords[0],
+                                   vox_coords[1],
+                                   vox_coords[2]], -1)
 
         if self.verbose:
-            prog_bar = ozu.ProgressBar(len(vox_coords))
             this_class = str(self.__class__).split("'")[-2].split('.')[-1]
             f_name = this_class + '.' + inspect.stack()[0][3]
 
-        # In each voxel:
-        for v_idx, vox in enumerate(vox_coords):
-            # For each fiber:
-            for f_idx in np.where(v2f[v_idx])[0]:
-                # Sum the signal from each node of the fiber in that voxel: 
-                pred_sig = np.zeros(n_bvecs)
-                for n_idx in np.where(v2fn[f_idx]==v_idx)[0]:
-                    relative_signal = self.fiber_signal[f_idx][n_idx]
-                    if self.mode == 'relative_signal':
-                        # Predict the signal and demean it, so that the isotropic
-                        # part can carry that:
-                        pred_sig += (relative_signal -
-                            np.mean(self.relative_signal[vox[0],vox[1],vox[2]]))
-                    elif self.mode == 'signal_attenuation':
-                        pred_sig += ((1 - relative_signal) -
-                        np.mean(1 - self.relative_signal[vox[0],vox[1],vox[2]]))
-                    
-            # For each fiber-voxel combination, we now store the row/column
-            # indices and the signal in the pre-allocated linear arrays
-            f_matrix_row[keep_ct1:keep_ct1+n_bvecs] =\
-                np.arange(n_bvecs) + v_idx * n_bvecs
-            f_matrix_col[keep_ct1:keep_ct1+n_bvecs] = np.ones(n_bvecs) * f_idx 
-            f_matrix_sig[keep_ct1:keep_ct1+n_bvecs] = pred_sig
-            keep_ct1 += n_bvecs
-
-            # Put in the isotropic part in the other matrix: 
-            i_matrix_row[keep_ct2:keep_ct2+n_bvecs]=\
-                np.arange(v_idx*n_bvecs, (v_idx + 1)*n_bvecs)
-            i_matrix_col[keep_ct2:keep_ct2+n_bvecs]= v_idx * np.ones(n_bvecs)
-            i_matrix_sig[keep_ct2:keep_ct2+n_bvecs] = 1
-            keep_ct2 += n_bvecs
+        f_matrix_sig = []
+        f_matrix_row = []
+        f_matrix_col = []
+        n_fibers = 0
+        for batch in self.fiber_batches():
+            node_vox = self._node_voxels(batch)
+            node_sig = self._batch_signal(batch)
+            if self.mode == 'signal_attenuation':
+                node_sig = 1 - node_sig
+            node_sig -= vox_mean[node_vox][:, np.newaxis]
+            if ozf.NODE_WEIGHT in batch.node_stats:
+                # Nodes of compressed fibers stand for several nodes each:
+                node_sig *= batch.node_stats[ozf.NODE_WEIGHT][:, np.newaxis]
+
+            # Sum the signal from the nodes of each fiber in each voxel:
+            fv, fv_idx = np.unique(batch.fiber_index * n_vox + node_vox,
+                                   return_inverse=True)
+            node_order = np.argsort(fv_idx, kind='mergesort')
+            starts = np.searchsorted(fv_idx[node_order], np.arange(len(fv)))
+            pred_sig = np.add.reduceat(node_sig[node_order], starts, axis=0)
+
+            # For each fiber-voxel combination, we store the row/column
+            # indices and the signal:
+            f_matrix_row.append(((fv % n_vox)[:, np.newaxis] * n_bvecs +
+                                 np.arange(n_bvecs)).ravel())
+            f_matrix_col.append(np.repeat(fv // n_vox + n_fibers, n_bvecs))
+            f_matrix_sig.append(pred_sig.ravel())
+            n_fibers += len(batch)
+
             if self.verbose:
-                prog_bar.animate(v_idx, f_name=f_name)
-        
+                print("%s: processed %s fibers"%(f_name, n_fibers))
+
         # Allocate the sparse matrices, using the more memory-efficient 'csr'
         # format: 
-        fiber_matrix = sparse.coo_matrix((f_matrix_sig,
-                                       [f_matrix_row, f_matrix_col])).tocsr()
-        iso_matrix = sparse.coo_matrix((i_matrix_sig,
-                                       [i_matrix_row, i_matrix_col])).tocsr()
+        fiber_matrix = sparse.coo_matrix((np.concatenate(f_matrix_sig),
+                                          [np.concatenate(f_matrix_row),
+                                           np.concatenate(f_matrix_col)]),
+                                    shape=(n_vox * n_bvecs, n_fibers)).tocsr()
+
+        # The isotropic part has one weight for each voxel:
+        iso_matrix = sparse.coo_matrix((np.ones(n_vox * n_bvecs),
+                                        [np.arange(n_vox * n_bvecs),
+                                         np.repeat(np.arange(n_vox), n_bvecs)]),
+                                       shape=(n_vox * n_bvecs, n_vox)).tocsr()
 
         if self.verbose:
             print("Generated model matrices")
@@ -315,13 +398,18 @@ class FiberModel(BaseFiber):
     @desc.auto_attr
     def iso_weights(self):
         """
-        Get the weights using scipy.sparse.linalg or sklearn.linear_model.sparse
+        Get the weights for the isotropic part of the matrix
 
         """
+        if self.solver == 'nnls':
+            return onn.sparse_nnls(self.matrix[1],
+                                   self.voxel_signal.ravel(),
+                                   **self.solver_params)
 
         iso_w =sgd.stochastic_gradient_descent(self.voxel_signal.ravel(),
                                                self.matrix[1],
-                                               verbose=self.verbose)
+                                               verbose=self.verbose,
+                                               **self.solver_params)
         
         return iso_w
     
@@ -330,9 +418,16 @@ class FiberModel(BaseFiber):
         """
         Get the weights for the fiber part of the matrix
         """
+        if self.solver == 'nnls':
+            return onn.sparse_nnls(self.matrix[0],
+                                   self.voxel_signal_demeaned,
+                                   w0=self.fiber_weights0,
+                                   **self.solver_params)
+
         fiber_w = sgd.stochastic_gradient_descent(self.voxel_signal_demeaned,
                                                   self.matrix[0],
-                                                  verbose=self.verbose)
+                                                  verbose=self.verbose,
+                                                  **self.solver_params)
 
         return fiber_w
 
@@ -390,35 +485,89 @@ class FiberStatistic(BaseFiber):
                  data,
                  FG,
                  affine=None,
-                 mask=None):
+                 mask=None,
+                 batch_size=None,
+                 alpha=0.1,
+                 solver='ridge',
+                 tol=1e-8):
         """
         Parameters
         ----------
         
-        FG: a osmosis.fibers.FiberGroup object, or the name of a pdb file
-            containing the fibers to be read in using ozf.fg_from_pdb        
+        FG: a osmosis.fibers.FiberGroup object, or the name of a pdb or trk
+            file containing the fibers (see BaseFiber)
 
         data: array, or path to nifti
+
+        batch_size: The number of fibers to process at a time. Defaults to
+            all the fibers at once.
+
+        alpha: The weight of the L2 penalty on the parameters.
+
+        solver: 'ridge' for ridge regression with an intercept (solved with
+            LSQR) or 'nnls' for ridge regression with non-negative parameters
+            and no intercept (see `osmosis.nnls.sparse_nnls`).
+
+        tol: The tolerance of the solver.
         """
         # Initialize the super-class:
         BaseFiber.__init__(self,
 			   data,
 			   FG,
 			   affine=affine,
-			   mask=mask)
+			   mask=mask,
+                           batch_size=batch_size)
+        if solver not in ['ridge', 'nnls']:
+            raise ValueError("Solver %s is not supported"%solver)
+        self.alpha = alpha
+        self.solver = solver
+        self.tol = tol
 
     @desc.auto_attr
-    def design_matrix(self):
+    def fiber_matrix(self):
         """
-        The design matrix based on the fiber coordinates
+        The fiber part of the design matrix: a sparse (voxels by fibers)
+        matrix with 1 wherever a fiber passes through a voxel
         """
         v2f, v2fn = self.voxel2fiber
         # Binarize this sucker:
-        v2f = np.array(v2f, dtype=bool).astype(int)
-        # We add a column to account for non-fiber stuff: 
-        return np.hstack([v2f, np.eye(v2f.shape[0])])
+        v2f = v2f.tocsr()
+        v2f.data = np.ones(v2f.data.shape)
+        return v2f
+
+    @desc.auto_attr
+    def design_matrix(self):
+        """
+        The design matrix based on the fiber coordinates, as a sparse csr
+        matrix
+        """
+        n_vox = self.fiber_matrix.shape[0]
+        # We add a column to account for non-fiber stuff in each voxel: 
+        return sparse.hstack([self.fiber_matrix,
+                              sparse.identity(n_vox, format='csr')]).tocsr()
+
+    def _design_operator(self, x_mean=None):
+        """
+        The design matrix as a linear operator, with the identity part
+        applied implicitly and the columns optionally centered (by
+        subtracting x_mean)
+        """
+        F = self.fiber_matrix
+        n_vox, n_fibers = F.shape
+        if x_mean is None:
+            x_mean = np.zeros(n_fibers + n_vox)
+
+        def matvec(w):
+            w = np.ravel(w)
+            return F.dot(w[:n_fibers]) + w[n_fibers:] - np.dot(x_mean, w)
+
+        def rmatvec(r):
+            r = np.ravel(r)
+            return np.concatenate([F.T.dot(r), r]) - x_mean * np.sum(r)
+
+        return spla.LinearOperator((n_vox, n_fibers + n_vox), matvec=matvec,
+                                   rmatvec=rmatvec, dtype=float)
 
-    
     @desc.auto_attr
     def fiber_data(self):
         """
@@ -434,12 +583,41 @@ class FiberStatistic(BaseFiber):
         """
         The weights on the fibers calculated from the linear model
         """
-        # L = lm.ElasticNet(l1_ratio=0, alpha=0.005, positive=True)
-        # L = lm.ElasticNet(l1_ratio=0.01, alpha=0.0005)
-        L = lm.Ridge(alpha=0.1)
-        L.fit(self.design_matrix, self.fiber_data)
-        return L.coef_, L.intercept_
-        
+        n_vox, n_fibers = self.fiber_matrix.shape
+        y = np.reshape(self.fiber_data, (n_vox, -1)).astype(float)
+
+        coef = np.zeros((y.shape[-1], n_fibers + n_vox))
+        intercept = np.zeros(y.shape[-1])
+        if self.solver == 'ridge':
+            # The intercept is not penalized, so we fit to centered data and
+            # columns (the mean of each column is the proportion of voxels in
+            # it):
+            x_mean = np.concatenate([np.asarray(self.fiber_matrix.sum(0)
+                                                ).ravel(),
+                                     np.ones(n_vox)]) / float(n_vox)
+            op = self._design_operator(x_mean)
+            y_mean = np.mean(y, 0)
+            for t_idx in range(y.shape[-1]):
+                coef[t_idx] = spla.lsqr(op, y[:, t_idx] - y_mean[t_idx],
+                                        damp=np.sqrt(self.alpha),
+                                        atol=self.tol, btol=self.tol,
+                                        iter_lim=10 * (n_fibers + n_vox))[0]
+            intercept = y_mean - np.dot(coef, x_mean)
+
+        elif self.solver == 'nnls':
+            # The penalty goes in as additional rows of the matrix:
+            X = sparse.vstack([self.design_matrix,
+                               np.sqrt(self.alpha) *
+                               sparse.identity(n_fibers + n_vox)])
+            for t_idx in range(y.shape[-1]):
+                coef[t_idx] = onn.sparse_nnls(X,
+                                    np.concatenate([y[:, t_idx],
+                                                    np.zeros(n_fibers + n_vox)]),
+                                    tol=self.tol, max_iter=10000)
+
+        if len(np.shape(self.fiber_data)) == 1:
+            return coef[0], intercept[0]
+        return coef, intercept
 
     @desc.auto_attr
     def coef(self):
@@ -460,7 +638,7 @@ class FiberStatistic(BaseFiber):
         """
         Predict back the data based on the fiber weights
         """
-        return(self.coef.dot(self.design_matrix.T) + self.intercept)
+        return self.design_matrix.dot(self.coef.T) + self.intercept
 
         
 
@@ -3,11 +3,9 @@ Various functions for calculating various attributes of different isotropic
 models.
 """
 
-import scipy.optimize as opt
 import inspect
 import osmosis.utils as ozu
 import osmosis.model.dti as dti
-import osmosis.leastsqbound as lsq
 import numpy as np
 
 # rs within function names means relative signal
@@ -73,11 +71,7 @@ def decaying_exp_plus_const(b, c, D):
     The fitted diffusion signal in log form
     """
 
-    b_extra_dim = b[..., None]
-    this_sig = np.max(np.concatenate([b_extra_dim*D, c*np.ones((len(b),1))],
-                                                                     -1),-1)
-
-    return this_sig
+    return np.maximum(b*D, c)
 
 
 def two_decaying_exp(b, a, D1, D2):
@@ -101,11 +95,7 @@ def two_decaying_exp(b, a, D1, D2):
     The fitted diffusion signal in log form
     """
 
-    b_extra_dim = b[..., None]
-    this_sig = np.max(np.concatenate([b_extra_dim*D1, a + b_extra_dim*D2],
-                                                                   -1),-1)
-
-    return this_sig
+    return np.maximum(b*D1, a + b*D2)
 
 
 def two_decaying_exp_plus_const(b, a, c, D1, D2):
@@ -129,11 +119,7 @@ def two_decaying_exp_plus_const(b, a, c, D1, D2):
     The fitted diffusion signal in log form
     """
 
-    b_extra_dim = b[..., None]
-    this_sig = np.max(np.concatenate([b_extra_dim * D1, a + b_extra_dim * D2,
-                                          c*np.ones((len(b),1))],-1),-1)
-
-    return this_sig
+    return np.maximum(np.maximum(b*D1, a + b*D2), c)
 
 
 def single_exp_rs(b, D):
@@ -220,6 +206,299 @@ def bi_exp_nf_rs(b, nf, f1, D1, D2):
 
     return rel_sig
 
+
+# The Jacobians of the isotropic models: the derivatives of the model with
+# respect to each of its parameters (in the order of the inputs), stacked in
+# the first dimension. The parameters can be arrays that broadcast against b
+# (e.g. with shape (voxels, 1)), for fitting many voxels at once.
+
+def _stack_derivatives(*derivatives):
+    """
+    Broadcast the derivatives against each other and stack them in the first
+    dimension
+    """
+    return np.array(np.broadcast_arrays(*derivatives), dtype=float)
+
+
+def decaying_exp_jac(b, D):
+    """
+    Jacobian of `decaying_exp`
+    """
+    return _stack_derivatives(b + 0 * D)
+
+
+def decaying_exp_plus_const_jac(b, c, D):
+    """
+    Jacobian of `decaying_exp_plus_const`
+    """
+    # At a tie between the terms, these are the derivatives from the right
+    # (as forward differences would have them), so all the tied terms count:
+    m = decaying_exp_plus_const(b, c, D)
+    return _stack_derivatives((c >= m) * 1., (b*D >= m) * b)
+
+
+def two_decaying_exp_jac(b, a, D1, D2):
+    """
+    Jacobian of `two_decaying_exp`
+    """
+    m = two_decaying_exp(b, a, D1, D2)
+    second = a + b*D2 >= m
+    return _stack_derivatives(second * 1., (b*D1 >= m) * b, second * b)
+
+
+def two_decaying_exp_plus_const_jac(b, a, c, D1, D2):
+    """
+    Jacobian of `two_decaying_exp_plus_const`
+    """
+    m = two_decaying_exp_plus_const(b, a, c, D1, D2)
+    second = a + b*D2 >= m
+    return _stack_derivatives(second * 1., (c >= m) * 1., (b*D1 >= m) * b,
+                              second * b)
+
+
+def single_exp_rs_jac(b, D):
+    """
+    Jacobian of `single_exp_rs`
+    """
+    return _stack_derivatives(-b * np.exp(-b * D))
+
+
+def single_exp_nf_rs_jac(b, nf, D):
+    """
+    Jacobian of `single_exp_nf_rs`
+    """
+    e = np.exp(-b*D)
+    return _stack_derivatives(1 - e, -(1-nf) * b * e)
+
+
+def bi_exp_rs_jac(b, f1, D1, D2):
+    """
+    Jacobian of `bi_exp_rs`
+    """
+    e1 = np.exp(-b*D1)
+    e2 = np.exp(-b*D2)
+    return _stack_derivatives(e1 - e2, -f1 * b * e1, -(1-f1) * b * e2)
+
+
+def bi_exp_nf_rs_jac(b, nf, f1, D1, D2):
+    """
+    Jacobian of `bi_exp_nf_rs`
+    """
+    e1 = np.exp(-b*D1)
+    e2 = np.exp(-b*D2)
+    return _stack_derivatives(np.ones(e1.shape), e1 - e2, -f1 * b * e1,
+                              -(1-f1) * b * e2)
+
+
+def _numerical_jac(func):
+    """
+    A forward-difference Jacobian, for models with no analytic one
+    """
+    def jac(b, *params):
+        f0 = func(b, *params)
+        derivatives = []
+        for ii, p in enumerate(params):
+            step = np.sqrt(np.finfo(float).eps) * np.maximum(np.abs(p), 1)
+            new_params = list(params)
+            new_params[ii] = p + step
+            derivatives.append((func(b, *new_params) - f0) / step)
+        return _stack_derivatives(*derivatives)
+    return jac
+
+
+def model_jacobian(func):
+    """
+    The Jacobian of an isotropic model
+
+    Parameters
+    ----------
+    func: str or callable
+        Isotropic model
+
+    Returns
+    -------
+    jac: callable
+        A function with the same inputs as `func`, returning the derivatives
+        of `func` with respect to each parameter in the first dimension. For
+        models not defined in this module, the derivatives are approximated
+        by forward differences.
+    """
+    if isinstance(func, str):
+        func = globals()[func]
+    jac = globals().get(func.__name__ + '_jac')
+    if jac is None or globals().get(func.__name__) is not func:
+        return _numerical_jac(func)
+    return jac
+
+
+def leastsq_flat(func, b, s_prime, initial, bounds=None, jac=None,
+                 max_iter=200, ftol=1.49012e-08, xtol=1.49012e-08):
+    """
+    Bounded non-linear least squares fit of an isotropic model in many voxels
+    at once.
+
+    This is a Levenberg-Marquardt solver, in which all the voxels take their
+    steps together. Steps are projected onto the bounds, and parameters at a
+    bound that the gradient pushes out of the bounds are held fixed.
+
+    Parameters
+    ----------
+    func: callable
+        The isotropic model, with inputs `(b, *params)`
+    b: 1 dimensional array
+        An independent variable (b-values)
+    s_prime: 2 dimensional array
+        The dependent variable, with shape (voxels, len(b))
+    initial: 1 or 2 dimensional array
+        Initial values of the parameters. Either one set for all the voxels,
+        or an array with one row for each voxel.
+    bounds: list, optional
+        List containing tuples indicating the bounds for each parameter (None
+        for no bound). If None, the fit is unconstrained.
+    jac: callable, optional
+        The Jacobian of `func`. Defaults to `model_jacobian(func)`.
+    max_iter: int
+        Maximal number of iterations
+    ftol: float
+        A voxel has converged when a step decreases its sum of squared errors
+        by less than ftol (relative to it). The default is the same as in
+        scipy.optimize.leastsq.
+    xtol: float
+        A voxel has converged when a step changes its parameters by less
+        than xtol (relative to them).
+
+    Returns
+    -------
+    params: 2 dimensional array
+        The parameters in each voxel, with shape (voxels, parameters)
+
+    Notes
+    -----
+    The models depend on the measurements only through b, so the sum of
+    squared errors over all the measurements is a constant plus the sum of
+    squared errors of the mean signal in each unique b value, weighted by the
+    number of measurements with that b value. The fit minimizes the latter,
+    which needs far fewer model evaluations when b values repeat.
+    """
+    if jac is None:
+        jac = model_jacobian(func)
+    s_prime = np.asarray(s_prime, dtype=float)
+    n_vox = s_prime.shape[0]
+    initial = np.asarray(initial, dtype=float)
+    params = (np.atleast_1d(initial) * np.ones((n_vox, 1))).copy()
+    n_params = params.shape[-1]
+
+    lower = -np.inf * np.ones(n_params)
+    upper = np.inf * np.ones(n_params)
+    if bounds is not None:
+        for ii, (lo, hi) in enumerate(bounds):
+            if lo is not None:
+                lower[ii] = lo
+            if hi is not None:
+                upper[ii] = hi
+    params = np.clip(params, lower, upper)
+
+    # The mean signal in each unique b value:
+    b_unique, b_inverse, b_counts = np.unique(b, return_inverse=True,
+                                              return_counts=True)
+    b_mean = np.zeros((len(b_inverse), len(b_unique)))
+    b_mean[np.arange(len(b_inverse)), b_inverse] = 1. / b_counts[b_inverse]
+    weights = np.sqrt(b_counts)
+
+    # The voxels that are still being fit, and their data:
+    active = np.arange(n_vox)
+    y = np.dot(s_prime, b_mean) * weights
+
+    def residuals(p):
+        return y - weights * func(b_unique, *p.T[..., None])
+
+    eye = np.eye(n_params)
+    damping = 1e-3 * np.ones(n_vox)
+    r = residuals(params)
+    cost = np.sum(r ** 2, -1)
+    for iteration in xrange(max_iter):
+        if len(active) == 0:
+            break
+        p = params[active]
+        J = jac(b_unique, *p.T[..., None]) * weights
+        # The gradient (of the negative cost) and the Gauss-Newton Hessian:
+        g = np.sum(J * r, -1).T
+        JtJ = np.empty((len(active), n_params, n_params))
+        for ii in xrange(n_params):
+            for jj in xrange(ii + 1):
+                JtJ[:, ii, jj] = JtJ[:, jj, ii] = np.sum(J[ii] * J[jj], -1)
+        # Hold fixed the parameters pushed out of the bounds:
+        fixed = ((p <= lower) & (g < 0)) | ((p >= upper) & (g > 0))
+        free = (~fixed).astype(float)
+        JtJ = JtJ * free[:, :, None] * free[:, None, :] + eye * fixed[:, None]
+        g = g * free
+        diag = np.einsum('vii->vi', JtJ)
+        damped = damping[active, None] * np.maximum(diag, 1e-12)
+        step = np.linalg.solve(JtJ + damped[..., None] * eye,
+                               g[..., None])[..., 0]
+        p_new = np.clip(p + step, lower, upper)
+        r_new = residuals(p_new)
+        cost_new = np.sum(r_new ** 2, -1)
+
+        better = cost_new < cost[active]
+        # Accept the steps that decrease the cost, and damp the others more:
+        improved = active[better]
+        converged = ((cost[improved] - cost_new[better] <=
+                      ftol * cost[improved]) |
+                     np.all(np.abs(p_new[better] - p[better]) <=
+                            xtol * (np.abs(p[better]) + xtol), -1))
+        params[improved] = p_new[better]
+        cost[improved] = cost_new[better]
+        damping[improved] = np.maximum(damping[improved] / 10, 1e-12)
+        damping[active[~better]] *= 10
+        r[better] = r_new[better]
+
+        # Steps that don't decrease the cost with very large damping are too
+        # small to matter:
+        still = np.ones(len(active), dtype=bool)
+        still[np.where(better)[0][converged]] = False
+        still[~better] = damping[active[~better]] < 1e10
+        if not np.all(still):
+            active = active[still]
+            y = y[still]
+            r = r[still]
+
+    return params
+
+def preset_bounds(model):
+    """
+    The bounds used for fitting each of the isotropic models to the relative
+    diffusion signal.
+
+    Parameters
+    ----------
+    model: str or callable
+        Isotropic model
+
+    Returns
+    -------
+    bounds: list
+        A list containing the bounds for each parameter for least squares
+        fitting.
+    """
+    if isinstance(model, str):
+        # Grab the function handle for the desired mean model
+        model = globals()[model]
+
+    if model == single_exp_rs:
+        bounds = [(0, 4)]
+    elif model == single_exp_nf_rs:
+        bounds = [(0, 10000), (0, 4)]
+    elif model == bi_exp_rs:
+        bounds = [(0, 1), (0, 4), (0, 4)]
+    elif model == bi_exp_nf_rs:
+        bounds = [(0, 10000), (0, 1), (0, 4), (0, 4)]
+    else:
+        e_s = "No preset bounds for the isotropic model %s"%model.__name__
+        raise ValueError(e_s)
+
+    return bounds
+
 def initial_params(data, bvecs, bvals, model, mask=None, params_file='temp'):
     """
     Determine the initial values for fitting the isotropic diffusion model.
@@ -245,10 +524,16 @@ def initial_params(data, bvecs, bvals, model, mask=None, params_file='temp'):
     bounds: list
         A list containing the bounds for each parameter for least squares
         fitting.
-    initial: list
-        A list containing the initial values for each parameter for least
-        squares fitting.
+    initial: 2 dimensional array
+        The initial values for each parameter for least squares fitting, in
+        each voxel.
     """
+    if isinstance(model, str):
+        # Grab the function handle for the desired mean model
+        model = globals()[model]
+
+    bounds = preset_bounds(model)
+
     dti_mod = dti.TensorModel(data, bvecs, bvals, mask=mask,
                               params_file=params_file)
 
@@ -260,25 +545,87 @@ def initial_params(data, bvecs, bvals, model, mask=None, params_file='temp'):
     #nf = np.std(b0_data, -1)/np.mean(b0_data, -1)
     nf = np.min(data[np.where(mask)], -1)
     if model == single_exp_rs:
-        bounds = [(0, 4)]
-        initial = d
+        initial = d[..., None]
 
     elif model == single_exp_nf_rs:
-        bounds = [(0, 10000), (0, 4)]
         initial = np.concatenate([nf[..., None],
                                    np.ones(d[...,None].shape)], -1)
 
+    # The two diffusivities start apart from each other, because fits with
+    # analytic derivatives can't separate them from the same starting point:
     elif model== bi_exp_rs:
-        bounds = [(0, 1), (0, 4), (0, 4)]
-        initial = np.concatenate([0.5*np.ones((len(d),1)), d[...,None],
-                                                      d[...,None]], -1)
+        initial = np.concatenate([0.5*np.ones((len(d),1)), 1.1*d[...,None],
+                                                      0.9*d[...,None]], -1)
     elif model== bi_exp_nf_rs:
-        bounds = [(0, 10000), (0, 1), (0, 4), (0, 4)]
         initial = np.concatenate([nf[..., None], 0.5*np.ones((len(d),1)),
-                                           d[...,None], d[...,None]], -1)
+                                   1.1*d[...,None], 0.9*d[...,None]], -1)
     return bounds, initial
 
 
+def fit_flat(flat_data, b, b0_inds, all_b_idx, func, initial, bounds=None,
+             signal="relative_signal", block_size=10000):
+    """
+    Fit an isotropic model in each voxel of data that was already masked and
+    flattened.
+
+    Parameters
+    ----------
+    flat_data: 2 dimensional array
+        Diffusion data with shape (voxels, volumes)
+    b: 1 dimensional array
+        The (scaled) b values of the volumes in all_b_idx
+    b0_inds: 1 dimensional array
+        Indices into the volumes with b = 0
+    all_b_idx: 1 dimensional array
+        Indices into the diffusion-weighted volumes to fit to
+    func: callable
+        The isotropic model
+    initial: 1 or 2 dimensional array
+        Initial values of the parameters. Either one set for all the voxels,
+        or an array with one row for each voxel (e.g. parameters from a
+        previous fit, used as warm starts).
+    bounds: list, optional
+        List containing tuples indicating the bounds for each parameter. If
+        None, the fit is unconstrained.
+    signal: str
+        "relative_signal" to fit to S/S0 or "log" to fit to log(S/S0)
+    block_size: int
+        The number of voxels fit together (see `leastsq_flat`)
+
+    Returns
+    -------
+    param_out: 2 dimensional array
+        Parameters that minimize the residuals in each voxel
+    fit_out: 2 dimensional array
+        The model fit to the signal in each voxel
+    """
+    n_vox = flat_data.shape[0]
+    initial = np.asarray(initial, dtype=float)
+    per_voxel = len(initial.shape) == 2
+
+    # Pre-allocate the outputs:
+    param_out = np.zeros((n_vox, len(inspect.getargspec(func)[0]) - 1))
+    fit_out = ozu.nans((n_vox, len(b)))
+
+    for start in xrange(0, n_vox, block_size):
+        block = slice(start, min(start + block_size, n_vox))
+        s0 = np.mean(flat_data[block][:, b0_inds], -1)
+        input_signal = flat_data[block][:, all_b_idx]/s0[:, None]
+        if signal == "log":
+            input_signal = np.log(input_signal)
+
+        if per_voxel:
+            this_initial = initial[block]
+        else:
+            this_initial = initial
+
+        param_out[block] = leastsq_flat(func, b, input_signal, this_initial,
+                                        bounds=bounds)
+        fit_out[block] = func(b, *param_out[block].T[..., None])
+
+    return param_out, fit_out
+
+
 def _diffusion_inds(bvals, b_inds, rounded_bvals):
     """
     Extracts the diffusion-weighted and non-diffusion weighted indices.
@@ -317,7 +664,7 @@ def _diffusion_inds(bvals, b_inds, rounded_bvals):
 
 def isotropic_params(data, bvals, bvecs, mask, func, factor=1000,
                        initial="preset", bounds="preset", params_file='temp',
-                       signal="relative_signal"):
+                       signal="relative_signal", block_size=10000):
     """
     Finds the parameters of the given function to the given data
     that minimizes the sum squared errors.
@@ -340,6 +687,8 @@ def isotropic_params(data, bvals, bvecs, mask, func, factor=1000,
     bounds: list
         List containing tuples indicating the bounds for each parameter in
         the mean model function.
+    block_size: int
+        The number of voxels fit together (see `leastsq_flat`)
 
     Returns
     -------
@@ -347,24 +696,23 @@ def isotropic_params(data, bvals, bvecs, mask, func, factor=1000,
         Parameters that minimize the residuals
     fit_out: 2 dimensional array
         Model fitted means
-    ss_err: 2 dimensional array
-        Sum squared error between the model fitted means and the actual means
+    cod: 1 dimensional array
+        Coefficient of determination between the model fitted means and the
+        actual means
     """
     if isinstance(func, str):
         # Grab the function handle for the desired mean model
         func = globals()[func]
-    
 
     # Get the initial values for the desired mean model
-    if (bounds == "preset") | (initial == "preset"):
+    preset_initial = isinstance(initial, str) and initial == "preset"
+    if (isinstance(bounds, str) and bounds == "preset") or preset_initial:
         all_params = initial_params(data, bvecs, bvals, func, mask=mask,
                                     params_file=params_file)
-    if bounds == "preset":
-        bounds = all_params[0]
-    if initial == "preset":
-        func_initial = all_params[1]
-    else:
-        this_initial = initial
+        if isinstance(bounds, str):
+            bounds = all_params[0]
+        if preset_initial:
+            initial = all_params[1]
 
     # Separate b values and grab their indices
     bval_list, b_inds, unique_b, rounded_bvals = ozu.separate_bvals(bvals)
@@ -374,45 +722,21 @@ def isotropic_params(data, bvals, bvecs, mask, func, factor=1000,
     b = bvals[all_b_idx]/factor
     flat_data = data[np.where(mask)]
 
-    # Get the number of inputs to the mean diffusivity function
-    param_num = len(inspect.getargspec(func)[0])
-
-    # Pre-allocate the outputs:
-    param_out = np.zeros((int(np.sum(mask)), param_num - 1))
-    cod = ozu.nans(np.sum(mask))
-    fit_out = ozu.nans(cod.shape + (len(all_b_idx),))
-
-    prog_bar = ozu.ProgressBar(flat_data.shape[0])
-
-    for vox in np.arange(np.sum(mask)).astype(int):
-        prog_bar.animate(vox)
-        s0 = np.mean(flat_data[vox, b0_inds], -1)
+    param_out, fit_out = fit_flat(flat_data, b, b0_inds, all_b_idx, func,
+                                  initial, bounds=bounds, signal=signal,
+                                  block_size=block_size)
 
-        if initial == "preset":
-            this_initial = func_initial[vox]
-
-        input_signal = flat_data[vox, all_b_idx]/s0
-        if signal == "log":
-            input_signal = np.log(input_signal)
+    s0 = np.mean(flat_data[:, b0_inds], -1)
+    input_signal = flat_data[:, all_b_idx]/s0[..., None]
+    if signal == "log":
+        input_signal = np.log(input_signal)
+    cod = ozu.coeff_of_determination(input_signal, fit_out, axis=-1)
 
-        if bounds == None:
-            params, _ = opt.leastsq(err_func, this_initial, args=(b,
-                                                input_signal, func))
-        else:
-            lsq_b_out = lsq.leastsqbound(err_func, this_initial,
-                                         args=(b, input_signal, func),
-                                         bounds = bounds)
-            params = lsq_b_out[0]
-
-        param_out[vox] = np.squeeze(params)
-        fit_out[vox] = func(b, *params)
-        cod[vox] = ozu.coeff_of_determination(input_signal, fit_out[vox])
-        
     return param_out, fit_out, cod
 
 def kfold_xval_MD_mod(data, bvals, bvecs, mask, func, n, factor = 1000,
                       initial="preset", bounds = "preset", params_file='temp',
-                      signal="relative_signal"):
+                      signal="relative_signal", block_size=10000):
     """
     Finds the parameters of the given function to the given data
     that minimizes the sum squared errors using kfold cross validation.
@@ -438,6 +762,8 @@ def kfold_xval_MD_mod(data, bvals, bvecs, mask, func, n, factor = 1000,
     bounds: list
         List containing tuples indicating the bounds for each parameter in
         the mean model function.
+    block_size: int
+        The number of voxels fit together (see `leastsq_flat`)
 
     Returns
     -------
@@ -451,15 +777,14 @@ def kfold_xval_MD_mod(data, bvals, bvecs, mask, func, n, factor = 1000,
         func = globals()[func]
 
     # Get the initial values for the desired isotropic model
-    if (bounds == "preset") | (initial == "preset"):
+    preset_initial = isinstance(initial, str) and initial == "preset"
+    if (isinstance(bounds, str) and bounds == "preset") or preset_initial:
         all_params = initial_params(data, bvecs, bvals, func, mask=mask,
                                     params_file=params_file)
-        if bounds == "preset":
+        if isinstance(bounds, str):
             bounds = all_params[0]
-        if initial == "preset":
-            func_initial = all_params[1]
-    else:
-        this_initial = initial
+        if preset_initial:
+            initial = all_params[1]
 
     bval_list, b_inds, unique_b, rounded_bvals = ozu.separate_bvals(bvals)
     all_b_idx, b0_inds = _diffusion_inds(bvals, b_inds, rounded_bvals)
@@ -468,8 +793,7 @@ def kfold_xval_MD_mod(data, bvals, bvecs, mask, func, n, factor = 1000,
     flat_data = data[np.where(mask)]
 
     # Pre-allocate outputs
-    ss_err = np.zeros(int(np.sum(mask)))
-    predict_out = np.zeros((int(np.sum(mask)),len(all_b_idx)))
+    predict_out = np.zeros((flat_data.shape[0], len(all_b_idx)))
 
     # Setting up for creating combinations of directions for kfold cross
     # validation:
@@ -480,45 +804,23 @@ def kfold_xval_MD_mod(data, bvals, bvecs, mask, func, n, factor = 1000,
     # Find the indices to all the non-b = 0 directions and shuffle them.
     vec_pool = np.arange(len(all_b_idx))
     np.random.shuffle(vec_pool)
-    all_inc_0 = np.arange(len(rounded_bvals))
 
     # Start cross-validation
     for combo_num in np.arange(np.floor(100./n)):
+        # Only the indices are needed here, so don't copy the data:
         (si, vec_combo, vec_combo_rm0,
-         vec_pool_inds, these_bvecs, these_bvals,
-         this_data, these_inc0) = ozu.create_combos(bvecs, bvals, data,
-                                                    all_b_idx,
-                                                    np.arange(len(all_b_idx)),
-                                                    all_b_idx, vec_pool,
-                                                    num_choose, combo_num)
-
-        these_b = b_scaled[vec_combo] # b values to predict
-        for vox in np.arange(np.sum(mask)).astype(int):
-            s0 = np.mean(flat_data[vox, b0_inds], -1)
-
-            if initial == "preset":
-                this_initial = func_initial[vox]
-
-            input_signal = flat_data[vox, these_inc0]/s0
-
-            if signal == "log":
-                input_signal = np.log(input_signal)
-
-            # Fit mean model to part of the data
-            params, _ = opt.leastsq(err_func, this_initial,
-                                    args=(b_scaled[these_inc0],
-                                    input_signal, func))
-            if bounds == None:
-                params, _ = opt.leastsq(err_func, this_initial,
-                                        args=(b_scaled[these_inc0],
-                                        input_signal, func))
-            else:
-                lsq_b_out = lsq.leastsqbound(err_func, this_initial,
-                                             args = (b_scaled[these_inc0],
-                                                     input_signal, func),
-                                             bounds = bounds)
-                params = lsq_b_out[0]
-            predict_out[vox, vec_combo_rm0] = func(these_b, *params)
+         vec_pool_inds, these_inc0) = ozu.fold_indices(all_b_idx,
+                                                       np.arange(len(all_b_idx)),
+                                                       all_b_idx, vec_pool,
+                                                       num_choose, combo_num)
+
+        # Fit mean model to part of the data, in all the voxels:
+        params, _ = fit_flat(flat_data, b_scaled[these_inc0], b0_inds,
+                             these_inc0, func, initial, bounds=bounds,
+                             signal=signal, block_size=block_size)
+        # And predict the rest:
+        predict_out[:, vec_combo_rm0] = func(b_scaled[vec_combo],
+                                             *params.T[..., None])
 
     # Find the relative diffusion signal.
     s0 = np.mean(flat_data[:, b0_inds], -1).astype(float)
@@ -862,18 +862,18 @@ class SparseDeconvolutionModelMultiB(SparseDeconvolutionModel):
         self.initial_orig = initial
         self.bounds_orig = bounds
         
-        # Get rid of places 
-        # Get restraints and initial values for fitting the mean model
-        if (bounds == "preset") | (initial == "preset"):
-            all_params = mdm.initial_params(data, bvecs, bvals, self.func_str, mask=self.mask,
-                                            params_file="temp")
-        if bounds == "preset":
-            self.bounds = all_params[0]
+        # Get restraints and initial values for fitting the mean model. The
+        # initial values can also be provided for each voxel, as a voxels by
+        # parameters array (e.g. from a previous fit to similar data):
+        if isinstance(bounds, str) and bounds == "preset":
+            self.bounds = mdm.preset_bounds(self.func_str)
         else:
             self.bounds = bounds
             
-        if initial == "preset":
-            self.initial = all_params[1]
+        if isinstance(initial, str) and initial == "preset":
+            self.initial = mdm.initial_params(data, bvecs, bvals,
+                                              self.func_str, mask=self.mask,
+                                              params_file="temp")[1]
         else:
             self.initial = initial
             
@@ -1114,39 +1114,13 @@ class SparseDeconvolutionModelMultiB(SparseDeconvolutionModel):
         params_out: 2 dimensional array
             Parameters for the mean model at each voxel
         """
-        flat_data = self.data[np.where(self.mask)]
-        
-        param_num = len(inspect.getargspec(self.func)[0])-1
-        params_out = np.zeros((int(np.sum(self.mask)), param_num))
-        sig_out = ozu.nans((int(np.sum(self.mask)),) + (len(self.all_b_idx),))
-        
-        for vox in np.arange(np.sum(self.mask)).astype(int):
-            s0 = np.mean(flat_data[vox, self.b0_inds], -1)
-            
-            if self.mm_signal == "log":
-                input_sig = np.log(flat_data[vox, self.all_b_idx]/s0)
-            elif self.mm_signal == "relative_signal":
-                input_sig = flat_data[vox, self.all_b_idx]/s0
-            
-            if self.initial_orig == "preset":
-                this_initial = self.initial[vox]
-            else:
-                this_initial = self.initial
-            
-            if self.bounds == None:
-                params, _ = opt.leastsq(mdm.err_func, this_initial,
-                                        args=(bvals, input_sig, self.func))
-            else:
-                lsq_b_out = lsq.leastsqbound(mdm.err_func, this_initial,
-                                           args=(bvals, input_sig, self.func),
-                                                    bounds = self.bounds)
-                params = lsq_b_out[0] 
-            params_out[vox] = np.squeeze(params)
-            
-            if self.mm_signal == "log":
-                sig_out[vox] = np.exp(self.func(bvals, *params))
-            elif self.mm_signal == "relative_signal":
-                sig_out[vox] = self.func(bvals, *params)
+        params_out, sig_out = mdm.fit_flat(self._flat_data, bvals,
+                                           self.b0_inds, self.all_b_idx,
+                                           self.func, self.initial,
+                                           bounds=self.bounds,
+                                           signal=self.mm_signal)
+        if self.mm_signal == "log":
+            sig_out = np.exp(sig_out)
 
         return sig_out, params_out
         
@@ -1428,7 +1402,7 @@ class SparseDeconvolutionModelMultiB(SparseDeconvolutionModel):
             # It doesn't matter what's in the last dimension since we only care
             # about the first 3.  Thus, just pick the array of signals from them
             # first b value.
-            out_params = ozu.nans(self.signal.shape[:3] + (design_matrix.shape[-1],))
+            out_params = ozu.nans(self.signal.shape[:-1] + (design_matrix.shape[-1],))
             
             out_params[self.mask] = params
             # Save the params to a file: 
@@ -1487,7 +1461,7 @@ class SparseDeconvolutionModelMultiB(SparseDeconvolutionModel):
 
             out_flat_arr[vox] = this_pred_sig
             
-        out = ozu.nans((self.signal.shape[:3] + 
+        out = ozu.nans((self.signal.shape[:-1] + 
                          (design_matrix.shape[-1],)))
         out[self.mask] = out_flat_arr
 
@@ -1607,7 +1581,7 @@ class SparseDeconvolutionModelMultiB(SparseDeconvolutionModel):
                 
             out_flat_arr[vox] = this_pred_sig
         
-        out = ozu.nans(self.data.shape[:3] + (out_flat_arr.shape[-1],))
+        out = ozu.nans(self.data.shape[:-1] + (out_flat_arr.shape[-1],))
         out[self.mask] = out_flat_arr
         
         return out
@@ -7,7 +7,10 @@ import numpy.testing as npt
 
 import osmosis as oz
 import osmosis.utils as ozu
-from osmosis.model.dti import TensorModel, tensor_coherence, tensor_dispersion
+import osmosis.tensor as ozt
+from osmosis.model.dti import (TensorModel, tensor_coherence,
+                               tensor_dispersion, tensor_bootstrap)
+import osmosis.model.dti as dti
 
 data_path = os.path.split(oz.__file__)[0] + '/data/'
 
@@ -794,3 +797,114 @@ def test_predict():
 
     # Then verify that the prediction is equal to the fit in these directions:
     npt.assert_array_almost_equal(prediction, TM1.fit[...,:4])
+
+
+def _synthetic_tensor_data(prng, l1_offset=0):
+    """
+    Noiseless signal of random tensors in a (4, 5, 3) volume, measured in 30
+    random directions with b=1000, and in 2 b=0 volumes with signal 1000.
+    l1_offset is added to the largest eigen-value of all the tensors.
+
+    Returns data, bvecs, bvals, the (voxels, 3, 3) tensors and the
+    (voxels, 30) diffusion-weighted signal.
+    """
+    bvecs = prng.randn(3, 30)
+    bvecs = np.hstack([np.zeros((3, 2)),
+                       bvecs / np.sqrt(np.sum(bvecs ** 2, 0))])
+    bvals = np.array([0, 0] + [1000] * 30)
+    shape = (4, 5, 3)
+    n_vox = np.prod(shape)
+    # Random tensors, with eigen-values in descending order:
+    Q = np.array([np.linalg.qr(prng.randn(3, 3))[0] for ii in range(n_vox)])
+    L = np.sort(prng.rand(n_vox, 3) * 2 + 0.2, -1)[:, ::-1]
+    L[:, 0] += l1_offset
+    D = np.array([np.dot(Q[ii] * L[ii], Q[ii].T) for ii in range(n_vox)])
+    # The model scales the b values to 1:
+    sig = np.array([ozt.Tensor(D[ii], bvecs[:, 2:],
+                               bvals[2:] / 1000.).predicted_signal(1000)
+                    for ii in range(n_vox)])
+    data = np.hstack([1000 * np.ones((n_vox, 2)), sig]).reshape(shape + (32,))
+    return data, bvecs, bvals, D, sig
+
+
+def test_TensorModel_blocks():
+    """
+    Test that fitting and predicting over blocks of voxels gives the same
+    results as the per-voxel tensor calculations
+    """
+    prng = np.random.RandomState(2047)
+    data, bvecs, bvals, D, sig = _synthetic_tensor_data(prng)
+    shape = data.shape[:3]
+    mask = prng.rand(*shape) > 0.3
+
+    for block_size in [1, 7, 10000]:
+        TM = TensorModel(data, bvecs, bvals, mask=mask, params_file='temp',
+                         block_size=block_size, verbose=False)
+        npt.assert_almost_equal(TM.tensors[mask],
+                                D.reshape(shape + (3, 3))[mask], decimal=4)
+        npt.assert_almost_equal(TM.fit[mask] / 1000.,
+                                sig[mask.ravel()] / 1000., decimal=4)
+        npt.assert_almost_equal(TM.predict(bvecs[:, 2:6])[mask],
+                                TM.fit[mask][:, :4])
+        for vox, Q_vox in enumerate(TM.tensors[mask]):
+            npt.assert_almost_equal(TM.model_adc[mask][vox],
+                            ozt.apparent_diffusion_coef(bvecs[:, 2:], Q_vox))
+            npt.assert_almost_equal(TM.model_diffusion_distance[mask][vox],
+                            ozt.diffusion_distance(bvecs[:, 2:], Q_vox))
+
+
+def test_tensor_bootstrap():
+    """
+    Test the batched tensor fit and the bootstrap of the dyad statistics
+    """
+    import dipy.reconst.dti as dipy_dti
+    prng = np.random.RandomState(2048)
+    # A clear principal direction in each voxel:
+    data, bvecs, bvals, _, _ = _synthetic_tensor_data(prng, l1_offset=1)
+    shape = data.shape[:3]
+    noisy = data + prng.randn(*data.shape) * 20
+
+    # The batched fit is the same as dipy's:
+    TM = TensorModel(noisy, bvecs, bvals, params_file='temp', verbose=False)
+    design = dipy_dti.design_matrix(TM.gtab)
+    for fit_method, dipy_fit in [('WLS', dipy_dti.wls_fit_tensor),
+                                 ('LS', dipy_dti.ols_fit_tensor)]:
+        params = dti._fit_log_tensors(design, np.log(TM._flat_data),
+                                      fit_method)
+        evals, evecs = dti._decompose_tensors(params)
+        dipy_params = dipy_fit(design, TM._flat_data)
+        dipy_evecs = dipy_params[:, 3:].reshape(-1, 3, 3)
+        npt.assert_almost_equal(evals, dipy_params[:, :3])
+        # The principal directions are the same, up to their sign:
+        npt.assert_almost_equal(
+            np.abs(np.sum(evecs[..., 0] * dipy_evecs[..., 0], -1)), 1)
+    npt.assert_equal(dti._fit_log_tensors(design, np.log(TM._flat_data),
+                                          'OLS'), params)
+    npt.assert_raises(ValueError, dti._fit_log_tensors, design,
+                      np.log(TM._flat_data), 'NNLS')
+
+    # Without noise, all the samples are the same:
+    for method in ['wild', 'residual', 'subsample']:
+        coherence, dispersion = tensor_bootstrap(data, bvecs, bvals,
+                                                 n_samples=20, method=method,
+                                                 n_dirs=12, block_size=7,
+                                                 verbose=False, seed=1)
+        npt.assert_almost_equal(coherence, np.ones(shape), decimal=5)
+        npt.assert_almost_equal(dispersion, np.zeros(shape), decimal=3)
+
+    # With noise, the principal directions vary:
+    mask = np.zeros(shape, dtype=bool)
+    mask[:2] = True
+    for method, this_data in [('wild', noisy), ('residual', noisy),
+                              ('repetition', [noisy, data +
+                                              prng.randn(*data.shape) * 20])]:
+        coherence, dispersion = tensor_bootstrap(this_data, bvecs, bvals,
+                                                 n_samples=50, method=method,
+                                                 mask=mask, verbose=False,
+                                                 seed=1)
+        npt.assert_(np.all(coherence[mask] < 1))
+        npt.assert_(np.all(dispersion[mask] > 0))
+        npt.assert_(np.all(np.isnan(coherence[~mask])))
+
+    npt.assert_raises(ValueError, tensor_bootstrap, data, bvecs, bvals,
+                      method='subsample')
@@ -1,11 +1,15 @@
 import os
+import tempfile
 
 import numpy as np
 import numpy.testing as npt
+import scipy.optimize as opt
+import sklearn.linear_model as lm
 
 import osmosis as oz
 import osmosis.io as mio
-from osmosis.model.fiber import FiberModel
+import osmosis.fibers as ozf
+from osmosis.model.fiber import FiberModel, FiberStatistic
 
 data_path = os.path.split(oz.__file__)[0] + '/data/'
 
@@ -31,3 +35,199 @@ def test_FiberModel():
 
     npt.assert_equal(M.matrix[1].shape[0], np.prod(M.voxel_signal.shape))
     npt.assert_equal(M.matrix[1].shape[-1], len(M.fg_idx_unique.T))
+
+
+def _random_dwi(prng, shape, n_dirs):
+    """
+    Random diffusion data in a volume of the given shape, with 2 b=0 volumes
+    (with signal 1000) and n_dirs random directions with b=1000
+
+    Returns data, bvecs, bvals
+    """
+    bvals = np.array([0, 0] + [1000] * n_dirs)
+    bvecs = np.hstack([np.zeros((3, 2)), prng.randn(3, n_dirs)])
+    bvecs[:, 2:] = bvecs[:, 2:] / np.sqrt(np.sum(bvecs[:, 2:] ** 2, 0))
+    data = prng.rand(*(shape + (n_dirs + 2,))) * 100 + 100
+    data[..., :2] = 1000
+    return data, bvecs, bvals
+
+
+def test_FiberModel_batches():
+    """
+    Test that the model matrix is the same when the fibers are processed in
+    batches and when they are streamed from a file
+    """
+    prng = np.random.RandomState(2013)
+    data, bvecs, bvals = _random_dwi(prng, (4, 4, 4), 6)
+
+    fibers = []
+    for ii in range(5):
+        # Make the nodes go through the voxels at a bunch of angles, with two
+        # of them sometimes in the same voxel:
+        start = prng.rand(3) * 2
+        fibers.append(ozf.Fiber(start[:, None] +
+                                np.outer(prng.rand(3), np.arange(4) * 0.6)))
+    FG = ozf.FiberGroup(fibers)
+
+    M = FiberModel(data, bvecs, bvals, FG)
+    fiber_matrix, iso_matrix = M.matrix
+    n_vox = M.fg_idx_unique.shape[-1]
+    npt.assert_equal(fiber_matrix.shape, (n_vox * 6, len(fibers)))
+    npt.assert_equal(iso_matrix.shape, (n_vox * 6, n_vox))
+
+    # Sum the demeaned signal over the nodes, one node at a time:
+    expected = np.zeros((n_vox * 6, len(fibers)))
+    for f_idx, f in enumerate(fibers):
+        for n_idx, vox in enumerate(f.coords.astype(int).T):
+            v_idx = np.where(np.all(M.fg_idx_unique.T == vox, -1))[0][0]
+            sig = M.fiber_signal[f_idx][n_idx]
+            expected[v_idx * 6:(v_idx + 1) * 6, f_idx] += (sig -
+                np.mean(M.relative_signal[vox[0], vox[1], vox[2]]))
+    npt.assert_almost_equal(fiber_matrix.todense(), expected)
+
+    M_batch = FiberModel(data, bvecs, bvals, FG, batch_size=2)
+    npt.assert_almost_equal(M_batch.matrix[0].todense(), expected)
+    npt.assert_equal(M_batch.matrix[1].todense(), iso_matrix.todense())
+
+    file_name = os.path.join(tempfile.mkdtemp(), 'fibers.pdb')
+    mio.pdb_from_fg(FG, file_name, verbose=False)
+    M_file = FiberModel(data, bvecs, bvals, file_name, batch_size=2)
+    npt.assert_equal(M_file.n_fibers, len(fibers))
+    npt.assert_equal(M_file.fg_idx_unique, M.fg_idx_unique)
+    npt.assert_almost_equal(M_file.matrix[0].todense(), expected)
+
+
+def test_voxel2fiber():
+    """
+    Test the mapping between voxels, fibers and nodes
+    """
+    prng = np.random.RandomState(2014)
+    data = prng.rand(5, 5, 5)
+    fibers = [ozf.Fiber(prng.rand(3, 1) * 2 +
+                        np.outer(prng.rand(3), np.arange(n) * 0.7))
+              for n in [2, 5, 3, 4]]
+    FG = ozf.FiberGroup(fibers)
+    FS = FiberStatistic(data, FG)
+    # Fibers read from file are mapped a batch at a time:
+    file_name = os.path.join(tempfile.mkdtemp(), 'fibers.pdb')
+    mio.pdb_from_fg(FG, file_name, verbose=False)
+    FS_batch = FiberStatistic(data, file_name, batch_size=3)
+
+    vox = FS.fg_idx_unique.T
+    n_vox = len(vox)
+    for this in [FS, FS_batch]:
+        v2f, v2fn = this.voxel2fiber
+        npt.assert_equal(v2f.shape, (n_vox, len(fibers)))
+        npt.assert_equal(len(v2fn), FG.coords.shape[-1])
+        node_idx = 0
+        expected = np.zeros((n_vox, len(fibers)))
+        for f_idx, f in enumerate(fibers):
+            for node in f.coords.astype(int).T:
+                v_idx = np.where(np.all(vox == node, -1))[0][0]
+                npt.assert_equal(v2fn[node_idx], v_idx)
+                expected[v_idx, f_idx] += 1
+                node_idx += 1
+        npt.assert_equal(v2f.toarray(), expected)
+
+    npt.assert_equal(FS.design_matrix.toarray(),
+                     np.hstack([expected > 0, np.eye(n_vox)]))
+    npt.assert_equal(FS.fiber_data, data[vox[:, 0], vox[:, 1], vox[:, 2]])
+
+
+def test_FiberStatistic():
+    """
+    Test fitting the FiberStatistic model with a sparse design matrix
+    """
+    prng = np.random.RandomState(2016)
+    data = prng.rand(5, 5, 5, 2)
+    FG = ozf.FiberGroup([ozf.Fiber(prng.rand(3, 1) * 2 +
+                                   np.outer(prng.rand(3), np.arange(6) * 0.5))
+                         for ii in range(6)])
+
+    FS = FiberStatistic(data[..., 0], FG)
+    X = FS.design_matrix.toarray()
+    L = lm.Ridge(alpha=0.1)
+    L.fit(X, FS.fiber_data)
+    npt.assert_almost_equal(FS.coef, L.coef_)
+    npt.assert_almost_equal(FS.intercept, L.intercept_)
+    npt.assert_almost_equal(FS.fit, L.predict(X))
+
+    # Several values in each voxel are fit one at a time:
+    FS2 = FiberStatistic(data, FG)
+    L.fit(X, FS2.fiber_data)
+    npt.assert_almost_equal(FS2.coef, L.coef_)
+    npt.assert_almost_equal(FS2.fit, L.predict(X))
+
+    FS_nnls = FiberStatistic(data[..., 0], FG, solver='nnls', tol=1e-10)
+    n_cols = X.shape[-1]
+    npt.assert_almost_equal(FS_nnls.coef,
+                            opt.nnls(np.vstack([X, np.sqrt(0.1) *
+                                                np.eye(n_cols)]),
+                                     np.concatenate([FS.fiber_data,
+                                                     np.zeros(n_cols)]))[0],
+                            decimal=6)
+    npt.assert_equal(FS_nnls.intercept, 0)
+
+    npt.assert_raises(ValueError, FiberStatistic, data, FG, solver='Lasso')
+
+
+def test_FiberModel_nnls():
+    """
+    Test fitting the FiberModel weights with non-negative least squares
+    """
+    prng = np.random.RandomState(2015)
+    data, bvecs, bvals = _random_dwi(prng, (4, 4, 4), 10)
+    FG = ozf.FiberGroup([ozf.Fiber(prng.rand(3, 1) * 2 +
+                                   np.outer(prng.rand(3), np.arange(5) * 0.5))
+                         for ii in range(4)])
+    M = FiberModel(data, bvecs, bvals, FG, solver='nnls',
+                   solver_params=dict(tol=1e-10, max_iter=10000))
+    npt.assert_(np.all(M.fiber_weights >= 0))
+    npt.assert_almost_equal(M.fiber_weights,
+                            opt.nnls(M.matrix[0].toarray(),
+                                     M.voxel_signal_demeaned)[0], decimal=6)
+    npt.assert_almost_equal(M.iso_weights, np.mean(M.voxel_signal, -1))
+    npt.assert_equal(M.fit.shape, M.voxel_signal.ravel().shape)
+
+    npt.assert_raises(ValueError, FiberModel, data, bvecs, bvals, FG,
+                      solver='Lasso')
+
+
+def test_FiberModel_compressed():
+    """
+    Test that compressing straight fibers does not change the model matrix,
+    and changes it only a little for curved fibers
+    """
+    prng = np.random.RandomState(2017)
+    data, bvecs, bvals = _random_dwi(prng, (6, 6, 6), 6)
+    # Straight fibers with many nodes in each voxel:
+    FG = ozf.FiberGroup([ozf.Fiber(prng.rand(3, 1) + 1 +
+                                   np.outer(prng.rand(3),
+                                            np.arange(20) * 0.15))
+                         for ii in range(4)])
+    compressed = ozf.compress_fibers(FG)
+    npt.assert_(compressed.n_nodes < FG.n_nodes / 2)
+    M = FiberModel(data, bvecs, bvals, FG)
+    M_compressed = FiberModel(data, bvecs, bvals, compressed)
+    npt.assert_equal(M_compressed.fg_idx_unique, M.fg_idx_unique)
+    npt.assert_almost_equal(M_compressed.matrix[0].todense(),
+                            M.matrix[0].todense())
+
+    # For curved fibers (quarter circles), the matrix is an approximation,
+    # which is better for larger radii of curvature:
+    t = np.linspace(0, np.pi / 2, 60)
+    rel_err = []
+    for radius in [1.5, 4]:
+        x = 0.5 + radius * (1 - np.cos(t))
+        y = 0.5 + radius * np.sin(t)
+        FG = ozf.FiberGroup([ozf.Fiber(np.array([x, y, 1.5 + ii + 0 * t]))
+                             for ii in range(3)])
+        M = FiberModel(data, bvecs, bvals, FG)
+        M_compressed = FiberModel(data, bvecs, bvals,
+                                  ozf.compress_fibers(FG))
+        npt.assert_equal(M_compressed.fg_idx_unique, M.fg_idx_unique)
+        diff = (M_compressed.matrix[0] - M.matrix[0]).toarray()
+        rel_err.append(np.sqrt(np.sum(diff ** 2) /
+                               np.sum(M.matrix[0].toarray() ** 2)))
+    npt.assert_(0 < rel_err[1] < rel_err[0] < 0.15)
+    npt.assert_(rel_err[1] < 0.05)
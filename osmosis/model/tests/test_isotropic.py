@@ -119,3 +119,83 @@ def test_kfold_xval_MD_mod():
     ss_err, predict_out = mdm.kfold_xval_MD_mod(data_pv, bvals_pv, bvecs_pv,
                                                 mask_pv, "bi_exp_nf_rs", 10)
     npt.assert_equal(np.mean(ss_err) < 200, 1)
+
+def test_fit_flat():
+    flat_data = data_pv[np.where(mask_pv)]
+    b0_inds = b_inds[0]
+    all_b_idx = all_b_inds[0]
+    b = bvals_pv[all_b_idx]/1000.
+    # Noiseless signal from a known set of parameters:
+    params_t = np.array([0.3, 0.5, 1.5])
+    s0 = np.mean(flat_data[:, b0_inds], -1)
+    flat_data[:, all_b_idx] = s0[:, None] * mdm.bi_exp_rs(b, *params_t)
+
+    bounds = mdm.preset_bounds("bi_exp_rs")
+    npt.assert_equal(bounds, [(0, 1), (0, 4), (0, 4)])
+    params_out, fit_out = mdm.fit_flat(flat_data, b, b0_inds, all_b_idx,
+                                       mdm.bi_exp_rs, [0.4, 0.6, 1.2],
+                                       bounds=bounds)
+    npt.assert_almost_equal(params_out, np.tile(params_t, (2, 1)), decimal=4)
+    npt.assert_almost_equal(fit_out, flat_data[:, all_b_idx]/s0[:, None])
+
+    # Initial values can be given for each voxel:
+    params_warm, _ = mdm.fit_flat(flat_data, b, b0_inds, all_b_idx,
+                                  mdm.bi_exp_rs, params_out, bounds=bounds)
+    npt.assert_almost_equal(params_warm, params_out)
+
+    npt.assert_raises(ValueError, mdm.preset_bounds, "decaying_exp")
+
+def test_model_jacobian():
+    b = np.array([0., 1., 1., 2., 3.])
+    # Parameters away from the kinks of the piecewise models, one row for
+    # each of two voxels:
+    params = {"decaying_exp": [[-0.5], [-1.]],
+              "decaying_exp_plus_const": [[-1., -0.5], [-2., -0.7]],
+              "two_decaying_exp": [[-0.3, -0.5, -0.7], [-0.1, -1., -0.2]],
+              "two_decaying_exp_plus_const": [[-0.3, -2., -0.5, -0.7],
+                                              [-0.1, -1.5, -1., -0.2]],
+              "single_exp_rs": [[1.], [0.5]],
+              "single_exp_nf_rs": [[0.1, 1.], [0.2, 0.5]],
+              "bi_exp_rs": [[0.3, 0.5, 1.5], [0.7, 1., 2.]],
+              "bi_exp_nf_rs": [[0.1, 0.3, 0.5, 1.5], [0.2, 0.7, 1., 2.]]}
+    for name, p in params.items():
+        func = getattr(mdm, name)
+        p = np.array(p).T[..., None]
+        J = mdm.model_jacobian(name)(b, *p)
+        npt.assert_equal(J.shape, (p.shape[0], 2, len(b)))
+        npt.assert_almost_equal(J, mdm._numerical_jac(func)(b, *p),
+                                decimal=5)
+
+    # Other models get a numerical Jacobian:
+    def my_exp(b, D):
+        return np.exp(-b * D)
+    npt.assert_almost_equal(mdm.model_jacobian(my_exp)(b, 1.),
+                            mdm.single_exp_rs_jac(b, 1.), decimal=5)
+
+def test_leastsq_flat():
+    b = np.repeat([1., 2., 3.], 10)
+    params_t = np.array([[0.3, 0.5, 1.5], [0.8, 0.2, 1.], [0.5, 1.2, 3.]])
+    s_prime = mdm.bi_exp_rs(b, *params_t.T[..., None])
+    bounds = mdm.preset_bounds("bi_exp_rs")
+    params = mdm.leastsq_flat(mdm.bi_exp_rs, b, s_prime, [0.4, 0.6, 1.2],
+                              bounds=bounds)
+    npt.assert_almost_equal(params, params_t, decimal=4)
+
+    # Parameters stay within the bounds:
+    s_single = mdm.single_exp_rs(b, np.array([[0.5], [1.], [2.]]))
+    params = mdm.leastsq_flat(mdm.single_exp_rs, b, s_single, [1.5],
+                              bounds=[(1.2, 4)])
+    npt.assert_equal(params[:2], 1.2 * np.ones((2, 1)))
+    npt.assert_almost_equal(params[2], [2.])
+
+    # Fitting in blocks doesn't change the fit:
+    flat_data = np.hstack([np.ones((3, 2)), s_prime])
+    all_b_idx = np.arange(2, flat_data.shape[-1])
+    params_1, fit_1 = mdm.fit_flat(flat_data, b, [0, 1], all_b_idx,
+                                   mdm.bi_exp_rs, [0.4, 0.6, 1.2],
+                                   bounds=bounds, block_size=1)
+    params_3, fit_3 = mdm.fit_flat(flat_data, b, [0, 1], all_b_idx,
+                                   mdm.bi_exp_rs, [0.4, 0.6, 1.2],
+                                   bounds=bounds)
+    npt.assert_almost_equal(params_1, params_3)
+    npt.assert_almost_equal(fit_1, fit_3)
@@ -0,0 +1,187 @@
+"""
+
+Non-negative least squares for large sparse problems
+
+Solves
+
+.. math::
+
+    \min_{w \geq 0} \frac{1}{2} ||X w - y||^2_2
+
+with the spectral projected gradient method (Birgin, Martinez and Raydan
+2000): projected gradient steps with the Barzilai-Borwein step size and a
+non-monotone line search, which needs only products with X and X^T. This is
+deterministic, so the same inputs always give the same weights.
+
+"""
+
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import scipy.sparse as sps
+
+
+class BlockOperator(object):
+    """
+    Products with a csr matrix, split into row blocks that are multiplied in
+    parallel threads (the sparse products release the GIL).
+    """
+    def __init__(self, X, n_threads=1):
+        """
+        Parameters
+        ----------
+        X: sparse matrix, or a sequence of sparse matrices
+            The matrix. A sequence of matrices with the same number of rows
+            (such as FiberModel.matrix) is stacked horizontally.
+        n_threads: int
+            The number of row blocks/threads
+        """
+        if isinstance(X, (list, tuple)):
+            X = sps.hstack(X)
+        X = sps.csr_matrix(X)
+        self.shape = X.shape
+        n_threads = int(max(min(n_threads, X.shape[0]), 1))
+        edges = np.linspace(0, X.shape[0], n_threads + 1).astype(int)
+        self.edges = zip(edges[:-1], edges[1:])
+        # The blocks share the data of X:
+        self.blocks = [sps.csr_matrix((X.data[X.indptr[a]:X.indptr[b]],
+                                       X.indices[X.indptr[a]:X.indptr[b]],
+                                       X.indptr[a:b + 1] - X.indptr[a]),
+                                      shape=(b - a, X.shape[1]))
+                       for a, b in self.edges]
+        if n_threads > 1:
+            self.pool = ThreadPool(n_threads)
+        else:
+            self.pool = None
+
+    def _map(self, func, args):
+        if self.pool is None:
+            return map(func, args)
+        return self.pool.map(func, args)
+
+    def dot(self, w):
+        """
+        X w
+        """
+        return np.concatenate(self._map(lambda B: B.dot(w), self.blocks))
+
+    def rdot(self, r):
+        """
+        X^T r
+        """
+        def block_rdot(i):
+            a, b = self.edges[i]
+            return self.blocks[i].T.dot(r[a:b])
+        return np.sum(self._map(block_rdot, range(len(self.blocks))), 0)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+
+
+def sparse_nnls(X, y, w0=None, tol=1e-6, max_iter=1000, n_threads=1,
+                memory=10, verbose=False):
+    """
+    Non-negative least squares solution of y = X w, for large sparse X
+
+    Parameters
+    ----------
+    X: sparse matrix, or a sequence of sparse matrices
+        The regressors, with shape (n_obs, n_regressors). A sequence of
+        matrices with the same number of rows (for example the
+        (fiber_matrix, iso_matrix) of FiberModel.matrix) is stacked
+        horizontally, and the weights of all of them are returned together.
+    y: 1-d array
+        The data, with shape (n_obs,)
+    w0: 1-d array, optional
+        Initial weights (warm start). If it is shorter than n_regressors, the
+        rest of the weights start at 0 (as when fibers are added at the end
+        of the matrix). When fibers are removed, pass the weights of the ones
+        that were kept. Negative values are set to 0. Defaults to all 0.
+    tol: float
+        The solution is returned when the norm of the projected gradient,
+        P(w - g) - w, is below tol times the norm of X^T y (the gradient at
+        w = 0).
+    max_iter: int
+        Maximal number of iterations. Each iteration takes one product with
+        X and one with X^T (and the line-search takes none).
+    n_threads: int
+        The number of threads for the sparse products.
+    memory: int
+        The number of iterations over which the objective is allowed not to
+        decrease (for the non-monotone line search).
+    verbose: bool
+        Whether to print the progress.
+
+    Returns
+    -------
+    w: 1-d array
+        The weights, with shape (n_regressors,)
+    """
+    A = BlockOperator(X, n_threads=n_threads)
+    y = np.asarray(y, dtype=float).ravel()
+    n_regressors = A.shape[1]
+
+    w = np.zeros(n_regressors)
+    if w0 is not None:
+        w0 = np.ravel(w0)[:n_regressors]
+        w[:len(w0)] = np.maximum(w0, 0)
+
+    scale = np.sqrt(np.sum(A.rdot(y) ** 2))
+    if scale == 0:
+        # Any non-negative solution to X^T y = 0 will do:
+        A.close()
+        return np.zeros(n_regressors)
+
+    r = A.dot(w) - y
+    g = A.rdot(r)
+    f = 0.5 * np.dot(r, r)
+    f_hist = [f]
+    # The first step is scaled to the size of the gradient:
+    step = 1.0 / max(np.max(np.abs(g)), np.finfo(float).tiny)
+
+    for iteration in xrange(max_iter):
+        pg_norm = np.sqrt(np.sum((np.maximum(w - g, 0) - w) ** 2))
+        if verbose:
+            print("Itn #:%03d | SSE: %.4g | projected gradient: %.4g"%(
+                iteration, 2 * f, pg_norm / scale))
+        if pg_norm <= tol * scale:
+            break
+
+        # The projected gradient direction:
+        d = np.maximum(w - step * g, 0) - w
+        gd = np.dot(g, d)
+        # X d is all we need for the line-search along d:
+        Xd = A.dot(d)
+        dXXd = np.dot(Xd, Xd)
+        f_ref = np.max(f_hist[-memory:])
+        lam = 1.0
+        while 1:
+            f_new = f + lam * gd + 0.5 * lam ** 2 * dXXd
+            if f_new <= f_ref + 1e-4 * lam * gd or lam < 1e-10:
+                break
+            # Safeguarded quadratic interpolation:
+            lam_q = -0.5 * lam ** 2 * gd / (f_new - f - lam * gd)
+            if lam_q < 0.1 * lam or lam_q > 0.9 * lam:
+                lam_q = lam / 2.0
+            lam = lam_q
+
+        # This is between w and the projection, so it is still non-negative:
+        s = lam * d
+        w = w + s
+        r = r + lam * Xd
+        g_new = A.rdot(r)
+        f = f_new
+        f_hist.append(f)
+
+        # The Barzilai-Borwein step size, s^T s / s^T X^T X s:
+        sy = lam ** 2 * dXXd
+        if sy > 0:
+            step = np.dot(s, s) / sy
+        else:
+            step = 1.0 / max(np.max(np.abs(g_new)), np.finfo(float).tiny)
+        g = g_new
+
+    A.close()
+    return w
@@ -0,0 +1,590 @@
+"""
+
+Running sharded jobs on the local machine, with a pool of processes
+
+This follows the same workflow as the submission of jobs to an SGE (see
+`osmosis.parallel.sge`): a template script is turned into one script per job
+with `add_params`, and each job processes one shard of the voxels in a mask.
+Here, the scripts are written to a local directory and run by a pool of
+worker processes, failed jobs are retried, and the outputs of all the shards
+are reassembled into one volume.
+
+For example::
+
+    import osmosis.parallel.local as local
+    import osmosis.parallel.emd_template as template
+
+    code = local.getsourcelines(template)[0]
+    params_list = local.shard_params(dict(sid="FP", fODF="single",
+                                          im="bi_exp_rs",
+                                          data_path=data_path),
+                                     n_vox, 2000)
+    failed = local.run_template(code, params_list, "~/pycmd", name="emd")
+
+Shards of a fixed size take very different times to run when the cost of the
+voxels varies across the mask. Instead, the voxels can be split into small
+blocks, and the blocks dealt out to the jobs in contiguous runs of equal
+estimated cost (see `voxel_costs` and `block_plan`). Each job works through
+its own blocks from the front, and when it runs out of blocks, it takes the
+unfinished blocks of the jobs with the most work left, from the back (see
+`job_blocks`)::
+
+    costs = local.voxel_costs(pilot_func, n_vox)
+    plan = local.block_plan(costs, n_jobs=100, block_size=200)
+    failed = local.run_plan(code, dict(sid="FP", fODF="single",
+                                       im="bi_exp_rs", data_path=data_path),
+                            plan, "~/pycmd", name="emd")
+
+"""
+
+import os
+import sys
+import time
+import json
+import errno
+import inspect
+import subprocess
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+import osmosis.utils as ozu
+
+
+def getsourcelines(object):
+    """Return a list of source lines and starting line number for an object.
+
+    Parameters
+    ----------
+    object : a python object
+       The argument may be a module, class, method, function, traceback, frame,
+       or code object.  The source code is returned as a string with the lines
+       corresponding to the object and the line number indicates where in the
+       original source file the first line of code was found.  An IOError is
+       raised if the source code cannot be retrieved."""
+
+    lines, lnum = inspect.findsource(object)
+    if inspect.ismodule(object):
+        lnum = 0
+        ss = ''
+        for x in lines:
+            ss += x
+    else:
+        lines = inspect.getblock(lines[lnum:])
+        lnum = lnum + 1
+        ss = ''
+        for x in lines:
+            ss += x
+
+    return ss, 0
+
+
+def add_params(s, params_dict):
+    """
+
+    Add parameter values from a dict to a code string. This sets the values of
+    particular elements of the code, so that many different versions of the
+    same code can be run with different parameter settings
+
+    """
+    for k,v in params_dict.items():
+        # Keep quotes on strings:
+        if isinstance(v, str):
+            s = '%s="%s"\n'%(k,v) + s
+        else:
+            s = "%s = %s\n"%(k,v) + s
+
+    return s
+
+
+def n_shards(n_vox, shard_size):
+    """
+    The number of shards needed to cover n_vox voxels
+    """
+    return int(np.ceil(n_vox / float(shard_size)))
+
+
+def shard_bounds(i, n_vox, shard_size):
+    """
+    The range of voxels (in the order of np.where(mask)) in shard i
+
+    Returns
+    -------
+    low, high: int
+        The shard includes the voxels low:high
+    """
+    low = i * shard_size
+    # Make sure not to go over the edge of the mask:
+    high = np.min([(i + 1) * shard_size, n_vox])
+    return low, high
+
+
+def shard_mask(mask, i, shard_size):
+    """
+    A mask with only the voxels in one shard of a mask
+
+    Parameters
+    ----------
+    mask: 3 dimensional array
+        The full mask
+    i: int
+        The shard number
+    shard_size: int
+        Number of voxels in each shard
+
+    Returns
+    -------
+    this_mask: 3 dimensional array
+        A mask of the voxels in shard i
+    """
+    mask_idx = np.where(mask)
+    low, high = shard_bounds(i, len(mask_idx[0]), shard_size)
+    this_mask = np.zeros(mask.shape)
+    this_mask[tuple([idx[low:high] for idx in mask_idx])] = 1
+    return this_mask
+
+
+def shard_params(params_dict, n_vox, shard_size, key="i"):
+    """
+    One parameter dict for each shard of the voxels in a mask
+
+    Parameters
+    ----------
+    params_dict: dict
+        The parameters shared by all the jobs
+    n_vox: int
+        The number of voxels in the mask
+    shard_size: int
+        Number of voxels in each shard
+    key: str
+        The name of the shard number in the template
+
+    Returns
+    -------
+    params_list: list of dicts
+    """
+    params_list = []
+    for i in range(n_shards(n_vox, shard_size)):
+        this_params = dict(params_dict)
+        this_params[key] = i
+        params_list.append(this_params)
+    return params_list
+
+
+def write_scripts(template, params_list, script_dir, name="job"):
+    """
+    Write one script for each parameter dict, from a template
+
+    Parameters
+    ----------
+    template: str
+        The code of the template (e.g. from `getsourcelines`)
+    params_list: list of dicts
+        Parameters of each job
+    script_dir: str
+        Where to write the scripts
+    name: str
+        The scripts are called name_000.py, name_001.py, ...
+
+    Returns
+    -------
+    script_list: list
+        The full paths to the scripts
+    """
+    script_dir = os.path.expanduser(script_dir)
+    if not os.path.exists(script_dir):
+        os.makedirs(script_dir)
+
+    script_list = []
+    for job_i, params_dict in enumerate(params_list):
+        code = add_params(template, params_dict)
+        script = os.path.join(script_dir, "%s_%03d.py"%(name, job_i))
+        f = open(script, 'w')
+        f.write(code)
+        f.close()
+        script_list.append(script)
+    return script_list
+
+
+def _run_script(args):
+    """
+    Run one script in its own python process, keeping the output in .o and .e
+    files next to the script (as the SGE does).
+    """
+    script, python, attempt = args
+    stem = os.path.splitext(script)[0]
+    out = open("%s.o"%stem, 'a')
+    err = open("%s.e"%stem, 'a')
+    out.write("# Attempt %d\n"%attempt)
+    out.flush()
+    try:
+        status = subprocess.call([python, script], stdout=out, stderr=err,
+                                 cwd=os.path.dirname(script))
+    finally:
+        out.close()
+        err.close()
+    return status
+
+
+def run_scripts(script_list, n_procs=None, retries=2, python=None,
+                verbose=True):
+    """
+    Run scripts in a pool of processes on this machine, retrying the ones that
+    fail.
+
+    Parameters
+    ----------
+    script_list: list
+        Full paths to the scripts
+    n_procs: int, optional
+        Number of scripts to run at a time. Defaults to the number of CPUs.
+    retries: int
+        How many more times to run a script that fails
+    python: str, optional
+        The python executable. Defaults to the one running this function.
+    verbose: bool
+        Whether to report progress
+
+    Returns
+    -------
+    failed: list
+        The scripts that failed in all attempts
+    """
+    if n_procs is None:
+        n_procs = multiprocessing.cpu_count()
+    if python is None:
+        python = sys.executable
+
+    t1 = time.time()
+    pending = list(script_list)
+    attempt = 0
+    pool = ThreadPool(n_procs)
+    try:
+        while len(pending) and attempt <= retries:
+            # Each script runs in its own process, so threads suffice to keep
+            # n_procs of them running at a time:
+            status = pool.map(_run_script,
+                              [(script, python, attempt) for script in pending],
+                              chunksize=1)
+            pending = [script for script, s in zip(pending, status) if s != 0]
+            if verbose and len(pending):
+                print("%s jobs failed in attempt %s"%(len(pending), attempt))
+            attempt = attempt + 1
+    finally:
+        pool.close()
+        pool.join()
+
+    if verbose:
+        t2 = time.time()
+        print("Ran %s jobs in %4.2f minutes"%(len(script_list), (t2 - t1)/60.))
+
+    return pending
+
+
+def run_template(template, params_list, script_dir, name="job", n_procs=None,
+                 retries=2, python=None, verbose=True):
+    """
+    Write the scripts for a template and run them on this machine (see
+    `write_scripts` and `run_scripts`)
+
+    Returns
+    -------
+    failed: list
+        The scripts that failed in all attempts
+    """
+    script_list = write_scripts(template, params_list, script_dir, name=name)
+    return run_scripts(script_list, n_procs=n_procs, retries=retries,
+                       python=python, verbose=verbose)
+
+
+def reassemble(file_list, mask, shard_size):
+    """
+    Put the outputs of the jobs on the shards of a mask back into one volume.
+
+    Parameters
+    ----------
+    file_list: list
+        The .npy output files of the shards, in order of the shard number.
+        Each has one row for each voxel in the shard.
+    mask: 3 dimensional array
+        The full mask
+    shard_size: int
+        Number of voxels in each shard
+
+    Returns
+    -------
+    vol: array
+        Volume with the outputs in the voxels of the mask, and nans outside of
+        it, or where an output is missing
+    missing: list
+        The numbers of the shards with missing output files
+    """
+    mask_idx = np.where(mask)
+    n_vox = len(mask_idx[0])
+    vol = None
+    missing = []
+    for i, file_name in enumerate(file_list):
+        if not os.path.exists(file_name):
+            missing.append(i)
+            continue
+        this_data = np.load(file_name)
+        if vol is None:
+            vol = ozu.nans(mask.shape + this_data.shape[1:])
+        low, high = shard_bounds(i, n_vox, shard_size)
+        vol[tuple([idx[low:high] for idx in mask_idx])] = this_data
+
+    if vol is None:
+        vol = ozu.nans(mask.shape)
+
+    return vol, missing
+
+
+def cost_bounds(costs, n_shards):
+    """
+    Split a sequence of items into contiguous shards of (roughly) equal cost
+
+    Parameters
+    ----------
+    costs: 1 dimensional array
+        The (estimated) cost of each item
+    n_shards: int
+        The number of shards
+
+    Returns
+    -------
+    bounds: list
+        (low, high) for each shard, which holds the items low:high. When
+        there are fewer items than shards, some of the shards are empty.
+    """
+    costs = np.asarray(costs, dtype=float)
+    n_items = costs.shape[0]
+    cum_cost = np.concatenate([[0], np.cumsum(costs)])
+    edges = [0]
+    for ii in range(1, n_shards):
+        # End the shard where the cumulative cost is closest to its share of
+        # the total:
+        target = cum_cost[-1] * ii / float(n_shards)
+        edge = int(np.argmin(np.abs(cum_cost - target)))
+        # Don't leave shards empty, if there are enough items:
+        edge = max(edge, edges[-1] + (n_items >= n_shards))
+        edge = min(edge, n_items - (n_shards - ii) * (n_items >= n_shards))
+        edges.append(edge)
+    edges.append(n_items)
+    return [(edges[ii], edges[ii + 1]) for ii in range(n_shards)]
+
+
+def voxel_costs(time_func, n_vox, n_pilot=10, pilot_size=10):
+    """
+    Estimate the run time of each voxel from a pilot run on a few voxels
+
+    Parameters
+    ----------
+    time_func: callable
+        time_func(low, high) runs the computation on the voxels low:high (in
+        the order of np.where(mask))
+    n_vox: int
+        Number of voxels in the mask
+    n_pilot: int
+        Number of pilot ranges, evenly spaced over the mask
+    pilot_size: int
+        Number of voxels in each pilot range
+
+    Returns
+    -------
+    costs: 1 dimensional array
+        The estimated run time (in seconds) of each voxel, interpolated
+        between the pilot ranges
+    """
+    starts = np.linspace(0, max(n_vox - pilot_size, 0), n_pilot).astype(int)
+    centers = []
+    per_voxel = []
+    for low in np.unique(starts):
+        high = min(low + pilot_size, n_vox)
+        t1 = time.time()
+        time_func(low, high)
+        per_voxel.append((time.time() - t1) / float(high - low))
+        centers.append((low + high - 1) / 2.0)
+
+    return np.interp(np.arange(n_vox), centers, per_voxel)
+
+
+def block_plan(costs, n_jobs, block_size):
+    """
+    Split the voxels into blocks and deal out the blocks to jobs in
+    contiguous runs of equal estimated cost
+
+    Parameters
+    ----------
+    costs: 1 dimensional array
+        The estimated cost of each voxel (see `voxel_costs`)
+    n_jobs: int
+        Number of jobs
+    block_size: int
+        Number of voxels in each block. Blocks are the unit of work (and of
+        output files), so that jobs can take over each other's blocks
+
+    Returns
+    -------
+    plan: dict
+        n_vox, block_size, the estimated cost of each block ('block_costs')
+        and the list of blocks of each job ('jobs')
+    """
+    costs = np.asarray(costs, dtype=float)
+    n_vox = costs.shape[0]
+    starts = np.arange(0, n_vox, block_size)
+    block_costs = np.add.reduceat(costs, starts)
+    jobs = [range(low, high) for low, high in cost_bounds(block_costs, n_jobs)]
+    return dict(n_vox=int(n_vox), block_size=int(block_size),
+                block_costs=[float(c) for c in block_costs],
+                jobs=[j for j in jobs if len(j)])
+
+
+def write_plan(plan, plan_file):
+    """
+    Save a plan (see `block_plan`) for the jobs, and start it with no blocks
+    claimed (see `job_blocks`)
+    """
+    f = open(plan_file, 'w')
+    json.dump(plan, f)
+    f.close()
+    claim_dir = _claim_dir(plan_file)
+    if not os.path.exists(claim_dir):
+        os.makedirs(claim_dir)
+    for claim in os.listdir(claim_dir):
+        os.remove(os.path.join(claim_dir, claim))
+
+
+def _claim_dir(plan_file):
+    return os.path.splitext(plan_file)[0] + "_claims"
+
+
+def _claim(claim_dir, b):
+    """
+    Claim block b. Creating the file fails if it exists, so only one job can
+    claim each block, also across machines that share the file system.
+    """
+    try:
+        fd = os.open(os.path.join(claim_dir, "%d"%b),
+                     os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except OSError as e:
+        if e.errno == errno.EEXIST:
+            return False
+        raise
+    os.close(fd)
+    return True
+
+
+def _is_claimed(claim_dir, b):
+    return os.path.exists(os.path.join(claim_dir, "%d"%b))
+
+
+def _is_done(claim_dir, b):
+    return os.path.exists(os.path.join(claim_dir, "%d.done"%b))
+
+
+def job_blocks(i, plan_file=None):
+    """
+    The blocks that job i works on, in a plan (see `block_plan`)
+
+    The job first takes its own blocks, from the front. When none are left,
+    it takes the unclaimed blocks of the job with the most estimated cost left,
+    from the back, until all the blocks are claimed. A block is marked as done
+    when the loop over the blocks moves on to the next one, so blocks in which
+    the job failed can be run again (see `run_plan`).
+
+    Parameters
+    ----------
+    i: int
+        The job number
+    plan_file: str, optional
+        The plan (see `write_plan`). Without a plan, job i works on block i
+        only, as with shards of a fixed size.
+
+    Returns
+    -------
+    A generator of block numbers
+    """
+    if plan_file is None:
+        yield i
+        return
+
+    f = open(plan_file)
+    plan = json.load(f)
+    f.close()
+    claim_dir = _claim_dir(plan_file)
+    jobs = plan["jobs"]
+    block_costs = plan["block_costs"]
+
+    for b in jobs[i]:
+        if _claim(claim_dir, b):
+            yield b
+            open(os.path.join(claim_dir, "%d.done"%b), 'w').close()
+
+    while True:
+        # Find the job with the most work left:
+        left = [[b for b in blocks if not _is_claimed(claim_dir, b)]
+                for blocks in jobs]
+        cost_left = [np.sum([block_costs[b] for b in blocks])
+                     for blocks in left]
+        victim = int(np.argmax(cost_left))
+        if not len(left[victim]):
+            return
+        b = left[victim][-1]
+        if _claim(claim_dir, b):
+            yield b
+            open(os.path.join(claim_dir, "%d.done"%b), 'w').close()
+
+
+def run_plan(template, params_dict, plan, script_dir, name="job",
+             n_procs=None, retries=2, python=None, verbose=True):
+    """
+    Run the jobs of a plan (see `block_plan`) on this machine.
+
+    The template loops over the blocks of job i, for example::
+
+        for b in local.job_blocks(i, plan_file):
+            low = b * block_size
+            ...
+
+    Besides params_dict, each job gets the parameters i, plan_file and
+    block_size. Blocks that are not done when all the jobs end are released
+    and the jobs are run again, up to retries times.
+
+    Returns
+    -------
+    undone: list
+        The blocks that were not done in any of the attempts
+    """
+    script_dir = os.path.expanduser(script_dir)
+    if not os.path.exists(script_dir):
+        os.makedirs(script_dir)
+    plan_file = os.path.join(script_dir, "%s_plan.json"%name)
+    write_plan(plan, plan_file)
+    claim_dir = _claim_dir(plan_file)
+
+    params_list = []
+    for job_i in range(len(plan["jobs"])):
+        this_params = dict(params_dict)
+        this_params.update(i=job_i, plan_file=plan_file,
+                           block_size=plan["block_size"])
+        params_list.append(this_params)
+    script_list = write_scripts(template, params_list, script_dir, name=name)
+
+    n_blocks = len(plan["block_costs"])
+    undone = range(n_blocks)
+    for attempt in range(retries + 1):
+        # After the first attempt, any job can take the blocks that are left:
+        run_scripts(script_list[:len(undone)], n_procs=n_procs, retries=0,
+                    python=python, verbose=verbose)
+        undone = [b for b in range(n_blocks) if not _is_done(claim_dir, b)]
+        if not len(undone):
+            break
+        # Release the blocks of the jobs that failed, so they run again:
+        for b in undone:
+            if _is_claimed(claim_dir, b):
+                os.remove(os.path.join(claim_dir, "%d"%b))
+        if verbose:
+            print("%s blocks not done in attempt %s"%(len(undone), attempt))
+
+    return undone
@@ -15,32 +15,8 @@ import IPython.zmq.zmqshell as zmqshell
 # This does ssh:
 import paramiko
 
-def getsourcelines(object):
-    """Return a list of source lines and starting line number for an object.
-
-    Parameters
-    ----------
-    object : a python object 
-       The argument may be a module, class, method, function, traceback, frame,
-       or code object.  The source code is returned as a string with the lines
-       corresponding to the object and the line number indicates where in the
-       original source file the first line of code was found.  An IOError is
-       raised if the source code cannot be retrieved."""
-    
-    lines, lnum = inspect.findsource(object)
-    if inspect.ismodule(object):
-        lnum = 0
-        ss = ''
-        for x in lines:
-            ss += x
-    else:
-        lines = inspect.getblock(lines[lnum:])
-        lnum = lnum + 1
-        ss = ''
-        for x in lines:
-            ss += x
-
-    return ss, 0   
+# The scripts are generated from templates in the same way for local runs:
+from osmosis.parallel.local import getsourcelines, add_params
 
 class SSH(object):
    """
@@ -149,24 +125,6 @@ class SSH(object):
 
       
 
-def add_params(s, params_dict):
-    """
-
-    Add parameter values from a dict to a code string. This sets the values of
-    particular elements of the code, so that many different versions of the
-    same code can be run with different parameter settings
-
-    """
-    for k,v in params_dict.items():
-       # Keep quotes on strings:
-       if isinstance(v, str):
-          s = '%s="%s"\n'%(k,v) + s
-       else: 
-          s = "%s = %s\n"%(k,v) + s
-
-    return s
-
-
 def qsub_cmd(call, name, working_dir='cwd', shell='/bin/bash',
              email=None, mem_usage=25, priority=0,
              flags='', output_dir='sgeoutput'):
@@ -17,6 +17,7 @@ from osmosis.utils import separate_bvals
 
 import osmosis.model.sparse_deconvolution as sfm
 import osmosis.model.dti as dti
+import osmosis.model.isotropic as mm
 
 def partial_round(bvals, factor = 1000.):
     """
@@ -43,7 +44,8 @@ def partial_round(bvals, factor = 1000.):
 
 def new_mean_combos(vec_pool_inds, data, bvals, bvecs, mask, b_inds,
                     bounds="preset", mean_mod_func = "bi_exp_rs",
-                    these_b_inds=None, b_idx1=None, b_idx2=None):
+                    these_b_inds=None, b_idx1=None, b_idx2=None,
+                    initial="preset", cache=None):
     """
     Helper function for calculating a new mean from all b values and corresponding data
 
@@ -52,13 +54,13 @@ def new_mean_combos(vec_pool_inds, data, bvals, bvecs, mask, b_inds,
     vec_pool_inds: 1 dimensional array
         Shuffled indices to leave out during the current fold corresponding
         to certain values in these_b_inds
-    data: 4 dimensional array
-        Diffusion MRI data
+    data: 4 or 2 dimensional array
+        Diffusion MRI data, or the masked data flattened to voxels by volumes
     bvals: 1 dimensional array
         All b values
     bvecs: 2 dimensional array
         All the b vectors
-    mask: 3 dimensional array
+    mask: 3 or 1 dimensional array
         Brain mask of the data
     bounds: list
         List containing tuples indicating the bounds for each parameter in
@@ -72,6 +74,14 @@ def new_mean_combos(vec_pool_inds, data, bvals, bvecs, mask, b_inds,
         First index into b_inds
     b_idx2: int
         Index into b_inds.
+    initial: str or 2 dimensional array
+        Initial values for fitting the mean model.  Typically, the parameters
+        of the mean model fit to all the data in each voxel, which are close
+        to the parameters in each fold.  If "preset", these are estimated from
+        a tensor fit to the data in the fold.
+    cache: dict, optional
+        If provided, fits are stored here, keyed on the mean model and the
+        indices fit to, and are reused whenever the same fold comes up again.
 
     Returns
     -------
@@ -84,46 +94,84 @@ def new_mean_combos(vec_pool_inds, data, bvals, bvecs, mask, b_inds,
     inds_arr: 1 dimensional array
         Indices corresponding to the b values to fit to.  Used for single fODF
     """
-    inds_list = list(np.arange(len(bvals)))
-
     # Remove combo indices from the indices from all the b values.
-    for vc in vec_pool_inds:
-        if b_idx1 is not None:
-            inds_list.remove(b_inds[1:][b_idx1][vc])
-        elif b_idx2 is not None:
-            inds_list.remove(b_inds[1:][b_idx2][vc])
-        elif these_b_inds is not None:
-            inds_list.remove(these_b_inds[vc])
-
-    inds_arr = np.array(inds_list)
-
-    # New data with removed indices.
-    fit_all_data = data[..., inds_arr]
-    fit_all_bvecs = bvecs[:, inds_arr]
-    fit_all_bvals = bvals[inds_arr]
+    if b_idx1 is not None:
+        left_out = b_inds[1:][b_idx1][vec_pool_inds]
+    elif b_idx2 is not None:
+        left_out = b_inds[1:][b_idx2][vec_pool_inds]
+    elif these_b_inds is not None:
+        left_out = np.asarray(these_b_inds)[vec_pool_inds]
+    else:
+        left_out = np.array([], dtype=int)
 
-    # Now put this into SFM multi_b class in order to grab the calculated mean
-    mod = sfm.SparseDeconvolutionModelMultiB(fit_all_data, fit_all_bvecs,
-                                             fit_all_bvals, mask = mask,
-                                             bounds=bounds,
-                                             mean_mod_func = mean_mod_func,
-                                             params_file = "temp")
-    _, b_inds_ar, _, _ = separate_bvals(fit_all_bvals, mode = "remove0")
+    inds_arr = np.setdiff1d(np.arange(len(bvals)), left_out)
+    fit_all_bvals = bvals[inds_arr]
 
-    # Get the new means at each direction and the new parameters at each voxel
-    sig_out, new_params = mod.fit_flat_rel_sig_avg
+    key = (mean_mod_func, inds_arr.tostring())
+    if cache is not None and key in cache:
+        sig_out, new_params = cache[key]
+    else:
+        sig_out, new_params = _fit_mean_model(data, bvals, bvecs, mask,
+                                              inds_arr, bounds, mean_mod_func,
+                                              initial)
+        if cache is not None:
+            cache[key] = sig_out, new_params
 
     if b_idx1 is not None:
         _, b_inds_ar, _, _ = separate_bvals(fit_all_bvals, mode = "remove0")
         return sig_out, new_params, b_inds_ar[b_idx1]
     else:
-        for bi0 in b_inds[0]:
-            # Remove the b = 0 indices so we can obtain the indices to the
-            # non diffusion weighted directions
-            inds_list.remove(bi0)
-        inds_arr = np.array(inds_list)
+        # Remove the b = 0 indices so we can obtain the indices to the
+        # non diffusion weighted directions
+        return sig_out, new_params, np.setdiff1d(inds_arr, b_inds[0])
 
-        return sig_out, new_params, inds_arr
+def _fit_mean_model(data, bvals, bvecs, mask, inds_arr, bounds, mean_mod_func,
+                    initial):
+    """
+    Helper function that fits the mean model to the volumes inds_arr of the
+    data in the mask, the same way SparseDeconvolutionModelMultiB does, but
+    without copying the data or initializing a model object.
+
+    Returns
+    -------
+    sig_out: 2 dimensional array
+        Mean model signal for each non-zero b value fit to in each voxel
+    params_out: 2 dimensional array
+        Parameters for the mean model at each voxel
+    """
+    func = getattr(mm, mean_mod_func)
+    fit_all_bvals = bvals[inds_arr]
+    _, fit_b_inds, _, fit_rounded = separate_bvals(fit_all_bvals)
+    all_b_idx, b0_inds = mm._diffusion_inds(fit_all_bvals, fit_b_inds,
+                                            fit_rounded)
+    # Indices into the volumes of the original data:
+    b_cols = inds_arr[all_b_idx]
+    b0_cols = inds_arr[b0_inds]
+
+    # As in the model classes, voxels with no b0 signal are not fit:
+    flat_data = data[np.where(mask)]
+    flat_data = flat_data[np.mean(flat_data[:, b0_cols], -1) != 0]
+
+    if isinstance(initial, str) and initial == "preset":
+        initial = mm.initial_params(flat_data[:, inds_arr], bvecs[:, inds_arr],
+                                    fit_all_bvals, func,
+                                    mask=np.ones(flat_data.shape[0], dtype=bool),
+                                    params_file="temp")[1]
+    if isinstance(bounds, str) and bounds == "preset":
+        bounds = mm.preset_bounds(func)
+
+    if mean_mod_func[-2:] == "rs":
+        signal = "relative_signal"
+    else:
+        signal = "log"
+
+    params_out, sig_out = mm.fit_flat(flat_data, bvals[b_cols]/sfm.SCALE_FACTOR,
+                                      b0_cols, b_cols, func, initial,
+                                      bounds=bounds, signal=signal)
+    if signal == "log":
+        sig_out = np.exp(sig_out)
+
+    return sig_out, params_out
 
 def _predict_across_b(mod_obj, vec_combo, vec_pool_inds, bvecs, bvals,
                         b_inds, b_across, new_params = None):
@@ -407,7 +455,8 @@ def kfold_xval(data, bvals, bvecs, mask, ad, rd, n, fODF_mode,
                mean_mod_func = "bi_exp_rs", mean = "mean_model",
                mean_mix = None, precision = False, fit_method = None,
                b_idx1 = None, b_idx2 = None, over_sample=None,
-               bounds = "preset", solver=None, viz = False, bias_var=False):
+               bounds = "preset", solver=None, viz = False, bias_var=False,
+               n_threads=1, emd_mode="exact", emd_params=None):
     """
     Does k-fold cross-validation leaving out a certain percentage of the vertices
     out at a time.  This function can be used for 7 different variations of
@@ -456,6 +505,13 @@ def kfold_xval(data, bvals, bvecs, mask, ad, rd, n, fODF_mode,
         Bounds on the parameters for fitting the mean model
     solver: str
         Solver to be used in multi_bvals module for fitting the SFM.
+    n_threads: int
+        Number of threads used to compute the EMD, if precision is 'emd' or
+        'emd_multi_combine'.
+    emd_mode: str
+        "exact" or "sinkhorn", for an approximate EMD (see `fODF_EMD`)
+    emd_params: dict, optional
+        Parameters for the "sinkhorn" EMD mode: reg, n_iter and tol.
 
     Returns
     -------
@@ -468,6 +524,11 @@ def kfold_xval(data, bvals, bvecs, mask, ad, rd, n, fODF_mode,
         model parameters
     """
     t1 = time.time()
+    # All the models are initialized with the masked data, flattened to a
+    # voxels by volumes matrix, so that the folds only index into this matrix,
+    # instead of copying the full 4D volume:
+    data, mask = ozu.flat_data_mask(data, mask)
+
     [b_inds, unique_b, b_inds_rm0,
     all_b_idx, all_b_idx_rm0, predicted] = _kfold_xval_setup(bvals, mask)
 
@@ -526,6 +587,8 @@ def kfold_xval(data, bvals, bvecs, mask, ad, rd, n, fODF_mode,
 
     count = 0
     vec_pool_list = []
+    # Mean model fits to the same indices are shared between folds:
+    mm_cache = {}
     for bi_idx, bi in enumerate(indices):
         mp_list = []
         mp_rot_vecs_list = []
@@ -609,21 +672,24 @@ def kfold_xval(data, bvals, bvecs, mask, ad, rd, n, fODF_mode,
             e = "Number of directions not equally divisible by %d"%n
             raise ValueError(e)
 
-        for combo_num in np.arange(np.floor(100./n)):
-            # Create the combinations of directions to leave out at a time and
-            # remove them from the original data for fitting purposes.
-            (si, vec_combo, vec_combo_rm0,
-            vec_pool_inds, these_bvecs, these_bvals,
-            this_data, these_inc0) = ozu.create_combos(bvecs, bvals, data,
-                                                       these_b_inds,
-                                                       these_b_inds_rm0,
-                                                       all_inc_0, this_vec_pool,
-                                                       num_choose, combo_num)
+        # Create the combinations of directions to leave out at a time:
+        plan = ozu.fold_plan(these_b_inds, these_b_inds_rm0, all_inc_0,
+                             this_vec_pool, num_choose, np.floor(100./n))
+
+        # The mean model parameters fit to all the data are a good starting
+        # point for the fits to each fold:
+        if (mean == "mean_model") & (full_mod.func_str == mean_mod_func):
+            mm_initial = full_mod.fit_flat_rel_sig_avg[1]
+        else:
+            mm_initial = "preset"
 
+        for (si, vec_combo, vec_combo_rm0,
+             vec_pool_inds, these_inc0) in plan:
             # Initial a model object with reduced data (not including the
             # chosen combinations)
-            mod = sfm.SparseDeconvolutionModelMultiB(this_data, these_bvecs,
-                                                     these_bvals,
+            mod = sfm.SparseDeconvolutionModelMultiB(data[:, these_inc0],
+                                                     bvecs[:, these_inc0],
+                                                     bvals[these_inc0],
                                                      mask = mask,
                                                      axial_diffusivity = ad,
                                                      radial_diffusivity = rd,
@@ -634,6 +700,7 @@ def kfold_xval(data, bvals, bvecs, mask, ad, rd, n, fODF_mode,
                                                      mean_mix = mean_mix,
                                                 mean_mod_func = mean_mod_func,
                                                 mean = mean,
+                                                initial = mm_initial,
                                                 params_file = "temp")
 
             if (mean == "mean_model") & (fODF_mode != "single"):
@@ -652,7 +719,9 @@ def kfold_xval(data, bvals, bvecs, mask, ad, rd, n, fODF_mode,
                                                                  mask, b_inds,
                                                                  bounds=bounds,
                                                 mean_mod_func = mean_mod_func,
-                                                b_idx1=b_mean1, b_idx2=b_idx2)
+                                                b_idx1=b_mean1, b_idx2=b_idx2,
+                                                initial=mm_initial,
+                                                cache=mm_cache)
 
                 if (fODF_mode == "multi") & (b_idx2 == None):
                     # Replace the relative signal average of the model object
@@ -714,7 +783,10 @@ def kfold_xval(data, bvals, bvecs, mask, ad, rd, n, fODF_mode,
         if ((precision is not False) & (precision != "emd_multi_combine") &
                                             (start_fODF_mode[:4] != "both")):
             p_arr = kfold_xval_precision(mp_list, mod.mask, mp_rot_vecs_list,
-                                         precision, start_fODF_mode)
+                                         precision, start_fODF_mode,
+                                         n_threads=n_threads,
+                                         emd_mode=emd_mode,
+                                         emd_params=emd_params)
             p_list.append(p_arr)
 
         if (start_fODF_mode[:4] == "both") | (precision == "emd_multi_combine"):
@@ -729,11 +801,15 @@ def kfold_xval(data, bvals, bvecs, mask, ad, rd, n, fODF_mode,
                                                        unique_b, precision,
                                                        start_fODF_mode)
         p_arr = kfold_xval_precision(mp_list, mod.mask, mp_rot_vecs_list,
-                                     precision, start_fODF_mode)
+                                     precision, start_fODF_mode,
+                                     n_threads=n_threads, emd_mode=emd_mode,
+                                     emd_params=emd_params)
         p_list.append(p_arr)
     elif start_fODF_mode == "both_s":
         p_arr = kfold_xval_precision(all_mp_list, mod.mask,
-                               all_mp_rot_vecs_list, precision, start_fODF_mode)
+                               all_mp_rot_vecs_list, precision, start_fODF_mode,
+                               n_threads=n_threads, emd_mode=emd_mode,
+                               emd_params=emd_params)
         p_list.append(p_arr)
 
     t2 = time.time()
@@ -753,7 +829,8 @@ def kfold_xval(data, bvals, bvecs, mask, ad, rd, n, fODF_mode,
         return actual, predicted
 
 def kfold_xval_precision(mp_list, mask, rot_vecs_list,
-                        precision_type, start_fODF_mode):
+                        precision_type, start_fODF_mode, n_threads=1,
+                        emd_mode="exact", emd_params=None):
     """
     Helper function that finds the spherical cross-correlation between the
     different model params generated by k-fold cross-validation.
@@ -775,6 +852,12 @@ def kfold_xval_precision(mp_list, mask, rot_vecs_list,
                  model parameters
     start_fODF_mode: str
         The fODF mode for this round of k-fold cross-validation
+    n_threads: int
+        Number of threads used to compute the EMD
+    emd_mode: str
+        "exact" or "sinkhorn", for an approximate EMD (see `fODF_EMD`)
+    emd_params: dict, optional
+        Parameters for the "sinkhorn" EMD mode: reg, n_iter and tol.
 
     Returns
     -------
@@ -801,6 +884,26 @@ def kfold_xval_precision(mp_list, mask, rot_vecs_list,
     mp_count = 0
 
     for mp_inds in itr:
+        if (precision_type == "emd") | (precision_type == "emd_multi_combine"):
+            # All voxels share the rotational vectors, so the EMD in all of
+            # them is computed at once, with one distance matrix:
+            if start_fODF_mode == "None":
+                mp1 = mp_list[mp_inds[0]]
+                mp2 = mp_list[mp_inds[1]]
+                rot_vecs1 = rot_vecs_list[mp_inds[0]]
+                rot_vecs2 = rot_vecs_list[mp_inds[1]]
+            elif start_fODF_mode[:4] == "both":
+                mp1 = mp_list[0][mp_inds[0]]
+                mp2 = mp_list[1][mp_inds[1]]
+                rot_vecs1 = rot_vecs_list[0][mp_inds[0]]
+                rot_vecs2 = rot_vecs_list[1][mp_inds[1]]
+            p_arr[mp_count] = fODF_EMD_batch(mp1, mp2, rot_vecs1, rot_vecs2,
+                                             n_threads=n_threads,
+                                             emd_mode=emd_mode,
+                                             emd_params=emd_params)
+            mp_count = mp_count + 1
+            continue
+
         for vox in np.arange(int(np.sum(mask))):
             if start_fODF_mode == "None":
                 mp1 = mp_list[mp_inds[0]][vox]
@@ -853,6 +956,9 @@ def predict_grid(data, bvals, bvecs, mask, ad, rd, n, over_sample=None,
         Predicted signals for the vertices left out of the fit
     """
     t1 = time.time()
+    # Fit all the models to the masked data, flattened to a voxels by volumes
+    # matrix:
+    data, mask = ozu.flat_data_mask(data, mask)
 
     [b_inds, unique_b, b_inds_rm0,
     all_b_idx, all_b_idx_rm0, predicted] = _kfold_xval_setup(bvals, mask)
@@ -873,6 +979,12 @@ def predict_grid(data, bvals, bvecs, mask, ad, rd, n, over_sample=None,
                                                 bounds = bounds, solver = solver,
                                                 fit_method = fit_method,
                                                 mean = mean, params_file = "temp")
+    # The mean model parameters fit to all the data are used as initial values
+    # for the fits to each fold:
+    if mean == "mean_model":
+        mm_initial = full_mod.fit_flat_rel_sig_avg[1]
+    else:
+        mm_initial = "preset"
     for bi in np.arange(3):
         these_b_inds = np.array([]).astype(int)
         these_b_inds_rm0 = np.array([]).astype(int)
@@ -898,17 +1010,14 @@ def predict_grid(data, bvals, bvecs, mask, ad, rd, n, over_sample=None,
             e = "Number of directions not equally divisible by %d"%n
             raise ValueError(e)
 
-        for combo_num in np.arange(np.floor(100./n)):
-            (si, vec_combo, vec_combo_rm0,
-             vec_pool_inds, these_bvecs, these_bvals,
-             this_data, these_inc0) = ozu.create_combos(bvecs, bvals, data,
-                                                        these_b_inds,
-                                                        these_b_inds_rm0,
-                                                        all_inc_0, vec_pool,
-                                                        num_choose, combo_num)
-
-            mod = sfm.SparseDeconvolutionModelMultiB(this_data, these_bvecs,
-                                                     these_bvals,
+        plan = ozu.fold_plan(these_b_inds, these_b_inds_rm0, all_inc_0,
+                             vec_pool, num_choose, np.floor(100./n))
+
+        for (si, vec_combo, vec_combo_rm0,
+             vec_pool_inds, these_inc0) in plan:
+            mod = sfm.SparseDeconvolutionModelMultiB(data[:, these_inc0],
+                                                     bvecs[:, these_inc0],
+                                                     bvals[these_inc0],
                                                      mask = mask,
                                                      params_file = "temp",
                                                      axial_diffusivity = ad,
@@ -916,11 +1025,13 @@ def predict_grid(data, bvals, bvecs, mask, ad, rd, n, over_sample=None,
                                                      bounds = bounds,
                                                      mean = mean,
                                                      over_sample = over_sample,
-                                                     solver = solver)
+                                                     solver = solver,
+                                                     initial = mm_initial)
             sig_out, new_params, inds_arr = new_mean_combos(vec_pool_inds, data,
                                                         bvals, bvecs, mask,
                                                         b_inds, bounds=bounds,
-                                                       these_b_inds=these_b_inds)
+                                                       these_b_inds=these_b_inds,
+                                                       initial=mm_initial)
 
             mod.fit_flat_rel_sig_avg = [sig_out, new_params]
             if mean != "empirical":
@@ -1167,7 +1278,8 @@ def nchoosek(n,k):
     return f(n)/f(k)/f(n-k)
 
 
-def fODF_EMD(fODF1, fODF2, bvecs1=None, bvecs2=None, dist=None):
+def fODF_EMD(fODF1, fODF2, bvecs1=None, bvecs2=None, dist=None,
+             emd_mode="exact", emd_params=None):
     """
     Calcluates the earth mover's distance between two different fODFs
 
@@ -1187,17 +1299,28 @@ def fODF_EMD(fODF1, fODF2, bvecs1=None, bvecs2=None, dist=None):
         should already be calculated with the antipodal symmetry incorporated,
         so should lie in the interval [0-pi].
 
+    emd_mode : str
+        "exact": the EMD, computed with the transportation simplex.
+        "sinkhorn": an approximation, with entropic-regularized optimal
+        transport (see `fODF_sinkhorn_batch`).
+
+    emd_params : dict, optional
+        Parameters for the "sinkhorn" mode: reg, n_iter and tol.
+
     """
-    if dist is None:
-        angles = np.arccos(np.dot(np.squeeze(bvecs1).T, np.squeeze(bvecs2)))
+    if emd_mode not in ["exact", "sinkhorn"]:
+        raise ValueError("EMD mode %s is not supported"%emd_mode)
 
-        if angles.shape:
-            angles[np.isnan(angles)] = 0
-        elif np.isnan(angles):
-            angles = 0
+    if dist is None:
+        dist = emd_dist(bvecs1, bvecs2).ravel()
 
-        angles = np.min(np.array([angles, np.pi - angles]), 0)
-        dist = angles.ravel()
+    if emd_mode == "sinkhorn":
+        if emd_params is None:
+            emd_params = {}
+        fODF1 = np.ravel(fODF1)
+        fODF2 = np.ravel(fODF2)
+        dist = np.reshape(dist, (len(fODF1), len(fODF2)))
+        return fODF_sinkhorn_batch(fODF1, fODF2, dist=dist, **emd_params)[0]
 
     # The result is normalized such that 1 is the EMD of a weight of 1 moved 90
     # degrees:
@@ -1205,3 +1328,226 @@ def fODF_EMD(fODF1, fODF2, bvecs1=None, bvecs2=None, dist=None):
                      fODF2/np.sum(fODF2), dist) / (np.pi/2)
 
     return my_emd
+
+def emd_dist(bvecs1, bvecs2):
+    """
+    The ground distances for the EMD between fODFs on two sets of vectors
+
+    Parameters
+    ----------
+    bvecs1, bvecs2 : (3, n), (3, m) arrays
+        The bvectors used in the comparison.
+
+    Returns
+    -------
+    angles : array shape: (n, m)
+        The angular pair-wise distances between bvecs1 and bvecs2 *in radians*,
+        with the antipodal symmetry incorporated, so in the interval [0-pi/2].
+    """
+    angles = np.arccos(np.dot(np.squeeze(bvecs1).T, np.squeeze(bvecs2)))
+
+    if angles.shape:
+        angles[np.isnan(angles)] = 0
+    elif np.isnan(angles):
+        angles = 0
+
+    return np.min(np.array([angles, np.pi - angles]), 0)
+
+def fODF_EMD_batch(fODF1, fODF2, bvecs1=None, bvecs2=None, dist=None,
+                   n_threads=1, emd_mode="exact", emd_params=None):
+    """
+    Calculates the earth mover's distance between many pairs of fODFs, defined
+    on the same two sets of vectors (e.g. the same pair of models in every
+    voxel).
+
+    Parameters
+    ----------
+    fODF1 : 2d array (pairs, n)
+        The first fODF in each comparison
+
+    fODF2 : 2d array (pairs, m)
+        The second fODF in each comparison
+
+    bvecs1, bvecs2 : (3, n), (3, m) arrays
+        The bvectors used in the comparison.
+
+    dist : 2d array shape: (n, m)
+        The angular pair-wise distances between bvecs1 and bvecs2 *in radians*
+        (see `emd_dist`).
+
+    n_threads : int
+        Number of threads to compute the EMD with.
+
+    emd_mode : str
+        "exact" or "sinkhorn" (see `fODF_EMD`)
+
+    emd_params : dict, optional
+        Parameters for the "sinkhorn" mode: reg, n_iter and tol.
+
+    Returns
+    -------
+    my_emd : 1d array
+        The EMD for each pair, as in `fODF_EMD`, computed only from the
+        positive weights in each fODF. This is nan when one of the fODFs has
+        no positive weights.
+    """
+    if dist is None:
+        dist = emd_dist(bvecs1, bvecs2)
+
+    if emd_mode == "sinkhorn":
+        if emd_params is None:
+            emd_params = {}
+        return fODF_sinkhorn_batch(fODF1, fODF2, dist=dist, **emd_params)
+    elif emd_mode != "exact":
+        raise ValueError("EMD mode %s is not supported"%emd_mode)
+
+    fODF1 = np.ascontiguousarray(np.atleast_2d(fODF1), dtype=float)
+    fODF2 = np.ascontiguousarray(np.atleast_2d(fODF2), dtype=float)
+    dist = np.ascontiguousarray(dist, dtype=float)
+
+    # Weights are normalized to 1 in the extension. As in fODF_EMD, 1 is the
+    # EMD of a weight of 1 moved 90 degrees:
+    my_emd = np.array(emd.emd_batch(fODF1, fODF2, dist,
+                                    n_threads=n_threads)) / (np.pi/2)
+
+    return my_emd
+
+def fODF_sinkhorn_batch(fODF1, fODF2, bvecs1=None, bvecs2=None, dist=None,
+                        reg=0.02, n_iter=500, tol=1e-4):
+    """
+    Approximates the earth mover's distance between many pairs of fODFs with
+    entropic-regularized optimal transport, computed with Sinkhorn iterations
+    for all the pairs at once.
+
+    The transport plan that is found minimizes <P, dist> - reg * H(P), where
+    H is the entropy of the plan. Smaller values of reg get closer to the
+    EMD, but need more iterations to converge.
+
+    Parameters
+    ----------
+    fODF1 : 1d or 2d array (pairs, n)
+        The first fODF in each comparison
+
+    fODF2 : 1d or 2d array (pairs, m)
+        The second fODF in each comparison
+
+    bvecs1, bvecs2 : (3, n), (3, m) arrays
+        The bvectors used in the comparison.
+
+    dist : 2d array shape: (n, m)
+        The angular pair-wise distances between bvecs1 and bvecs2 *in radians*
+        (see `emd_dist`).
+
+    reg : float
+        The strength of the entropic regularization, in radians. Values much
+        smaller than 0.01 lead to underflow.
+
+    n_iter : int
+        Maximal number of Sinkhorn iterations.
+
+    tol : float
+        The iterations stop when the marginals of the plan are all within tol
+        (in L1 norm) of the fODFs.
+
+    Returns
+    -------
+    my_emd : 1d array
+        The approximate EMD for each pair, normalized as in `fODF_EMD`. This
+        is nan when one of the fODFs has no positive weights.
+    """
+    if dist is None:
+        dist = emd_dist(bvecs1, bvecs2)
+
+    fODF1 = np.atleast_2d(np.asarray(fODF1, dtype=float))
+    fODF2 = np.atleast_2d(np.asarray(fODF2, dtype=float))
+    dist = np.asarray(dist, dtype=float)
+
+    # As in the exact EMD, only the positive weights count, and each fODF is
+    # normalized to sum to 1:
+    a = np.where(fODF1 > 0, fODF1, 0)
+    b = np.where(fODF2 > 0, fODF2, 0)
+    sum_a = np.sum(a, -1)
+    sum_b = np.sum(b, -1)
+    valid = (sum_a > 0) & (sum_b > 0)
+    a = a[valid] / sum_a[valid][:, None]
+    b = b[valid] / sum_b[valid][:, None]
+
+    # Directions with no weight in any of the fODFs don't take part:
+    support1 = np.any(a > 0, 0)
+    support2 = np.any(b > 0, 0)
+    a = a[:, support1]
+    b = b[:, support2]
+    dist = dist[support1][:, support2]
+
+    K = np.exp(-dist / reg)
+    u = np.ones(a.shape)
+    v = np.ones(b.shape)
+    # Guard against division by 0 where the kernel underflows:
+    tiny = np.finfo(float).tiny
+    for ii in xrange(n_iter):
+        u = a / np.maximum(np.dot(v, K.T), tiny)
+        Ktu = np.dot(u, K)
+        # After updating u, the first marginal is exact. Check the second:
+        if np.max(np.sum(np.abs(v * Ktu - b), -1)) < tol:
+            break
+        v = b / np.maximum(Ktu, tiny)
+
+    # The cost of the plan, diag(u) K diag(v), for each pair:
+    my_emd = np.ones(len(valid)) * np.nan
+    my_emd[valid] = np.sum(u * np.dot(v, (K * dist).T), -1) / (np.pi/2)
+
+    return my_emd
+
+def emd_mode_error(fODF1, fODF2, bvecs1=None, bvecs2=None, dist=None,
+                   emd_params_list=None, n_threads=1):
+    """
+    Validates the approximate ("sinkhorn") EMD mode against the exact EMD for
+    a batch of fODF pairs, reporting both the error and the time taken by each
+    setting.
+
+    Parameters
+    ----------
+    fODF1, fODF2, bvecs1, bvecs2, dist : see `fODF_EMD_batch`
+
+    emd_params_list : list of dicts
+        Settings of the "sinkhorn" mode to validate. Defaults to the default
+        settings.
+
+    n_threads : int
+        Number of threads used for the exact EMD.
+
+    Returns
+    -------
+    exact : 1d array
+        The exact EMD of each pair
+    report : list of dicts
+        For each setting: the params, the mean and maximal absolute error, the
+        mean relative error and the time in seconds, together with the time
+        of the exact computation ("exact_time").
+    """
+    if dist is None:
+        dist = emd_dist(bvecs1, bvecs2)
+    if emd_params_list is None:
+        emd_params_list = [{}]
+
+    t1 = time.time()
+    exact = fODF_EMD_batch(fODF1, fODF2, dist=dist, n_threads=n_threads)
+    exact_time = time.time() - t1
+    finite = np.isfinite(exact)
+
+    report = []
+    for emd_params in emd_params_list:
+        t1 = time.time()
+        approx = fODF_EMD_batch(fODF1, fODF2, dist=dist, emd_mode="sinkhorn",
+                                emd_params=emd_params)
+        this_time = time.time() - t1
+        err = np.abs(approx[finite] - exact[finite])
+        report.append(dict(params=emd_params,
+                           mean_error=np.mean(err),
+                           max_error=np.max(err),
+                           relative_error=np.mean(err /
+                                       np.maximum(exact[finite], 1e-12)),
+                           time=this_time,
+                           exact_time=exact_time))
+
+    return exact, report
@@ -23,24 +23,29 @@ hostname = 'proclus.stanford.edu'
 username = 'klchan13'
 max_jobs = 8000.
 port = 22
+# The number of voxels in each job:
+block_size = 2000
 
 sid_list = ["103414", "110411", "105115", "111312", "113619",
             "100307", "115320", "117122", "118730", "118932"]
 
 def qsub_cmd_gen(template, job_name, i, sid, fODF, im, data_path,
                  cmd_file_path=cmd_file_path, python_path=python_path,
-                 bashcmd=bashcmd, mem=25):
+                 bashcmd=bashcmd, mem=25, block_size=block_size):
     reload(template)
     template = sge.getsourcelines(template)[0]
 
-    # Name the job and generate the parameters for each job
+    # Name the job and generate the parameters for each job. Each job works
+    # on its own block, without a plan (see osmosis.parallel.local.run_plan):
     if job_name[0:2] != "im":
         params_dict = dict(i=i, sid=sid, fODF=fODF, im=im,
-                        data_path=data_path)
+                        data_path=data_path, plan_file=None,
+                        block_size=block_size)
         name = '%s_%s_%s%s'%(job_name,fODF,shorthand_im,i)
     else:
         params_dict = dict(i=i, sid=sid, im=im,
-                        data_path=data_path)
+                        data_path=data_path, plan_file=None,
+                        block_size=block_size)
         name = '%s_%s%s'%(job_name,shorthand_im,i)
 
     code = sge.add_params(template,params_dict)
@@ -75,8 +80,8 @@ for sid_idx, sid in enumerate(sid_list):
     wm_vox_num = np.sum(np.round(wm_data_file.get_data()).astype(int))
 
     # For dividing up data
-    emd_file_num = int(np.ceil(wm_vox_num/2000.))
-    others_file_num = int(np.ceil(wm_vox_num/2000.))
+    emd_file_num = int(np.ceil(wm_vox_num/float(block_size)))
+    others_file_num = int(np.ceil(wm_vox_num/float(block_size)))
     subj_file_nums.append(np.array((emd_file_num, others_file_num)))
     for fODF in ["multi", "single"]:
         for im in ["bi_exp_rs", "single_exp_rs"]:
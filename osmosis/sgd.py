@@ -26,7 +26,8 @@ def stochastic_gradient_descent(y, X, momentum=0,
                                 verbose=True,
                                 plot=True,
                                 lamda=0,
-                                alpha=0.5):
+                                alpha=0.5,
+                                prop_check=0.1):
     """
 
     Solve y=Xh for h, using a stochastic gradient descent.
@@ -40,6 +41,10 @@ def stochastic_gradient_descent(y, X, momentum=0,
     X: ndarray of regressors. May be either sparse or dense. of shape (N, M)
        The regressors
     
+    momentum: float (default: 0)
+        The proportion of the previous gradient added to the gradient in each
+        iteration.
+
     prop_select: float (0-1, default 0.01)
         What proportion of the samples to evaluate in each iteration of the
         algorithm.
@@ -72,17 +77,51 @@ def stochastic_gradient_descent(y, X, momentum=0,
     plot: whether to generate a plot of the progression of the optimization
 
     lamda, alpha: ElasticNet params
+
+    prop_check: float (0-1, default 0.1)
+        What proportion of the samples to hold out for the error checks. These
+        samples are not used to compute the gradient.
     
     Returns
     -------
     h_best: The best estimate of the parameters.
     
-    
+    Notes
+    -----
+    The samples are split into contiguous blocks of prop_select * N rows,
+    and a random prop_check of the blocks is held out for the error checks.
+    Each pass over the data (epoch) visits the other blocks in a new random
+    order. Each iteration, as well as each error check, costs time
+    proportional to the number of samples it uses, rather than to N.
+
+    The blocks are slices of X, so X is never copied (for a sparse X, only
+    the rows of one block at a time). The price is that each block holds
+    neighboring rows of X rather than a random sample of them, so rows
+    that are similar to their neighbors (e.g. the directions of one voxel)
+    make the gradient of each iteration noisier. If the rows of X are
+    ordered, shuffling them before the call trades this for one copy of X.
     """
 
     num_data = y.shape[0]
     num_regressors = X.shape[1]
-    n_select = np.round(prop_select * num_data)
+
+    if sps.issparse(X):
+        # Row blocks are cheap to slice out of the csr format:
+        X = sps.csr_matrix(X)
+
+    # Contiguous blocks of rows, which are sliced out of X when they are
+    # used, so that X is never copied as a whole:
+    n_select = int(np.clip(np.round(prop_select * num_data), 1,
+                           max(num_data // 2, 1)))
+    block_starts = np.arange(0, num_data, n_select)
+    n_blocks = len(block_starts)
+    # Hold out some of the blocks for checking the error:
+    perm = np.random.permutation(n_blocks)
+    n_check = int(np.clip(np.round(prop_check * n_blocks), 1, n_blocks - 1))
+    check_starts = np.sort(block_starts[perm[:n_check]])
+    train_starts = block_starts[perm[n_check:]]
+    y_check = np.concatenate([y[start:start + n_select]
+                              for start in check_starts])
 
     # Initialize the parameters at the origin:
     h = np.zeros(num_regressors)
@@ -93,34 +132,36 @@ def stochastic_gradient_descent(y, X, momentum=0,
     gradient = np.zeros(num_regressors)
     
     iteration = 1
-    count = 1
     ss_residuals = []  # This will hold the residuals in each iteration
     ss_residuals_min = np.inf  # This will keep track of the best solution so far
-    ss_residuals_to_mean = np.sum((y - np.mean(y))**2) # The variance of y
+    # The variance of y in the held out samples:
+    ss_residuals_to_mean = np.sum((y_check - np.mean(y_check))**2)
     rsq_max = -np.inf   # This will keep track of the best r squared so far
     count_bad = 0  # Number of times estimation error has gone up.
     error_checks = 0  # How many error checks have we done so far
+    blocks = []  # The blocks left to visit in this epoch
 
-        
     while 1:
-        # indices of data points to select
-        idx = np.floor(np.random.rand(n_select) * num_data).astype(int);
+        if not len(blocks):
+            # Start a new epoch, visiting the blocks in a new order:
+            blocks = list(np.random.permutation(train_starts))
+        start = blocks.pop()
 
         # Select for this round 
-        y0 = y[idx]
-        X0 = X[idx]
-
-        if iteration>1: 
-            # The sum of squared error given the current parameter setting: 
-            sse = np.sum((y - spdot(X,h))**2)
-            # The gradient is (Kay 2008 supplemental page 27): 
-            gradient = ((spdot(X0.T, spdot(X0,h) - y0))
-                        +
-                        lamda *((1-alpha) + alpha * h)
-                       )
-            gradient += momentum*gradient
+        y0 = y[start:start + n_select]
+        X0 = X[start:start + n_select]
+
+        # The gradient is (Kay 2008 supplemental page 27): 
+        last_gradient = gradient
+        gradient = ((spdot(X0.T, spdot(X0,h) - y0))
+                    +
+                    lamda *((1-alpha) + alpha * h)
+                   )
+        gradient = gradient + momentum * last_gradient
+        norm = np.sqrt(np.dot(gradient, gradient))
+        if norm > 0:
             # Normalize to unit-length
-            unit_length_gradient = gradient / np.sqrt(np.dot(gradient, gradient))
+            unit_length_gradient = gradient / norm
             # Update the parameters in the direction of the gradient:
             h -= step_size * unit_length_gradient
 
@@ -129,11 +170,14 @@ def stochastic_gradient_descent(y, X, momentum=0,
                 h[h<0] = 0
 
         # Every once in a while check whether it's converged:
-        if np.mod(iteration, check_error_iter):
+        if not np.mod(iteration, check_error_iter):
             # This calculates the sum of squared residuals at this point:
-            ss_residuals.append(np.sum(np.power(y - spdot(X,h), 2)) +
-                                lamda * (alpha*np.sum(h**2) +
-                                         (1-alpha)*np.sum(h)))
+            ss_check = np.sum([np.sum(np.power(y[start:start + n_select] -
+                                               spdot(X[start:start + n_select],
+                                                     h), 2))
+                               for start in check_starts])
+            ss_residuals.append(ss_check + lamda * (alpha*np.sum(h**2) +
+                                                    (1-alpha)*np.sum(h)))
             rsq_est = rsq(ss_residuals[-1], ss_residuals_to_mean)
             if verbose:
                 print("Itn #:%03d | SSE: %.1f | R2=%.1f "%
@@ -147,7 +191,7 @@ def stochastic_gradient_descent(y, X, momentum=0,
                 ss_residuals_min = ss_residuals[-1]
                 n_iterations = iteration # This holds the number of iterations
                                         # for the best solution so far.
-                h_best = h # This holds the best params we have so far
+                h_best = h.copy() # This holds the best params we have so far
 
                 # Are we generally (over iterations) converging on
                 # improvement in r-squared?
@@ -36,3 +36,97 @@ def test_dyad():
 
     # The dispersion should be null:
     npt.assert_equal(ozb.dyad_dispersion(dyad_dist), 0)
+
+
+def test_dyad_stats_vectorized():
+    """
+    Test that the dyad statistics over many voxels at once are the same as
+    the statistics in each voxel
+    """
+    prng = np.random.RandomState(2048)
+    # 5 voxels, with 10 sets of eigenvectors in each:
+    eigs = np.array([[np.linalg.qr(prng.randn(3, 3))[0] for ii in range(10)]
+                     for vox in range(5)])
+    coherence = ozb.dyad_coherence(ozb.dyadic_tensor(eigs, average=True))
+    dispersion = ozb.dyad_dispersion(ozb.dyadic_tensor(eigs, average=False))
+    npt.assert_equal(coherence.shape, (5,))
+    npt.assert_equal(dispersion.shape, (5,))
+    for vox in range(5):
+        npt.assert_almost_equal(coherence[vox],
+                    ozb.dyad_coherence(ozb.dyadic_tensor(eigs[vox])))
+        npt.assert_almost_equal(dispersion[vox],
+                    ozb.dyad_dispersion(ozb.dyadic_tensor(eigs[vox],
+                                                          average=False)))
+
+
+def test_resample():
+    """
+    Test resampling of residuals and of repetitions
+    """
+    prng = np.random.RandomState(2049)
+    residuals = prng.randn(4, 6)
+    samples = ozb.resample_residuals(residuals, 20, prng=prng)
+    npt.assert_equal(samples.shape, (20, 4, 6))
+    # Every residual is drawn from the ones of the same voxel:
+    for vox in range(4):
+        npt.assert_(np.all(np.in1d(samples[:, vox], residuals[vox])))
+
+    samples = ozb.resample_residuals(residuals, 20, method='wild', prng=prng)
+    npt.assert_almost_equal(np.abs(samples),
+                            np.abs(residuals) * np.ones((20, 1, 1)))
+
+    leverage = np.linspace(0, 0.5, 6)
+    samples = ozb.resample_residuals(residuals, 20, method='wild',
+                                     leverage=leverage, prng=prng)
+    npt.assert_almost_equal(np.abs(samples) * np.sqrt(1 - leverage),
+                            np.abs(residuals) * np.ones((20, 1, 1)))
+    npt.assert_raises(ValueError, ozb.resample_residuals, residuals, 20,
+                      'parametric')
+
+    repetitions = prng.randn(3, 4, 6)
+    samples = ozb.resample_repetitions(repetitions, 20, prng=prng)
+    npt.assert_equal(samples.shape, (20, 4, 6))
+    npt.assert_(np.all(np.any(samples[:, np.newaxis] == repetitions, 1)))
+
+
+def test_subsample_samples():
+    """
+    Test drawing many sub-samples together
+    """
+    prng = np.random.RandomState(2049)
+    bvecs = prng.randn(3, 150)
+    bvecs = bvecs / np.sqrt(np.sum(bvecs ** 2, 0))
+    sample_bvecs, bvec_idx = ozb.subsample(bvecs, 30, n_samples=20,
+                                           prng=np.random.RandomState(1))
+    npt.assert_equal(sample_bvecs.shape, (20, 3, 30))
+    npt.assert_equal(bvec_idx.shape, (20, 30))
+    for this_bvecs, this_idx in zip(sample_bvecs, bvec_idx):
+        # No direction is chosen twice:
+        npt.assert_equal(len(np.unique(this_idx)), 30)
+        npt.assert_equal(this_bvecs, bvecs[:, this_idx])
+    # The first direction of every sample is its seed:
+    npt.assert_equal(bvec_idx[:, 0],
+                     np.random.RandomState(1).randint(150, size=20))
+
+    # A single sample is the same as the first of many:
+    one_bvecs, one_idx = ozb.subsample(bvecs, 30,
+                                       prng=np.random.RandomState(1))
+    npt.assert_equal(one_idx[0], bvec_idx[0, 0])
+
+    # Sub-sampling all of the directions gives all of them back:
+    bvec_idx = ozb.subsample(bvecs[:, :40], 40,
+                             elec_points=ozu.get_camino_pts(40).T)[1]
+    npt.assert_equal(np.sort(bvec_idx), np.arange(40))
+
+    # The sub-sample is spread over the sphere, more than the same number of
+    # random directions:
+    def min_angle(v):
+        corr = np.abs(np.dot(v.T, v))
+        np.fill_diagonal(corr, 0)
+        return np.arccos(np.max(corr))
+    dense = prng.randn(3, 2000)
+    dense = dense / np.sqrt(np.sum(dense ** 2, 0))
+    npt.assert_(min_angle(ozb.subsample(dense, 30, prng=prng)[0]) >
+                2 * min_angle(dense[:, :30]))
+
+    npt.assert_raises(ValueError, ozb.subsample, bvecs, 151)
@@ -40,3 +40,76 @@ def test_fodf_emd():
     emd2 = pn.fODF_EMD(fodf1, fodf2, bvecs1=bvecs, dist=angles)
 
     npt.assert_equal(emd1, emd2)
+
+
+def test_emd_batch():
+    xx = np.array([[1,0,0], [0,1,0], [0,0,1]])
+    cost = np.array([[np.sqrt(sum((this_x - this_y)**2)) for this_y in xx]
+                     for this_x in xx])
+    w1 = np.array([[0, 1, 0], [0, 2, 2], [0, 0, 0]], dtype=float)
+    w2 = np.array([[1, 0, 0], [0, 1, 1], [1, 0, 0]], dtype=float)
+    ee = emd.emd_batch(w1, w2, cost)
+    npt.assert_almost_equal(ee[:2], [np.sqrt(2), 0], decimal=5)
+    # No positive weights in the first signature:
+    npt.assert_(np.isnan(ee[2]))
+
+    npt.assert_raises(TypeError, emd.emd_batch, w1.astype(np.float32), w2,
+                      cost)
+    npt.assert_raises(ValueError, emd.emd_batch, w1, w2[:2], cost)
+
+
+def test_fodf_emd_batch():
+    bvecs = ozu.get_camino_pts(150)
+    rot_vecs1 = bvecs[:, :30]
+    rot_vecs2 = bvecs[:, 30:70]
+    fODF1 = np.random.rand(6, 30) * (np.random.rand(6, 30) > 0.7)
+    fODF2 = np.random.rand(6, 40) * (np.random.rand(6, 40) > 0.7)
+    fODF1[0, 0] = 1
+    fODF2[2] = 0
+
+    emd_batch = pn.fODF_EMD_batch(fODF1, fODF2, rot_vecs1, rot_vecs2)
+    for vox in range(fODF1.shape[0]):
+        idx1 = np.where(fODF1[vox] > 0)
+        idx2 = np.where(fODF2[vox] > 0)
+        if len(idx2[0]) == 0:
+            npt.assert_(np.isnan(emd_batch[vox]))
+            continue
+        npt.assert_almost_equal(emd_batch[vox],
+                                pn.fODF_EMD(fODF1[vox][idx1],
+                                            fODF2[vox][idx2],
+                                            rot_vecs1[:, idx1],
+                                            rot_vecs2[:, idx2]), decimal=5)
+
+    emd_threads = pn.fODF_EMD_batch(fODF1, fODF2, rot_vecs1, rot_vecs2,
+                                    n_threads=3)
+    npt.assert_equal(emd_threads, emd_batch)
+
+
+def test_fodf_sinkhorn():
+    bvecs = ozu.get_camino_pts(150)
+    rot_vecs1 = bvecs[:, :30]
+    rot_vecs2 = bvecs[:, 30:70]
+    fODF1 = np.random.rand(6, 30)
+    fODF2 = np.random.rand(6, 40) * (np.random.rand(6, 40) > 0.5)
+    fODF2[:, 0] = 1
+    fODF2[2] = 0
+
+    exact, report = pn.emd_mode_error(fODF1, fODF2, rot_vecs1, rot_vecs2,
+                                      emd_params_list=[dict(reg=0.05),
+                                                       dict(reg=0.01,
+                                                            n_iter=2000)])
+    approx = pn.fODF_EMD_batch(fODF1, fODF2, rot_vecs1, rot_vecs2,
+                               emd_mode="sinkhorn",
+                               emd_params=dict(reg=0.01, n_iter=2000))
+    npt.assert_(np.isnan(approx[2]))
+    npt.assert_almost_equal(approx, exact, decimal=2)
+    # The approximation improves with less regularization:
+    npt.assert_(report[1]["mean_error"] < report[0]["mean_error"])
+
+    npt.assert_almost_equal(pn.fODF_EMD(fODF1[0], fODF2[0], rot_vecs1,
+                                        rot_vecs2, emd_mode="sinkhorn"),
+                            exact[0], decimal=2)
+    npt.assert_raises(ValueError, pn.fODF_EMD_batch, fODF1, fODF2, rot_vecs1,
+                      rot_vecs2, emd_mode="emd")
+    npt.assert_raises(ValueError, pn.fODF_EMD, fODF1[0], fODF2[0], rot_vecs1,
+                      rot_vecs2, emd_mode="emd")
@@ -2,12 +2,14 @@ import os
 
 import osmosis as mt
 import osmosis.fibers as mtf
+import osmosis.utils as mtu
 
 import numpy as np
 import numpy.testing as npt
 import numpy.testing.decorators as dec
 
 import scipy.io as sio
+import scipy.linalg as la
 
 def test_Fiber():
     """
@@ -160,6 +162,45 @@ def test_Fiber_predicted_signal():
     sig = f1.predicted_signal(bvecs, bvals, ad, rd)
 
 
+def test_Fiber_tensors_closed_form():
+    """
+    Test that the tensors and signal along the fiber are the ones given by
+    rotating the diagonal tensor to the direction of the fiber
+    """
+    prng = np.random.RandomState(2013)
+    f1 = mtf.Fiber(np.cumsum(prng.randn(3, 6), -1))
+    bvecs = prng.randn(3, 10)
+    bvecs = bvecs / np.sqrt(np.sum(bvecs ** 2, 0))
+    bvecs[:, 0] = 0
+    bvals = np.ones(10) * 1.5
+    ad = 1.5
+    rd = 0.5
+
+    tensors = f1.tensors(ad, rd)
+    sig = f1.predicted_signal(bvecs, bvals, ad, rd)
+    npt.assert_equal(sig.shape, (6, 10))
+    for grad, Q, this_sig in zip(f1.gradients.T, tensors, sig):
+        usv = la.svd(np.matrix(grad))
+        evecs = np.matrix(usv[2])
+        Q_svd = evecs.T * np.matrix(np.diag([ad, rd, rd])) * evecs
+        npt.assert_almost_equal(Q.reshape(3, 3), Q_svd)
+        ADC = np.diag(np.matrix(bvecs).T * Q_svd * np.matrix(bvecs))
+        npt.assert_almost_equal(this_sig, np.exp(-bvals * ADC))
+    # No diffusion weighting, no signal loss:
+    npt.assert_almost_equal(sig[:, 0], 1)
+
+    # The compact fiber group does it for all the fibers at once:
+    fibers = [f1, mtf.Fiber(prng.randn(3, 2)), mtf.Fiber(prng.randn(3, 4))]
+    cfg = mtf.compact_fiber_group(mtf.FiberGroup(fibers))
+    npt.assert_almost_equal(cfg.gradients,
+                            np.hstack([f.gradients for f in fibers]))
+    npt.assert_almost_equal(cfg.tensors(ad, rd),
+                            np.vstack([f.tensors(ad, rd) for f in fibers]))
+    npt.assert_almost_equal(cfg.predicted_signal(bvecs, bvals, ad, rd),
+                            np.vstack([f.predicted_signal(bvecs, bvals, ad, rd)
+                                       for f in fibers]))
+
+
 def test_FiberGroup():
     """
     Testing intialization of FiberGroup class.
@@ -263,3 +304,175 @@ def test_FiberGroup_unique_coords():
                  mtf.Fiber([[x2,x1],[y2,y1],[z2,z1]])]).unique_coords,
             np.array([[x1,x2],[y1,y2],[z1,z2]]),decimal=4)
 
+
+
+def test_CompactFiberGroup():
+    """
+    Test the array-backed FiberGroup
+    """
+    pi_2 = np.pi/2
+    affine1 = np.matrix([[1, 0,             0,            0],
+                         [0, np.cos(pi_2), -np.sin(pi_2), 0],
+                         [0, np.sin(pi_2),  np.cos(pi_2), 0],
+                         [0, 0,             0,            1]])
+    f1 = mtf.Fiber([[1., 2, 1], [3, 4, 3], [5, 6, 5]],
+                   fiber_stats=dict(a=1, b=2),
+                   node_stats=dict(ecc=np.array([0.1, 0.2, 0.3])))
+    f2 = mtf.Fiber([[5., 5], [6, 7], [7, 8]], fiber_stats=dict(a=3),
+                   node_stats=dict(ecc=np.array([0.4, 0.5])))
+    fg = mtf.FiberGroup([f1, f2], affine=affine1)
+    cfg = mtf.compact_fiber_group(fg)
+
+    npt.assert_equal(cfg.n_fibers, fg.n_fibers)
+    npt.assert_equal(len(cfg), 2)
+    npt.assert_equal(cfg.n_nodes, fg.n_nodes)
+    npt.assert_equal(cfg.offsets, [0, 3, 5])
+    npt.assert_equal(cfg.fiber_lengths, [3, 2])
+    npt.assert_equal(cfg.fiber_index, [0, 0, 0, 1, 1])
+    npt.assert_equal(cfg.coords, fg.coords)
+    npt.assert_equal(cfg.unique_coords, fg.unique_coords)
+    npt.assert_equal(cfg.fiber_stats["a"], [1, 3])
+    # Missing stats are nans:
+    npt.assert_equal(cfg.fiber_stats["b"], [2, np.nan])
+    npt.assert_equal(cfg.node_stats["ecc"], [0.1, 0.2, 0.3, 0.4, 0.5])
+
+    # Indexing gives Fibers with views into the arrays:
+    npt.assert_equal(cfg[0].coords, f1.coords)
+    npt.assert_equal(cfg[-1].coords, f2.coords)
+    npt.assert_equal(cfg[1].node_stats["ecc"], [0.4, 0.5])
+    npt.assert_equal(cfg[1].fiber_stats["a"], 3)
+    npt.assert_(cfg[0].coords.base is not None)
+    npt.assert_raises(IndexError, cfg.__getitem__, 2)
+    npt.assert_equal([f.n_nodes for f in cfg], [3, 2])
+
+    # Transforming is the same as for the FiberGroup:
+    orig_coords = cfg.coords.copy()
+    cfg2 = cfg.xform(inplace=False)
+    fg.xform()
+    npt.assert_almost_equal(cfg2.coords, fg.coords)
+    npt.assert_almost_equal(cfg2.affine, fg.affine)
+    cfg.xform()
+    npt.assert_almost_equal(cfg.coords, fg.coords)
+    npt.assert_almost_equal(cfg.unique_coords, fg.coords[:, [0, 1, 3, 4]])
+    # And back:
+    cfg.xform()
+    npt.assert_almost_equal(cfg.coords, orig_coords)
+
+    fg2 = cfg.to_fiber_group()
+    npt.assert_equal(fg2.n_fibers, 2)
+    npt.assert_almost_equal(fg2.coords, cfg.coords)
+
+    npt.assert_raises(ValueError, mtf.CompactFiberGroup, np.zeros((4, 3)),
+                      [0, 3])
+    npt.assert_raises(ValueError, mtf.CompactFiberGroup, np.zeros((3, 3)),
+                      [0, 2])
+
+
+def test_NodeIndex():
+    """
+    Test the spatial index of the nodes of a fiber group
+    """
+    prng = np.random.RandomState(2013)
+    fibers = [mtf.Fiber(prng.rand(3, 1) * 8 +
+                        np.cumsum(prng.randn(3, n) * 0.7, -1))
+              for n in [5, 2, 8, 3, 6, 4]]
+    fg = mtf.FiberGroup(fibers)
+    idx = fg.node_index
+    cfg_idx = mtf.compact_fiber_group(fg).node_index
+    node_vox = fg.coords.astype(int)
+    fiber_index = np.repeat(np.arange(6), [5, 2, 8, 3, 6, 4])
+
+    # The voxels are in the same order as the unique rows:
+    npt.assert_equal(idx.voxels, mtu.unique_rows(node_vox.T).T)
+    npt.assert_equal(cfg_idx.voxels, idx.voxels)
+    npt.assert_equal(idx.voxels[:, idx.node_voxel], node_vox)
+
+    # Look up a few voxels with nodes and one without:
+    query = np.hstack([idx.voxels[:, [0, 3, 3]], [[100], [100], [100]]])
+    npt.assert_equal(idx.voxel_ids(query), [0, 3, 3, -1])
+    in_query = np.array([np.any(np.all(v[:, None] == query, 0))
+                         for v in node_vox.T])
+    npt.assert_equal(idx.nodes_in_voxels(query), np.where(in_query)[0])
+    npt.assert_equal(idx.fibers_in_voxels(query),
+                     np.unique(fiber_index[in_query]))
+    npt.assert_equal(len(idx.nodes_in_voxels([[100], [100], [100]])), 0)
+
+    # An ROI in a volume:
+    roi = np.zeros((20, 20, 20), dtype=bool)
+    roi[tuple(idx.voxels[:, 1])] = True
+    in_roi = np.all(node_vox == idx.voxels[:, 1:2], 0)
+    npt.assert_equal(idx.fibers_in_roi(roi), np.unique(fiber_index[in_roi]))
+
+    # Nearest nodes:
+    points = prng.rand(3, 10) * 8
+    dist, node, fiber = idx.nearest_node(points)
+    all_dist = np.sqrt(np.sum((points[:, :, None] -
+                               fg.coords[:, None, :]) ** 2, 0))
+    npt.assert_almost_equal(dist, np.min(all_dist, -1))
+    npt.assert_equal(node, np.argmin(all_dist, -1))
+    npt.assert_equal(fiber, fiber_index[node])
+    dist, node, fiber = idx.nearest_node(points[:, 0], tol=1e-6)
+    npt.assert_equal([node, fiber], [-1, -1])
+    npt.assert_equal(idx.fibers_near(points[:, 0], 2),
+                     np.unique(fiber_index[all_dist[0] <= 2]))
+
+
+def test_compress_fibers():
+    """
+    Test compressing the fibers to one node per voxel they pass through
+    """
+    prng = np.random.RandomState(2013)
+    fibers = [mtf.Fiber(prng.rand(3, 1) * 3 +
+                        np.cumsum(prng.randn(3, n) * 0.2, -1),
+                        node_stats=dict(fa=prng.rand(n)))
+              for n in [30, 2, 1, 15]]
+    fg = mtf.FiberGroup(fibers)
+    for this_fg in [fg, mtf.compact_fiber_group(fg)]:
+        compressed = mtf.compress_fibers(this_fg)
+        npt.assert_equal(type(compressed), type(this_fg))
+        cfg = mtf.compact_fiber_group(compressed) if isinstance(
+            compressed, mtf.FiberGroup) else compressed
+        npt.assert_(cfg.n_nodes < fg.n_nodes)
+        weights = cfg.node_stats[mtf.NODE_WEIGHT]
+        npt.assert_equal(np.sum(weights), fg.n_nodes)
+        for f_idx, f in enumerate(fibers):
+            vox = f.coords.astype(int)
+            # The same voxels, in the same order, without repeats:
+            keep = np.ones(vox.shape[-1], dtype=bool)
+            keep[1:] = np.any(vox[:, 1:] != vox[:, :-1], 0)
+            new_f = cfg[f_idx]
+            npt.assert_equal(new_f.coords.astype(int), vox[:, keep])
+            # The stats are averaged over the nodes in each voxel:
+            stretch = np.cumsum(keep) - 1
+            npt.assert_almost_equal(new_f.node_stats['fa'],
+                                    [np.mean(f.node_stats['fa'][stretch == s])
+                                     for s in range(np.sum(keep))])
+
+    # Compressing again changes nothing:
+    once = mtf.compress_fibers(mtf.compact_fiber_group(fg))
+    twice = mtf.compress_fibers(once)
+    npt.assert_almost_equal(twice.coords, once.coords)
+    npt.assert_equal(twice.node_stats[mtf.NODE_WEIGHT],
+                     once.node_stats[mtf.NODE_WEIGHT])
+
+
+def test_resample_fibers():
+    """
+    Test resampling the fibers at equal steps
+    """
+    # A straight fiber, 3 long, and a fiber with a single node:
+    f1 = mtf.Fiber(np.array([[0, 1, 1.5, 3], [0, 0, 0, 0], [1, 1, 1, 1]]),
+                   node_stats=dict(fa=np.array([0, 1, 1.5, 3.])))
+    f2 = mtf.Fiber(np.array([[1.], [2], [3]]), node_stats=dict(fa=[1.]))
+    cfg = mtf.compact_fiber_group(mtf.FiberGroup([f1, f2]))
+    resampled = mtf.resample_fibers(cfg, 0.7)
+    npt.assert_equal(resampled.fiber_lengths, [6, 1])
+    npt.assert_almost_equal(resampled[0].coords[0], np.linspace(0, 3, 6))
+    npt.assert_almost_equal(resampled[0].coords[1:],
+                            [[0] * 6, [1] * 6])
+    npt.assert_almost_equal(resampled[0].node_stats['fa'],
+                            np.linspace(0, 3, 6))
+    npt.assert_equal(resampled[1].coords, f2.coords)
+
+    fg = mtf.resample_fibers(mtf.FiberGroup([f1]), 1.5)
+    npt.assert_almost_equal(fg.fibers[0].coords[0], [0, 1.5, 3])
@@ -74,6 +74,115 @@ def test_pdb_from_fg():
     
     npt.assert_equal(fg2.fiber_stats, fg.fiber_stats)
 
+def test_read_pdb():
+    """
+    Test reading a pdb file into flat arrays
+    """
+    n_nodes = [4, 7, 1]
+    fibers = []
+    for ii, n in enumerate(n_nodes):
+        fibers.append(mtf.Fiber(np.arange(3 * n).reshape(3, n) + 10 * ii,
+                                fiber_stats=dict(foo=ii, bar=2.5 * ii),
+                                node_stats=dict(ecc=np.arange(n) + 0.5 * ii)))
+    fg = mtf.FiberGroup(fibers)
+    file_name = os.path.join(tempfile.mkdtemp(), 'fg.pdb')
+    mio.pdb_from_fg(fg, file_name)
+
+    pdb = mio.read_pdb(file_name)
+    npt.assert_equal(pdb["version"], 3)
+    npt.assert_equal(pdb["xform"], np.eye(4))
+    npt.assert_equal(pdb["offsets"], np.concatenate([[0], np.cumsum(n_nodes)]))
+    npt.assert_equal(pdb["coords"], np.hstack([f.coords for f in fibers]))
+    npt.assert_equal(pdb["fiber_stats"]["foo"], [0, 1, 2])
+    npt.assert_equal(pdb["fiber_stats"]["bar"], [0, 2.5, 5])
+    npt.assert_equal(pdb["node_stats"]["ecc"],
+                     np.hstack([f.node_stats["ecc"] for f in fibers]))
+    npt.assert_equal(sorted(pdb["stats_header"]["local_name"]),
+                     ["bar", "ecc", "foo"])
+
+    fg2 = mio.fg_from_pdb(file_name, verbose=False)
+    for f, f2 in zip(fibers, fg2.fibers):
+        npt.assert_equal(f2.coords, f.coords)
+        npt.assert_equal(f2.node_stats, f.node_stats)
+        npt.assert_equal(f2.fiber_stats, f.fiber_stats)
+
+    # A compact FiberGroup holds the arrays read from the file:
+    cfg = mio.fg_from_pdb(file_name, verbose=False, compact=True)
+    npt.assert_equal(cfg.coords, pdb["coords"])
+    npt.assert_equal(cfg.offsets, pdb["offsets"])
+    npt.assert_equal(cfg[1].coords, fibers[1].coords)
+    npt.assert_equal(cfg.name, fg2.name)
+    # And can be saved as is:
+    mio.pdb_from_fg(cfg, file_name, verbose=False)
+    npt.assert_equal(mio.read_pdb(file_name)["node_stats"]["ecc"],
+                     pdb["node_stats"]["ecc"])
+
+def test_pdb_from_batches():
+    """
+    Test writing a pdb file from batches of fibers
+    """
+    fibers = []
+    for ii, n in enumerate([4, 7, 1, 3]):
+        fibers.append(mtf.Fiber(np.arange(3 * n).reshape(3, n) + 10 * ii,
+                                fiber_stats=dict(foo=ii),
+                                node_stats=dict(ecc=np.arange(n) + 0.5 * ii)))
+    temp_dir = tempfile.mkdtemp()
+    fg = mtf.FiberGroup(fibers)
+    mio.pdb_from_fg(fg, os.path.join(temp_dir, 'fg.pdb'))
+    pdb = mio.read_pdb(os.path.join(temp_dir, 'fg.pdb'))
+
+    # Batches can be lists of fibers, FiberGroups, or arrays read from file:
+    batches = [fibers[:1], mtf.FiberGroup(fibers[1:3]), [fibers[3]], pdb]
+    n_fibers = mio.pdb_from_batches(batches,
+                                    os.path.join(temp_dir, 'batches.pdb'))
+    npt.assert_equal(n_fibers, 2 * len(fibers))
+    pdb2 = mio.read_pdb(os.path.join(temp_dir, 'batches.pdb'))
+    npt.assert_equal(pdb2["offsets"],
+                     np.concatenate([pdb["offsets"],
+                                     pdb["offsets"][1:] + pdb["offsets"][-1]]))
+    npt.assert_equal(pdb2["coords"], np.hstack([pdb["coords"]] * 2))
+    npt.assert_equal(pdb2["fiber_stats"]["foo"], [0, 1, 2, 3] * 2)
+    npt.assert_equal(pdb2["node_stats"]["ecc"],
+                     np.hstack([pdb["node_stats"]["ecc"]] * 2))
+
+    npt.assert_raises(ValueError, mio.pdb_from_batches, [],
+                      os.path.join(temp_dir, 'empty.pdb'))
+
+def test_iter_fibers():
+    """
+    Test reading fibers from pdb and trk files in batches
+    """
+    fibers = []
+    for ii, n in enumerate([4, 7, 2, 3, 5]):
+        fibers.append(mtf.Fiber(np.arange(3 * n).reshape(3, n) + 10. * ii,
+                                fiber_stats=dict(foo=ii),
+                                node_stats=dict(ecc=np.arange(n) + 0.5 * ii)))
+    temp_dir = tempfile.mkdtemp()
+    fg = mtf.FiberGroup(fibers)
+    pdb_file = os.path.join(temp_dir, 'fg.pdb')
+    mio.pdb_from_fg(fg, pdb_file, verbose=False)
+
+    trk_file = os.path.join(temp_dir, 'fg.trk')
+    hdr = mio.tv.empty_header()
+    mio.tv.aff_to_hdr(np.eye(4), hdr)
+    mio.tv.write(trk_file, [(f.coords.T.astype(np.float32), None, None)
+                            for f in fibers], hdr)
+
+    for fn in [pdb_file, trk_file, fg]:
+        batches = list(mio.iter_fibers(fn, batch_size=2))
+        npt.assert_equal([len(b) for b in batches], [2, 2, 1])
+        npt.assert_almost_equal(np.hstack([b.coords for b in batches]),
+                                fg.coords)
+        if fn == pdb_file:
+            npt.assert_equal(np.hstack([b.fiber_stats["foo"]
+                                        for b in batches]), range(5))
+            npt.assert_equal(np.hstack([b.node_stats["ecc"]
+                                        for b in batches]),
+                             np.hstack([f.node_stats["ecc"] for f in fibers]))
+
+    # Without a batch size, all the fibers come in one batch:
+    npt.assert_equal([len(b) for b in mio.iter_fibers(fg, None)], [5])
+
 def test_fg_from_trk():
     """
     Test reading of trk files into a FiberGroup
@@ -89,3 +198,90 @@ def test_fg_from_trk():
     
 
 
+
+
+def test_place_shards():
+    temp_dir = tempfile.mkdtemp()
+    n_vox = 23
+    shard_size = 10
+    full = np.random.RandomState(2013).rand(n_vox, 4)
+    # Shard 1 leaves out the voxels with no signal:
+    vox_mask = np.ones(n_vox, dtype=bool)
+    vox_mask[[12, 15]] = False
+    mio.save_shard(full[0:10], "out_", 0, 0, 10, file_path=temp_dir)
+    mio.save_shard(full[10:20][vox_mask[10:20]], "out_", 1, 10, 20,
+                   file_path=temp_dir)
+    # A file that shares the prefix, but is not a shard of this output:
+    np.save(os.path.join(temp_dir, "out_other0.npy"), np.zeros(3))
+
+    missing, aggre = mio.place_shards("out_", 3, n_vox, file_path=temp_dir,
+                                      vox_mask=vox_mask)
+    npt.assert_equal(missing, [2])
+    npt.assert_equal(aggre[:20][vox_mask[:20]], full[:20][vox_mask[:20]])
+    npt.assert_(np.all(np.isnan(aggre[20:])))
+    npt.assert_(np.all(np.isnan(aggre[[12, 15]])))
+
+    # Memory-mapped output:
+    out_file = os.path.join(temp_dir, "aggre.npy")
+    mio.place_shards("out_", 3, n_vox, file_path=temp_dir, out_file=out_file,
+                     vox_mask=vox_mask)
+    npt.assert_equal(np.load(out_file), aggre)
+
+    # place_files uses the manifests too:
+    mask = np.zeros((3, 3, 3))
+    mask[np.unravel_index(np.arange(n_vox), mask.shape)] = 1
+    mask_idx = np.where(mask)
+    data = np.ones(mask.shape + (4,))
+    data[mask_idx[0][[12, 15]], mask_idx[1][[12, 15]],
+         mask_idx[2][[12, 15]], :2] = 0
+    missing_list, aggre_list = mio.place_files(["out_"], shard_size, 3, mask,
+                                               data,
+                                               np.array([0, 0, 1000, 1000]),
+                                               file_path=temp_dir)
+    npt.assert_equal(missing_list[0], 2)
+    npt.assert_equal(aggre_list[0], aggre)
+
+
+def test_data_shards():
+    temp_dir = tempfile.mkdtemp()
+    rs = np.random.RandomState(2013)
+    data = rs.randint(0, 1000, (3, 4, 5, 6)).astype(np.int16)
+    bvals = np.array([0, 0, 1000, 1000, 2000, 2000])
+    bvecs = rs.randn(3, 6)
+    mask = rs.rand(3, 4, 5) > 0.5
+    mask_idx = np.where(mask)
+    n_vox = len(mask_idx[0])
+    shard_size = 7
+    shard_path = os.path.join(temp_dir, "shards")
+    n_shards = mio.write_data_shards(data, bvals, bvecs, mask, shard_size,
+                                     shard_path)
+    npt.assert_equal(n_shards, int(np.ceil(n_vox / float(shard_size))))
+
+    for i in range(n_shards):
+        low = i * shard_size
+        high = min((i + 1) * shard_size, n_vox)
+        this_data, this_bvals, this_bvecs, this_mask, manifest = \
+            mio.load_data_shard(i, shard_path)
+        npt.assert_equal(this_data.shape, (high - low, 1, 1, data.shape[-1]))
+        npt.assert_equal(this_data.dtype, data.dtype)
+        npt.assert_equal(this_data[this_mask], data[mask][low:high])
+        npt.assert_equal(this_bvals, bvals)
+        npt.assert_equal(this_bvecs, bvecs)
+        npt.assert_equal((manifest["low"], manifest["high"]), (low, high))
+        npt.assert_equal(tuple(manifest["vox_idx"].T),
+                         tuple([idx[low:high] for idx in mask_idx]))
+
+    # The templates read the shards, if they are in the subject directory:
+    job = mio.job_data(temp_dir, 1, shard_size=shard_size)
+    npt.assert_equal(job[0][job[3]], data[mask][shard_size:2 * shard_size])
+    npt.assert_equal(job[4:], (shard_size, 2 * shard_size))
+    job = mio.job_data(temp_dir, n_shards - 1, shard_size=shard_size)
+    npt.assert_equal(job[4:], ((n_shards - 1) * shard_size, n_vox))
+    # Blocks of another size would not match the shards:
+    for i, other_size in [(0, shard_size + 1), (0, shard_size - 1),
+                          (n_shards - 1, shard_size - 1),
+                          (n_shards, shard_size),
+                          (2 * n_shards, shard_size / 2)]:
+        npt.assert_raises(ValueError, mio.job_data, temp_dir, i,
+                          shard_size=other_size)
+    npt.assert_raises(IOError, mio.load_data_shard, n_shards, shard_path)
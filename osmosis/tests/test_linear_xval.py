@@ -0,0 +1,71 @@
+import numpy as np
+import numpy.testing as npt
+
+import scipy.optimize as opt
+from sklearn.linear_model import ElasticNet
+
+import osmosis.linear_xval as lxv
+
+np.random.seed(2013)
+
+X = np.random.randn(40, 6)
+beta_t = np.abs(np.random.randn(6, 3))
+Y = np.dot(X, beta_t) + 0.1 * np.random.randn(40, 3)
+folds = [np.arange(ii, 40, 4) for ii in range(4)]
+
+
+def _keep(held_out):
+    return np.setdiff1d(np.arange(X.shape[0]), held_out)
+
+
+def test_downdate():
+    full = lxv.gram_system(X, Y)
+    held_out = folds[0]
+    keep = _keep(held_out)
+    fold = full.downdate(X[held_out], Y[held_out])
+    direct = lxv.gram_system(X[keep], Y[keep])
+    npt.assert_almost_equal(fold.gram, direct.gram)
+    npt.assert_almost_equal(fold.XtY, direct.XtY)
+    npt.assert_almost_equal(fold.x_sum, direct.x_sum)
+    npt.assert_equal(fold.n_obs, len(keep))
+
+
+def test_kfold_xval_linear_ols():
+    predicted, params = lxv.kfold_xval_linear(X, Y, folds, solver="LR")
+    for held_out, (beta, intercept) in zip(folds, params):
+        keep = _keep(held_out)
+        beta_direct = np.linalg.lstsq(X[keep], Y[keep], rcond=-1)[0]
+        npt.assert_almost_equal(beta, beta_direct)
+        npt.assert_almost_equal(predicted[held_out],
+                                np.dot(X[held_out], beta_direct))
+
+
+def test_kfold_xval_linear_nnls():
+    YY = Y - 2 * X[:, :1] # Make sure some of the weights go to 0
+    predicted, params = lxv.kfold_xval_linear(X, YY, folds, solver="nnls",
+                                              tol=1e-10)
+    for held_out, (beta, intercept) in zip(folds, params):
+        keep = _keep(held_out)
+        for target in range(YY.shape[-1]):
+            beta_direct = opt.nnls(X[keep], YY[keep, target])[0]
+            npt.assert_almost_equal(beta[:, target], beta_direct, decimal=5)
+
+
+def test_kfold_xval_linear_elastic_net():
+    solver_params = dict(alpha=0.01, l1_ratio=0.6, fit_intercept=True,
+                         positive=True)
+    predicted, params = lxv.kfold_xval_linear(X, Y + 1, folds,
+                                              solver="ElasticNet",
+                                              solver_params=solver_params,
+                                              tol=1e-10)
+    for held_out, (beta, intercept) in zip(folds, params):
+        keep = _keep(held_out)
+        for target in range(Y.shape[-1]):
+            en = ElasticNet(tol=1e-10, max_iter=10000, **solver_params)
+            en.fit(X[keep], Y[keep, target] + 1)
+            npt.assert_almost_equal(beta[:, target], en.coef_, decimal=4)
+            npt.assert_almost_equal(intercept[target], en.intercept_,
+                                    decimal=4)
+
+    npt.assert_raises(ValueError, lxv.kfold_xval_linear, X, Y, folds,
+                      "Lasso")
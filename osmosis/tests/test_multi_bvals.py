@@ -3,6 +3,7 @@ import osmosis.tensor as ozt
 import numpy.testing as npt
 
 import osmosis.model.sparse_deconvolution as sfm
+import osmosis.utils as ozu
 
 # Fix the random seed:
 np.random.seed(10)
@@ -165,3 +166,30 @@ def test_predict():
                             
         npt.assert_equal(abs(np.squeeze(out_t[vox]) - mb_MD.predict(bvec_t,
                                            np.array([2000]))[np.where(mask_t)][vox]) < 30, 1)
+
+
+def test_flat_data():
+    # A model initialized with the masked data, flattened to voxels by
+    # volumes, should give the same answers as one initialized with the
+    # full volume:
+    flat_data, flat_mask = ozu.flat_data_mask(data_t, mask_t)
+    for mean in ["mean_model", "MD"]:
+        mb_vol = sfm.SparseDeconvolutionModelMultiB(data_t, bvecs_t, bvals_t,
+                                                    mask = mask_t,
+                                                    axial_diffusivity = ad,
+                                                    radial_diffusivity = rd,
+                                                    mean = mean, solver = "nnls",
+                                                    params_file = 'temp')
+        mb_flat = sfm.SparseDeconvolutionModelMultiB(flat_data, bvecs_t,
+                                                     bvals_t, mask = flat_mask,
+                                                     axial_diffusivity = ad,
+                                                     radial_diffusivity = rd,
+                                                     mean = mean,
+                                                     solver = "nnls",
+                                                     params_file = 'temp')
+        npt.assert_equal(mb_flat.mask.shape, (4,))
+        npt.assert_almost_equal(mb_flat.model_params[mb_flat.mask],
+                                mb_vol.model_params[mb_vol.mask])
+        npt.assert_almost_equal(
+            mb_flat.predict(bvecs_t[:, 3:], bvals_t[3:])[mb_flat.mask],
+            mb_vol.predict(bvecs_t[:, 3:], bvals_t[3:])[mb_vol.mask])
@@ -0,0 +1,42 @@
+import numpy as np
+import numpy.testing as npt
+
+import scipy.sparse as sps
+import scipy.optimize as opt
+
+import osmosis.nnls as onn
+
+prng = np.random.RandomState(2013)
+X = sps.rand(300, 60, density=0.2, random_state=prng, format='csr')
+y = X * prng.randn(60) + 0.1 * prng.randn(300)
+w_nnls = opt.nnls(X.toarray(), y)[0]
+
+
+def test_sparse_nnls():
+    w = onn.sparse_nnls(X, y, tol=1e-10, max_iter=10000)
+    npt.assert_almost_equal(w, w_nnls, decimal=6)
+    # Some of them should be at the constraint:
+    npt.assert_(np.any(w == 0))
+    npt.assert_(np.all(w >= 0))
+
+    # Splitting the products into threads gives the same answer:
+    w_threads = onn.sparse_nnls(X, y, tol=1e-10, max_iter=10000, n_threads=3)
+    npt.assert_almost_equal(w_threads, w, decimal=10)
+
+    # Columns can be provided in a few matrices:
+    w_split = onn.sparse_nnls((X[:, :40], X[:, 40:]), y, tol=1e-10,
+                              max_iter=10000)
+    npt.assert_almost_equal(w_split, w, decimal=6)
+
+    npt.assert_equal(onn.sparse_nnls(X, np.zeros(300)), np.zeros(60))
+
+
+def test_sparse_nnls_warm_start():
+    w = onn.sparse_nnls(X, y, tol=1e-10, max_iter=10000)
+    # Add some columns at the end and start from the previous solution:
+    X_more = sps.hstack([X, sps.rand(300, 5, density=0.2, random_state=prng)])
+    w_more = onn.sparse_nnls(X_more, y, w0=w, tol=1e-10, max_iter=10000)
+    npt.assert_almost_equal(w_more, opt.nnls(X_more.toarray(), y)[0],
+                            decimal=6)
+    # Starting at the solution, we are done right away:
+    npt.assert_equal(onn.sparse_nnls(X, y, w0=w, tol=1e-6, max_iter=1), w)
@@ -0,0 +1,193 @@
+import os
+import tempfile
+
+import numpy as np
+import numpy.testing as npt
+
+import osmosis.parallel.local as local
+
+# The directory with the osmosis package:
+osmosis_path = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(local.__file__))))
+
+# Each job saves the linear index of its voxels. Shard 1 fails the first time
+# it is run:
+template = """
+import os
+import numpy as np
+
+if __name__=="__main__":
+    low = i * shard_size
+    high = np.min([(i + 1) * shard_size, n_vox])
+    if i == 1 and not os.path.exists("failed_once"):
+        open("failed_once", "w").close()
+        raise ValueError("Failing on purpose")
+    np.save("out_%03d.npy"%i, np.arange(low, high)[:, None] * [1, 2])
+"""
+
+def test_shard_mask():
+    mask = np.zeros((3, 4, 5))
+    mask[1:, 1:3, 2:] = 1
+    n_vox = int(np.sum(mask))
+    shards = [local.shard_mask(mask, i, 5)
+              for i in range(local.n_shards(n_vox, 5))]
+    npt.assert_equal(len(shards), 3)
+    npt.assert_equal(np.sum(shards, 0), mask)
+    npt.assert_equal(np.sum(shards[-1]), n_vox - 10)
+
+
+def test_run_template():
+    mask = np.zeros((3, 4, 5))
+    mask[1:, 1:3, 2:] = 1
+    n_vox = int(np.sum(mask))
+    shard_size = 5
+    script_dir = tempfile.mkdtemp()
+
+    params_list = local.shard_params(dict(shard_size=shard_size, n_vox=n_vox),
+                                     n_vox, shard_size)
+    failed = local.run_template(template, params_list, script_dir,
+                                name="test", n_procs=2, retries=1,
+                                verbose=False)
+    npt.assert_equal(failed, [])
+
+    file_list = [os.path.join(script_dir, "out_%03d.npy"%i)
+                 for i in range(len(params_list))]
+    vol, missing = local.reassemble(file_list, mask, shard_size)
+    npt.assert_equal(missing, [])
+    npt.assert_equal(vol.shape, mask.shape + (2,))
+    npt.assert_equal(vol[np.where(mask)][:, 1], 2 * np.arange(n_vox))
+    npt.assert_(np.all(np.isnan(vol[np.where(mask == 0)])))
+
+    # Without retries, the failing job is reported:
+    os.remove(os.path.join(script_dir, "failed_once"))
+    failed = local.run_template(template, params_list, script_dir,
+                                name="test", n_procs=2, retries=0,
+                                verbose=False)
+    npt.assert_equal(failed, [os.path.join(script_dir, "test_001.py")])
+
+
+def test_cost_bounds():
+    # The second half of the items cost three times as much:
+    costs = np.concatenate([np.ones(40), 3 * np.ones(40)])
+    bounds = local.cost_bounds(costs, 4)
+    npt.assert_equal(bounds, [(0, 40), (40, 53), (53, 67), (67, 80)])
+    shard_costs = [np.sum(costs[low:high]) for low, high in bounds]
+    npt.assert_(np.max(shard_costs) - np.min(shard_costs) <= 3)
+
+    # Shards are not left empty, as long as there are enough items:
+    bounds = local.cost_bounds([100, 1, 1, 1], 4)
+    npt.assert_equal(bounds, [(0, 1), (1, 2), (2, 3), (3, 4)])
+
+
+def test_voxel_costs():
+    timed = []
+    def time_func(low, high):
+        timed.append((low, high))
+    costs = local.voxel_costs(time_func, 100, n_pilot=5, pilot_size=10)
+    npt.assert_equal(costs.shape, (100,))
+    npt.assert_equal(len(timed), 5)
+    npt.assert_equal(timed[0], (0, 10))
+    npt.assert_equal(timed[-1], (90, 100))
+
+
+def test_job_blocks():
+    costs = np.concatenate([np.ones(40), 3 * np.ones(40)])
+    plan = local.block_plan(costs, 2, 10)
+    npt.assert_equal(plan["jobs"], [[0, 1, 2, 3, 4], [5, 6, 7]])
+    npt.assert_equal(plan["block_costs"], [10] * 4 + [30] * 4)
+
+    plan_file = os.path.join(tempfile.mkdtemp(), "plan.json")
+    local.write_plan(plan, plan_file)
+    # Job 1 runs through its own blocks first and then takes blocks of job 0,
+    # from the back, while job 0 is still working on its first block:
+    job0 = local.job_blocks(0, plan_file)
+    npt.assert_equal(next(job0), 0)
+    npt.assert_equal(list(local.job_blocks(1, plan_file)),
+                     [5, 6, 7, 4, 3, 2, 1])
+    npt.assert_equal(list(job0), [])
+
+    # Without a plan, job i works on block i:
+    npt.assert_equal(list(local.job_blocks(3)), [3])
+
+
+# Each job saves the linear index of the voxels of its blocks. Block 2 fails
+# the first time it is run:
+plan_template = """
+import os
+import sys
+import numpy as np
+sys.path.insert(0, osmosis_path)
+import osmosis.parallel.local as local
+
+if __name__=="__main__":
+    for b in local.job_blocks(i, plan_file):
+        low = b * block_size
+        high = np.min([(b + 1) * block_size, n_vox])
+        if b == 2 and not os.path.exists("failed_once"):
+            open("failed_once", "w").close()
+            raise ValueError("Failing on purpose")
+        np.save("out_%03d.npy"%b, np.arange(low, high)[:, None] * [1, 2])
+"""
+
+def test_run_plan():
+    mask = np.zeros((3, 4, 5))
+    mask[1:, 1:3, 2:] = 1
+    n_vox = int(np.sum(mask))
+    block_size = 3
+    script_dir = tempfile.mkdtemp()
+
+    plan = local.block_plan(np.linspace(1, 2, n_vox), 3, block_size)
+    # The jobs import osmosis from here, also if it is not installed:
+    params_dict = dict(n_vox=n_vox, osmosis_path=osmosis_path)
+    undone = local.run_plan(plan_template, params_dict, plan,
+                            script_dir, name="test", n_procs=2, retries=1,
+                            verbose=False)
+    npt.assert_equal(undone, [])
+
+    n_blocks = local.n_shards(n_vox, block_size)
+    file_list = [os.path.join(script_dir, "out_%03d.npy"%b)
+                 for b in range(n_blocks)]
+    vol, missing = local.reassemble(file_list, mask, block_size)
+    npt.assert_equal(missing, [])
+    npt.assert_equal(vol[np.where(mask)][:, 1], 2 * np.arange(n_vox))
+
+    # Without retries, the block that failed is reported:
+    os.remove(os.path.join(script_dir, "failed_once"))
+    undone = local.run_plan(plan_template, params_dict, plan,
+                            script_dir, name="test", n_procs=2, retries=0,
+                            verbose=False)
+    npt.assert_equal(undone, [2])
+
+
+def _free_names(code):
+    """
+    The names a script reads at the top level without defining them
+    """
+    import symtable
+    import __builtin__
+    table = symtable.symtable(code, "<template>", "exec")
+    return set([s.get_name() for s in table.get_symbols()
+                if s.is_referenced() and not s.is_assigned() and
+                not s.is_imported() and
+                s.get_name() not in dir(__builtin__)])
+
+
+def test_wrapper_templates():
+    # Render the templates with the parameters given to them by
+    # osmosis/scripts/all_brain_analyses_wrapper.py (qsub_cmd_gen):
+    params_dict = dict(i=0, sid="100307", fODF="multi", im="bi_exp_rs",
+                       data_path="/tmp", plan_file=None, block_size=2000)
+    template_path = os.path.dirname(os.path.abspath(local.__file__))
+    for name in ["emd", "accuracy", "im_accuracy", "model_params"]:
+        these_params = dict(params_dict)
+        if name == "im_accuracy":
+            these_params.pop("fODF")
+        template = open(os.path.join(template_path,
+                                     "%s_template.py"%name)).read()
+        code = local.add_params(template, these_params)
+        compile(code, "%s_template.py"%name, "exec")
+        # Everything the template reads is defined:
+        npt.assert_equal(_free_names(code), set())
+        # Without them, the template would fail on these:
+        npt.assert_(set(["plan_file", "block_size"]) <=
+                    _free_names(template))
@@ -178,3 +178,39 @@ def test_predict_bvals():
     npt.assert_(rmse02<300)
     npt.assert_(rmse22<300)
     npt.assert_(rmse20<300)
+
+def test_new_mean_combos():
+    b_inds_pv = ozu.separate_bvals(bvals_pv)[1]
+    vec_pool_inds = np.arange(3)
+    cache = {}
+    sig_out, new_params, inds = pn.new_mean_combos(vec_pool_inds, data_pv,
+                                                   bvals_pv, bvecs_pv,
+                                                   mask_pv, b_inds_pv,
+                                                   b_idx1=0, cache=cache)
+    # Compare to fitting a model object to the reduced data:
+    left_out = b_inds_pv[1:][0][vec_pool_inds]
+    inds_arr = np.setdiff1d(np.arange(len(bvals_pv)), left_out)
+    mod = sfm.SparseDeconvolutionModelMultiB(data_pv[..., inds_arr],
+                                             bvecs_pv[:, inds_arr],
+                                             bvals_pv[inds_arr],
+                                             mask = mask_pv,
+                                             params_file = "temp")
+    npt.assert_almost_equal(sig_out, mod.fit_flat_rel_sig_avg[0], decimal=4)
+    npt.assert_almost_equal(new_params, mod.fit_flat_rel_sig_avg[1],
+                            decimal=3)
+    npt.assert_equal(len(cache), 1)
+
+    # Warm starts from the fit to all the data get to the same place:
+    full_mod = sfm.SparseDeconvolutionModelMultiB(data_pv, bvecs_pv, bvals_pv,
+                                                  mask = mask_pv,
+                                                  params_file = "temp")
+    warm = pn.new_mean_combos(vec_pool_inds, data_pv, bvals_pv, bvecs_pv,
+                              mask_pv, b_inds_pv, b_idx1=0,
+                              initial=full_mod.fit_flat_rel_sig_avg[1])
+    npt.assert_almost_equal(warm[0], sig_out, decimal=3)
+
+    # The same fold is only fit once:
+    cached = pn.new_mean_combos(vec_pool_inds, data_pv, bvals_pv, bvecs_pv,
+                                mask_pv, b_inds_pv, b_idx1=0, cache=cache)
+    npt.assert_(cached[0] is sig_out)
+    npt.assert_equal(cached[2], inds)
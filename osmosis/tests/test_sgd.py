@@ -23,6 +23,20 @@ def test_sgd():
     npt.assert_array_almost_equal(beta, beta_hat, decimal=1)
     npt.assert_array_almost_equal(beta, beta_hat_sparse, decimal=1)
 
+
+def test_sgd_sparse():
+    """
+    Test SGD on a larger sparse problem, in which each iteration only visits a
+    small block of the rows
+    """
+    prng = np.random.RandomState(2013)
+    X = sps.rand(20000, 200, density=0.01, format='csr', random_state=prng)
+    beta = prng.rand(200)
+    y = X * beta
+    beta_hat = sgd(y, X, plot=False, verbose=False, step_size=0.05)
+    npt.assert_(np.corrcoef(beta, beta_hat)[0, 1] > 0.99)
+    npt.assert_(np.all(beta_hat >= 0))
+
     
 if __name__=="__main__":
      test_sgd()
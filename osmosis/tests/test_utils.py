@@ -267,3 +267,70 @@ def test_xform():
     aff = np.eye(3)
     
     npt.assert_raises(ValueError, ozu.xform, coords, aff)
+
+
+def test_fold_plan():
+    """
+    Testing the indices generated for k-fold cross-validation
+    """
+    bvals = np.array([0, 0, 1000, 2000, 1000, 2000, 1000, 2000, 1000, 2000,
+                      1000, 2000])
+    bvecs = np.random.randn(3, len(bvals))
+    data = np.random.rand(2, 2, 2, len(bvals))
+    these_b_inds = np.arange(2, len(bvals))
+    these_b_inds_rm0 = np.arange(len(these_b_inds))
+    all_inc_0 = np.arange(len(bvals))
+    vec_pool = np.arange(len(these_b_inds))
+    np.random.shuffle(vec_pool)
+    num_choose = 2
+
+    plan = ozu.fold_plan(these_b_inds, these_b_inds_rm0, all_inc_0, vec_pool,
+                         num_choose, 5)
+    npt.assert_equal(len(plan), 5)
+
+    left_out = []
+    for combo_num, fold in enumerate(plan):
+        si, vec_combo, vec_combo_rm0, vec_pool_inds, these_inc0 = fold
+        # Nothing that is left out should be fit to:
+        npt.assert_equal(np.intersect1d(these_inc0, vec_combo).shape[0], 0)
+        npt.assert_equal(np.intersect1d(si, vec_combo_rm0).shape[0], 0)
+        npt.assert_equal(np.union1d(these_inc0, vec_combo), all_inc_0)
+        npt.assert_equal(these_inc0, np.sort(these_inc0))
+        left_out.append(vec_combo)
+
+        # The data-copying version should agree:
+        combos = ozu.create_combos(bvecs, bvals, data, these_b_inds,
+                                   these_b_inds_rm0, all_inc_0, vec_pool,
+                                   num_choose, combo_num)
+        npt.assert_equal(combos[0], si)
+        npt.assert_equal(combos[-1], these_inc0)
+        npt.assert_equal(combos[6], data[..., these_inc0])
+
+    # Every direction is left out exactly once:
+    npt.assert_equal(np.sort(np.concatenate(left_out)), these_b_inds)
+
+
+def test_flat_data_mask():
+    data = np.random.rand(2, 3, 4, 5)
+    mask = np.zeros((2, 3, 4))
+    mask[0, 1] = 1
+    flat_data, flat_mask = ozu.flat_data_mask(data, mask)
+    npt.assert_equal(flat_data, data[np.where(mask)])
+    npt.assert_equal(flat_mask.shape, (4,))
+    npt.assert_(np.all(flat_mask))
+
+
+def test_nearest_coords():
+    """
+    Test finding the nearest voxels with data for many coordinates at once
+    """
+    prng = np.random.RandomState(2013)
+    vol = prng.rand(8, 8, 8)
+    vol[vol > 0.1] = np.nan
+    in_coords = prng.rand(3, 20) * 8
+    in_coords[:, 0] = 100
+    out_coords, found = ozu.nearest_coords(vol, in_coords, tol=10)
+    npt.assert_equal(found[0], False)
+    for idx in np.where(found)[0]:
+        near = ozu.nearest_coord(vol, in_coords[:, idx], tol=10)
+        npt.assert_equal(vol[tuple(out_coords[:, idx])], vol[near][0])
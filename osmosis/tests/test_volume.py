@@ -5,6 +5,7 @@ import numpy.testing as npt
 import nibabel as ni
 
 import osmosis as oz
+import osmosis.utils as ozu
 import osmosis.volume as ozv
 import osmosis.io as oio
 import osmosis.fibers as ozf
@@ -36,6 +37,55 @@ def test_fg2volume():
     vol = ozv.fg2volume(fg, 'fp20110912_ecc.nii.gz',
                         shape=ni.load(nii_file).get_shape())
 
+def test_fg2volume_nii2fg():
+    """
+    Test projecting fiber stats into a volume and sampling a volume onto the
+    fibers
+    """
+    prng = np.random.RandomState(2013)
+    fibers = [ozf.Fiber(prng.rand(3, 1) * 6 + 1 +
+                        np.outer(prng.randn(3), np.arange(n) * 0.4))
+              for n in [4, 6, 3, 5]]
+    fg = ozf.FiberGroup(fibers)
+    fg.fiber_stats['foo'] = [1., 2., 3., 4.]
+    coords = fg.coords.copy()
+    # Move everything by one voxel:
+    affine = np.eye(4)
+    affine[:3, 3] = 1
+    shape = (10, 10, 10)
+
+    vol = ozv.fg2volume(fg, 'foo', shape=shape, affine=affine)
+    # The original fibers are not changed:
+    npt.assert_equal(fg.coords, coords)
+    total = np.zeros(shape)
+    count = np.zeros(shape)
+    for f, stat in zip(fibers, fg.fiber_stats['foo']):
+        for node in (f.coords.T + 1).astype(int):
+            total[tuple(node)] += stat
+            count[tuple(node)] += 1
+    npt.assert_equal(np.isnan(vol), count == 0)
+    npt.assert_almost_equal(vol[count > 0],
+                            total[count > 0] / count[count > 0])
+    # The same, for a compact fiber group:
+    cfg = ozf.compact_fiber_group(fg)
+    npt.assert_equal(ozv.fg2volume(cfg, 'foo', shape=shape, affine=affine),
+                     vol)
+
+    # Sample data from the voxels nearest to the ends of each fiber:
+    data = prng.rand(*shape)
+    data[:5] = np.nan
+    nii = ni.Nifti1Image(data, np.linalg.inv(affine))
+    for data_node in [0, -1]:
+        fg_stat = ozv.nii2fg(fg, nii, data_node=data_node, stat_name='bar')
+        npt.assert_equal(fg.coords, coords)
+        for f_idx, f in enumerate(fibers):
+            near = ozu.nearest_coord(data, f.coords[:, data_node] + 1)
+            npt.assert_almost_equal(fg_stat.fiber_stats['bar'][f_idx],
+                                    data[near][0])
+        fg_stat = ozv.nii2fg(cfg, nii, data_node=data_node, stat_name='bar')
+        npt.assert_almost_equal(fg_stat.fiber_stats['bar'],
+                    ozv.nii2fg(fg, nii, data_node, 'bar').fiber_stats['bar'])
+
 def test_resample_volume():
     """
     Testing resampling of one volume into another volumes space (a t1 into a
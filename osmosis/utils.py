@@ -9,6 +9,7 @@ import numpy as np
 import scipy
 import scipy.linalg as la
 import scipy.stats as stats
+import scipy.spatial as spatial
 
 import dipy.core.geometry as geo
 
@@ -124,18 +125,14 @@ def unique_rows(in_array, dtype='f4'):
        Array with the unique rows of the original array.
     
     """
-    x = np.array([tuple(in_array.T[:,i]) for i in
-                  xrange(in_array.shape[0])],
-        dtype=(''.join(['%s,'%dtype]* in_array.shape[-1])[:-1])) 
-
-    u,i = np.unique(x, return_index=True)
-    u_i = x[np.sort(i)]
-    u_return = np.empty((in_array.shape[-1],len(u_i)))
-    for j in xrange(len(u_i)):
-        u_return[:,j] = np.array([x for x in u_i[j]])
+    # Adding 0 makes -0.0 into 0.0, so that they compare as equal below:
+    x = np.ascontiguousarray(np.asarray(in_array).astype(dtype) + 0)
+    # View each row as one item, so that np.unique compares whole rows:
+    rows = x.view(np.dtype((np.void, x.dtype.itemsize * x.shape[-1])))
+    u,i = np.unique(rows.ravel(), return_index=True)
 
     # Return back the same dtype as you originally had:
-    return u_return.T.astype(in_array.dtype)
+    return x[np.sort(i)].astype(in_array.dtype)
         
 def l2_norm(arr):
     """
@@ -462,6 +459,44 @@ def nearest_coord(vol, in_coords, tol=10):
     else:
         return None 
     
+def nearest_coords(vol, in_coords, tol=10):
+    """
+    Find the coordinates in vol that contain data (not nan) that are
+    spatially closest to each one of a set of coordinates, all at once.
+
+    Parameters
+    ----------
+    vol: 3-d array
+
+    in_coords: array of shape (3, n)
+        The coordinates to look up
+
+    tol: float
+        Coordinates further than this from any voxel with data are not found
+
+    Returns
+    -------
+    out_coords: int array of shape (3, n)
+        The nearest voxel with data for each of the coordinates (0 where
+        there is none)
+    found: boolean array of shape (n,)
+        Whether there was a voxel with data within tol of each coordinate
+    """
+    in_coords = np.reshape(np.asarray(in_coords, dtype=float), (3, -1))
+    vol_idx = np.array(np.where(~np.isnan(vol)))
+    n = in_coords.shape[-1]
+    if not vol_idx.shape[-1]:
+        return np.zeros((3, n), dtype=int), np.zeros(n, dtype=bool)
+
+    # Distances up to and including tol:
+    dist, idx = spatial.cKDTree(vol_idx.T).query(in_coords.T,
+                                    distance_upper_bound=np.nextafter(tol,
+                                                                      np.inf))
+    found = np.isfinite(dist)
+    out_coords = vol_idx[:, np.where(found, idx, 0)]
+    out_coords[:, ~found] = 0
+    return out_coords, found
+
 def coeff_of_determination(data, model, axis=-1):
     """
 
@@ -846,6 +881,98 @@ def ipr(a,alpha=5):
     return score1 - score2
 
     
+def fold_indices(these_b_inds, these_b_inds_rm0, all_inc_0, vec_pool,
+                 num_choose, combo_num):
+    """
+    Compute the indices describing one fold of k-fold cross-validation,
+    without touching the data.
+
+    Parameters
+    ----------
+    these_b_inds: 1 dimensional array
+        Indices currently undergoing k-fold cross-validation
+    these_b_inds_rm0: 1 dimensional array
+        Indices currently undergoing k-fold cross-validation but with respect to
+        the non-zero b values.
+    all_inc_0: 1 dimensional array
+        these_b_inds concatenated to the b = 0 indices
+    vec_pool: 1 dimensional array
+        Shuffled indices corresponding to each of the values in these_b_inds
+    num_choose: int
+        Number of b values to leave out at a time.
+    combo_num: int
+        Current fold of k-fold cross-validation
+
+    Returns
+    -------
+    si: 1 dimensional array
+        Sorted indices after removing a certain number of indices for k-fold
+        cross-validation
+    vec_combo: 1 dimensional array
+        Indices of b values to leave out for the current fold
+    vec_combo_rm0: 1 dimensional array
+        Indices of b values to leave out for the current fold with respect to
+        the non-zero b values
+    vec_pool_inds: 1 dimensional array
+        Shuffled indices to leave out during the current fold corresponding
+        to certain values in these_b_inds
+    these_inc0: 1 dimensional array
+        Sorted indices to the directions to fit to
+    """
+    these_b_inds = np.asarray(these_b_inds)
+    these_b_inds_rm0 = np.asarray(these_b_inds_rm0)
+
+    low = int((combo_num)*num_choose)
+    high = np.min([int(combo_num*num_choose + num_choose), len(vec_pool)])
+
+    vec_pool_inds = vec_pool[low:high]
+    vec_combo = these_b_inds[vec_pool_inds]
+    vec_combo_rm0 = these_b_inds_rm0[vec_pool_inds]
+
+    # Remove the chosen indices from the rest of the indices in one go (the
+    # outputs of setdiff1d are already sorted):
+    these_inc0 = np.setdiff1d(all_inc_0, vec_combo)
+    si = np.setdiff1d(these_b_inds_rm0, vec_combo_rm0)
+
+    return si, vec_combo, vec_combo_rm0, vec_pool_inds, these_inc0
+
+
+def fold_plan(these_b_inds, these_b_inds_rm0, all_inc_0, vec_pool, num_choose,
+              n_folds):
+    """
+    Describe all the folds of k-fold cross-validation as index arrays.
+
+    The plan can be computed once and then used to index into the masked,
+    flattened (voxels by volumes) signal matrix, instead of copying the full 4D
+    data for every fold.
+
+    Parameters
+    ----------
+    these_b_inds: 1 dimensional array
+        Indices currently undergoing k-fold cross-validation
+    these_b_inds_rm0: 1 dimensional array
+        Indices currently undergoing k-fold cross-validation but with respect to
+        the non-zero b values.
+    all_inc_0: 1 dimensional array
+        these_b_inds concatenated to the b = 0 indices
+    vec_pool: 1 dimensional array
+        Shuffled indices corresponding to each of the values in these_b_inds
+    num_choose: int
+        Number of b values to leave out at a time.
+    n_folds: int
+        Number of folds of k-fold cross-validation
+
+    Returns
+    -------
+    plan: list
+        One entry per fold, each a list with the outputs of `fold_indices`:
+        [si, vec_combo, vec_combo_rm0, vec_pool_inds, these_inc0]
+    """
+    return [fold_indices(these_b_inds, these_b_inds_rm0, all_inc_0, vec_pool,
+                         num_choose, combo_num)
+            for combo_num in range(int(n_folds))]
+
+
 def create_combos(bvecs, bvals, data, these_b_inds,
                   these_b_inds_rm0, all_inc_0, vec_pool, num_choose, combo_num):
     """
@@ -857,8 +984,10 @@ def create_combos(bvecs, bvals, data, these_b_inds,
         All the b vectors
     bvals: 1 dimensional array
         All b values
-    data: 4 dimensional array
-        Diffusion MRI data
+    data: 4 or 2 dimensional array
+        Diffusion MRI data. This can either be the full volume, or the masked
+        data flattened to voxels by volumes, in which case the output data
+        will also be flat.
     these_b_inds: 1 dimensional array
         Indices currently undergoing k-fold cross-validation
     these_b_inds_rm0: 1 dimensional array
@@ -890,43 +1019,57 @@ def create_combos(bvecs, bvals, data, these_b_inds,
         B vectors with a certain number of vectors from the fold removed
     these_bvals: 1 dimensional array
         B values with a certain number of b values from the fold removed
-    this_data: 4 dimensional array
+    this_data: 4 or 2 dimensional array
         Diffusion data with a certain number of directions from the fold removed
     these_inc0: 1 dimensional array
         Sorted indices to the directions to fit to
-    """
-    
-    idx = list(these_b_inds_rm0)
-    these_inc0 = list(all_inc_0)
-    
-    low = int((combo_num)*num_choose)
-    high = np.min([int(combo_num*num_choose + num_choose), len(vec_pool)])
-    
-    vec_pool_inds = vec_pool[low:high]
-    vec_combo = these_b_inds[vec_pool_inds]
-    vec_combo_rm0 = these_b_inds_rm0[vec_pool_inds]
-        
-    # Remove the chosen indices from the rest of the indices
-    for choice_idx in vec_pool_inds:
-        these_inc0.remove(these_b_inds[choice_idx])
-        idx.remove(these_b_inds_rm0[choice_idx])
 
-    # Make the list back into an array
-    these_inc0 = np.array(sorted(these_inc0))
-    
-    # Need to sort the indices first before indexing full model's
-    # regressors
-    si = sorted(idx)
+    See also
+    --------
+    fold_indices, fold_plan: the same indices, without copying any data.
+    """
+    (si, vec_combo, vec_combo_rm0,
+     vec_pool_inds, these_inc0) = fold_indices(these_b_inds, these_b_inds_rm0,
+                                               all_inc_0, vec_pool, num_choose,
+                                               combo_num)
     
     # Isolate the b vectors, b values, and data not including those
     # to be predicted
     these_bvecs = bvecs[:, these_inc0]
     these_bvals = bvals[these_inc0]
-    this_data = data[:, :, :, these_inc0]
+    this_data = data[..., these_inc0]
     
     return [si, vec_combo, vec_combo_rm0, vec_pool_inds, these_bvecs,
                                 these_bvals, this_data, these_inc0]
-                                
+
+
+def flat_data_mask(data, mask):
+    """
+    Flatten the data in the mask to a voxels by volumes matrix.
+
+    Models can be initialized with this matrix, together with the returned
+    (1 dimensional) mask, in which case all their volume outputs are flat as
+    well. This is used to avoid copying the full 4D data over and over again
+    (for example, in every fold of cross-validation).
+
+    Parameters
+    ----------
+    data: 4 dimensional array
+        Diffusion MRI data
+    mask: 3 dimensional array
+        Brain mask of the data
+
+    Returns
+    -------
+    flat_data: 2 dimensional array
+        The data in the mask, with shape (voxels, volumes)
+    flat_mask: 1 dimensional array
+        A boolean mask over the voxels of flat_data (all True)
+    """
+    flat_data = data[np.where(mask)]
+    return flat_data, np.ones(flat_data.shape[0], dtype=bool)
+
+
 def start_parallel(imports_str=None):
     """
     This function starts a parallel computing environment 
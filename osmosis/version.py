@@ -56,7 +56,8 @@ PACKAGES = ['osmosis',
             'osmosis.leastsqbound',
             'osmosis.viz',
             'osmosis.model',
-            'osmosis.emd']
+            'osmosis.emd',
+            'osmosis.parallel']
             
 PACKAGE_DATA = {"osmosis": ["LICENSE", "data/*.pdb", "data/*.mat",
                             "data/*.nii.gz", "data/*.trk","data/*.bvals",
@@ -67,4 +68,4 @@ REQUIRES = ["numpy", "matplotlib", "scipy", "nibabel", "dipy", "mayavi",
 
 BIN='bin/'
 
-EXTENSIONS = [dict(name="emd.emd", sources=["osmosis/emd/pyemd.c", "osmosis/emd/emd.c"], extra_compile_args=['-g'])]
+EXTENSIONS = [dict(name="emd.emd", sources=["osmosis/emd/pyemd.c", "osmosis/emd/emd.c"], extra_compile_args=['-g'], libraries=["pthread"])]
@@ -16,14 +16,24 @@ import osmosis.fibers as ozf
 import osmosis.utils as ozu
 
 
+def _fiber_offsets(fg):
+    """
+    Helper function to get the offsets of the nodes of each fiber into the
+    coordinates of the fiber group (fg.coords)
+    """
+    if isinstance(fg, ozf.CompactFiberGroup):
+        return fg.offsets
+    return np.concatenate([[0], np.cumsum([f.n_nodes for f in fg.fibers])]
+                          ).astype(int)
+
+
 def nii2fg(fg, nii, data_node=0, stat_name=None):
     """
     Attach data from a nifti volume to the fiber-group fiber_stats dict
 
     Parameters
     ----------
-    fg: A osmosis.fibers.FiberGroup class instance or a full path to a pdb
-        file.
+    fg: A osmosis.fibers.FiberGroup (or CompactFiberGroup) class instance
 
     nii: A nibabel.Nifti1 class instance or a full path to a nifti file.
 
@@ -37,7 +47,12 @@ def nii2fg(fg, nii, data_node=0, stat_name=None):
     -------
     fg: FiberGroup class instance with the generated statistic as one of the
     fiber_stat dictionary values.
-    
+
+    Note
+    ----
+    The value for each fiber is taken from the voxel with data (not nan)
+    nearest to its first/last node (and is nan if there is none within 10
+    voxels). The nearest voxels of all the fibers are found at once.
     """
 
     if data_node not in [0,-1]:
@@ -60,15 +75,18 @@ def nii2fg(fg, nii, data_node=0, stat_name=None):
     # Do not mutate the original fiber-group. Instead, return a copy with the
     # transformation applied to it:
     fg = fg.xform(affine, inplace=False)
-    
-    stat_arr = np.empty(fg.n_fibers)
-    for f_idx, fib in enumerate(fg.fibers):
-        this_coord = ozu.nearest_coord(data, fib.coords[:, data_node])
-        if this_coord is not None:
-            stat_arr[f_idx] = data[this_coord]
-        else: 
-            stat_arr[f_idx] = None
-    
+
+    offsets = _fiber_offsets(fg)
+    if data_node == 0:
+        node_idx = offsets[:-1]
+    else:
+        node_idx = offsets[1:] - 1
+
+    coords, found = ozu.nearest_coords(data, fg.coords[:, node_idx])
+    stat_arr = np.ones(len(node_idx)) * np.nan
+    stat_arr[found] = data[coords[0][found], coords[1][found],
+                           coords[2][found]]
+
     fg.fiber_stats[stat_name] = stat_arr
 
     return fg
@@ -79,7 +97,7 @@ def fg2volume(fg, stat, nii=None, shape=None, affine=None):
 
     Parameters
     ----------
-    fg: A FiberGroup class instance.
+    fg: A FiberGroup (or CompactFiberGroup) class instance.
 
     stat: str
         The key into fg.fiber_stats to extract the statistic of interest.
@@ -95,6 +113,12 @@ def fg2volume(fg, stat, nii=None, shape=None, affine=None):
     affine: If no nifti is provided, an affine can still be provided as
         input. If no affine is provided, defaults to np.eye(4)
 
+    Returns
+    -------
+    vol: array with the mean of the statistic over all the nodes in each
+        voxel (nan in voxels with no nodes). Fibers with several nodes in a
+        voxel count once for each node. Nodes outside of the volume are
+        ignored.
     """
     if nii is not None:
         if shape is not None or affine is not None:
@@ -116,20 +140,29 @@ def fg2volume(fg, stat, nii=None, shape=None, affine=None):
         if affine is None:
             affine = np.matrix(np.eye(4))
 
-    stat_dict = fg.fiber_stats[stat]
-    vol = np.zeros(shape)
-    count_fibs = np.zeros(shape)    
+    stat_arr = np.asarray(fg.fiber_stats[stat], dtype=float)
     fg = fg.xform(affine, inplace=False)
 
-    for fidx, fib in enumerate(fg.fibers):
-        coords = fib.coords.astype(int)
-        vol[coords[0], coords[1], coords[2]] += stat_dict[fidx]
-        count_fibs[coords[0], coords[1], coords[2]] += 1
+    # The statistic of each fiber goes to each one of its nodes:
+    node_stat = np.repeat(stat_arr, np.diff(_fiber_offsets(fg)))
+    coords = np.reshape(fg.coords, (3, -1)).astype(int)
+    vol_shape = tuple(shape[:3])
+    inside = np.all((coords >= 0) &
+                    (coords < np.array(vol_shape)[:, np.newaxis]), 0)
+    lin_idx = np.ravel_multi_index(coords[:, inside], vol_shape)
+
+    n_vox = int(np.prod(vol_shape))
+    vol = np.bincount(lin_idx, weights=node_stat[inside], minlength=n_vox)
+    count_fibs = np.bincount(lin_idx, minlength=n_vox)
 
     # Put nans where there were no fibers:
-    vol[np.where(count_fibs==0)] = np.nan
-    vol /=count_fibs
-        
+    vol[count_fibs == 0] = np.nan
+    vol[count_fibs > 0] /= count_fibs[count_fibs > 0]
+    vol = np.reshape(vol, vol_shape)
+    if len(shape) > 3:
+        # The same values go in all the volumes:
+        vol = vol.reshape(vol_shape + (1,) * (len(shape) - 3)) + np.zeros(shape)
+
     return vol
 
 